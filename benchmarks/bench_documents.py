@@ -0,0 +1,287 @@
+""" Benchmarks of nefertari_mongodb document hot paths.
+
+Runs against a local mongod:
+
+    python benchmarks/bench_documents.py \
+        --host mongodb://localhost:27017/nefertari_bench
+
+or against an in-memory mongomock stand-in (no mongod required, useful to
+track Python-side overhead):
+
+    python benchmarks/bench_documents.py --mock
+
+Results are written as JSON with `--output`, and may be compared with a
+baseline with `--compare` (non-zero exit code on regressions).
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import decimal
+import json
+import sys
+
+import mongoengine
+import pkg_resources
+from bson import ObjectId
+from mongoengine import connection
+
+from nefertari_mongodb import BaseDocument
+from nefertari_mongodb.serializers import JSONEncoder, ESJSONSerializer
+from nefertari_mongodb.utils import es_mapping_cache
+
+from runner import (
+    Benchmark, BENCHMARKS, add_arguments, add_rates, report, run_benchmarks)
+from models import BenchParent, BenchChild, MODELS
+
+
+COLLECTION_SIZES = (100, 1000, 10000)
+PAGE_SIZE = 20
+HYDRATE_SIZE = 10000
+
+
+def connect(host=None, mock=False, db_name='nefertari_bench'):
+    """ Connect mongoengine to mongod at :host: or to mongomock. """
+    if not mock:
+        mongoengine.connect(db_name, host=host)
+        return 'mongod'
+    import mongomock
+    alias = connection.DEFAULT_CONNECTION_NAME
+    connection.register_connection(alias, db_name)
+    connection._connections[alias] = mongomock.MongoClient()
+    return 'mongomock'
+
+
+def drop_collections():
+    for model in MODELS:
+        model.drop_collection()
+
+
+def populate(size, children_per_parent=0):
+    """ Create :size: parents with :children_per_parent: children each. """
+    drop_collections()
+    parent_collection = BenchParent._get_collection()
+    child_collection = BenchChild._get_collection()
+    children_ids = []
+    for i in range(size * children_per_parent):
+        child = BenchChild(
+            name='child%d' % i, position=i,
+            created_at=datetime.datetime(2015, 1, 1, 12, 30),
+            birthday=datetime.date(2000, 1, 1),
+            start_time=datetime.time(12, 30),
+            price=decimal.Decimal('1.50'))
+        children_ids.append(
+            child_collection.insert(child.to_mongo()))
+    for i in range(size):
+        ids = children_ids[
+            i * children_per_parent:(i + 1) * children_per_parent]
+        parent = BenchParent(
+            name='parent%d' % i, position=i,
+            tags=['tag%d' % (i % 10), 'common'],
+            settings={'key': i})
+        son = parent.to_mongo()
+        son['children'] = ids
+        parent_id = parent_collection.insert(son)
+        if ids:
+            child_collection.update(
+                {'_id': {'$in': ids}}, {'$set': {'parent': parent_id}},
+                multi=True)
+
+
+def register_get_collection():
+    for size in COLLECTION_SIZES:
+        for start in (0, size // 2, size - PAGE_SIZE):
+            def func(state, start=start):
+                list(BenchParent.get_collection(
+                    _limit=PAGE_SIZE, _start=start, _sort='position'))
+            BENCHMARKS.append(Benchmark(
+                'get_collection[size=%d,start=%d]' % (size, start), func,
+                setup=lambda size=size: populate(size),
+                params={'size': size, 'start': start, 'limit': PAGE_SIZE}))
+
+
+def setup_loaded_parents(size=100, children_per_parent=5):
+    populate(size, children_per_parent)
+    return list(BenchParent.objects)
+
+
+def bench_to_dict_nested(parents):
+    for parent in parents:
+        parent.to_dict()
+
+
+def bench_to_dict_flat(parents):
+    for parent in parents:
+        parent.to_dict(_depth=0)
+
+
+def setup_sons(size=HYDRATE_SIZE):
+    """ Create :size: sons of children as loaded from the database. """
+    sons = []
+    for i in range(size):
+        son = BenchChild(
+            name=u'child%d' % i, position=i,
+            created_at=datetime.datetime(2015, 1, 1, 12, 30),
+            birthday=datetime.date(2000, 1, 1),
+            start_time=datetime.time(12, 30),
+            price=decimal.Decimal('1.50')).to_mongo()
+        son['_id'] = ObjectId()
+        son['unknown'] = i
+        sons.append(son)
+    return sons
+
+
+def bench_hydrate(sons):
+    for son in sons:
+        BenchChild._from_son(son, only_fields=[])
+
+
+def bench_hydrate_mongoengine(sons):
+    for son in sons:
+        super(BaseDocument, BenchChild)._from_son(son, only_fields=[])
+
+
+def setup_save(state):
+    drop_collections()
+    return BenchParent(name='parent').save()
+
+
+def bench_save_with_backref(parent):
+    BenchChild(name='child', parent=parent).save()
+
+
+def setup_update(state):
+    populate(10, 5)
+    return list(BenchChild.objects), list(BenchParent.objects[:2])
+
+
+def bench_update_with_backref(state):
+    children, parents = state
+    for child in children:
+        child.update({'parent': parents[child.position % 2]})
+
+
+def bench_update_scalar(state):
+    children, _ = state
+    for child in children:
+        child.update({'position': child.position + 1})
+
+
+def setup_update_many(state, size=100):
+    populate(size)
+
+
+def bench_update_many_queryset(state):
+    BenchParent._update_many(BenchParent.objects, {'position': -1})
+
+
+def setup_update_many_list(state, size=100):
+    populate(size)
+    return list(BenchParent.objects)
+
+
+def bench_update_many_list(parents):
+    BenchParent._update_many(parents, {'position': -1})
+
+
+def setup_delete_many(state, size=100):
+    populate(size)
+    return list(BenchParent.objects)
+
+
+def bench_delete_many(parents):
+    BenchParent._delete_many(parents)
+
+
+def setup_serialized():
+    parents = setup_loaded_parents(100, 5)
+    return [parent.to_dict() for parent in parents]
+
+
+def bench_json_encoder(data):
+    json.dumps(data, cls=JSONEncoder)
+
+
+def bench_es_serializer(data):
+    serializer = ESJSONSerializer()
+    for item in data:
+        serializer.dumps(item)
+
+
+def bench_es_mapping_uncached(state):
+    es_mapping_cache.clear()
+    for model in MODELS:
+        model.get_es_mapping()
+
+
+def bench_es_mapping_cached(state):
+    for model in MODELS:
+        model.get_es_mapping()
+
+
+def register_benchmarks():
+    register_get_collection()
+    BENCHMARKS.extend([
+        Benchmark('to_dict[nested,100x5]', bench_to_dict_nested,
+                  setup=setup_loaded_parents),
+        Benchmark('to_dict[flat,100x5]', bench_to_dict_flat,
+                  setup=setup_loaded_parents),
+        Benchmark('_from_son[%d]' % HYDRATE_SIZE, bench_hydrate,
+                  setup=setup_sons, params={'documents': HYDRATE_SIZE}),
+        Benchmark('_from_son[mongoengine,%d]' % HYDRATE_SIZE,
+                  bench_hydrate_mongoengine, setup=setup_sons,
+                  params={'documents': HYDRATE_SIZE}),
+        Benchmark('save[backref]', bench_save_with_backref,
+                  setup_each=setup_save, number=20),
+        Benchmark('update[backref,50]', bench_update_with_backref,
+                  setup_each=setup_update),
+        Benchmark('update[scalar,50]', bench_update_scalar,
+                  setup_each=setup_update),
+        Benchmark('_update_many[queryset,100]', bench_update_many_queryset,
+                  setup_each=setup_update_many),
+        Benchmark('_update_many[list,100]', bench_update_many_list,
+                  setup_each=setup_update_many_list),
+        Benchmark('_delete_many[100]', bench_delete_many,
+                  setup_each=setup_delete_many),
+        Benchmark('JSONEncoder[100x5]', bench_json_encoder,
+                  setup=setup_serialized),
+        Benchmark('ESJSONSerializer[100x5]', bench_es_serializer,
+                  setup=setup_serialized),
+        Benchmark('get_es_mapping[uncached]', bench_es_mapping_uncached,
+                  number=100),
+        Benchmark('get_es_mapping[cached]', bench_es_mapping_cached,
+                  number=100),
+    ])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--host', default='mongodb://localhost:27017/nefertari_bench',
+        help='MongoDB URI of the database used by benchmarks')
+    parser.add_argument(
+        '--mock', action='store_true',
+        help='Use in-memory mongomock instead of mongod')
+    add_arguments(parser, repeat=5)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    backend = connect(args.host, mock=args.mock)
+    register_benchmarks()
+    try:
+        results = run_benchmarks(
+            BENCHMARKS, repeat=args.repeat, match=args.match,
+            meta={'backend': backend,
+                  'mongoengine': mongoengine.get_version(),
+                  'nefertari_mongodb': pkg_resources.get_distribution(
+                      'nefertari_mongodb').version})
+    finally:
+        drop_collections()
+    add_rates(results, 'documents')
+    return report(results, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
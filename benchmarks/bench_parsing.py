@@ -0,0 +1,86 @@
+""" Benchmarks of date and time strings parsing.
+
+Compares throughput of the fast ISO parsers used by `DateField`,
+`DateTimeField` and `TimeField` with `dateutil.parser` on canonical
+values as emitted by `JSONEncoderMixin`:
+
+    python benchmarks/bench_parsing.py --size 1000000
+
+No database is required. Results are written as JSON with `--output`, and
+may be compared with a baseline with `--compare`.
+"""
+from __future__ import print_function
+
+import argparse
+import datetime
+import sys
+
+import dateutil.parser
+
+from nefertari_mongodb.fields import parse_datetime, parse_time
+
+from runner import (
+    Benchmark, BENCHMARKS, add_arguments, add_rates, report, run_benchmarks)
+
+
+def make_values(size, fmt):
+    start = datetime.datetime(2000, 1, 1)
+    step = datetime.timedelta(seconds=3607)
+    return [(start + step * i).strftime(fmt) for i in range(size)]
+
+
+def bench_parse_datetime(values):
+    for value in values:
+        parse_datetime(value)
+
+
+def bench_parse_time(values):
+    for value in values:
+        parse_time(value)
+
+
+def bench_dateutil(values):
+    for value in values:
+        dateutil.parser.parse(value)
+
+
+def register_benchmarks(size):
+    params = {'values': size}
+    formats = (
+        ('date', '%Y-%m-%d', bench_parse_datetime),
+        ('datetime', '%Y-%m-%dT%H:%M:%SZ', bench_parse_datetime),
+        ('time', '%H:%M:%S', bench_parse_time),
+    )
+    for name, fmt, func in formats:
+        def setup(fmt=fmt):
+            return make_values(size, fmt)
+
+        BENCHMARKS.extend([
+            Benchmark('parse[fast,%s]' % name, func,
+                      setup=setup, params=params),
+            Benchmark('parse[dateutil,%s]' % name, bench_dateutil,
+                      setup=setup, params=params),
+        ])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument(
+        '--size', type=int, default=1000000,
+        help='Number of values parsed by each benchmark')
+    add_arguments(parser, repeat=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    register_benchmarks(args.size)
+    results = run_benchmarks(
+        BENCHMARKS, repeat=args.repeat, match=args.match,
+        meta={'size': args.size})
+    add_rates(results, 'values')
+    return report(results, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,30 @@
+""" Models used by benchmarks. """
+from nefertari_mongodb import BaseDocument
+from nefertari_mongodb import fields
+
+
+class BenchParent(BaseDocument):
+    _nested_relationships = ['children']
+    _nesting_depth = 1
+
+    name = fields.StringField()
+    position = fields.IntegerField()
+    tags = fields.ListField(
+        item_type=fields.StringField, field=fields.StringField())
+    settings = fields.DictField()
+    children = fields.Relationship(
+        document='BenchChild', backref_name='parent', ondelete='NULLIFY')
+
+
+class BenchChild(BaseDocument):
+    _nested_relationships = ['parent']
+
+    name = fields.StringField()
+    position = fields.IntegerField()
+    created_at = fields.DateTimeField()
+    birthday = fields.DateField()
+    start_time = fields.TimeField()
+    price = fields.DecimalField(scale=2)
+
+
+MODELS = (BenchParent, BenchChild)
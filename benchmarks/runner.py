@@ -0,0 +1,226 @@
+""" Minimal benchmark runner producing machine-readable results.
+
+Benchmarks are registered by adding `Benchmark` instances to `BENCHMARKS`
+and run by `run_benchmarks`. Results are written as JSON, so runs can be
+stored as baselines and compared later with `compare_results`.
+
+Command line options shared by benchmark scripts are added with
+`add_arguments`, and results are written with `report`.
+"""
+from __future__ import print_function
+
+import json
+import math
+import platform
+import sys
+import time
+import timeit
+
+
+BENCHMARKS = []
+
+
+class Benchmark(object):
+    """ Single benchmark case.
+
+    Attributes:
+        name: Unique name of the benchmark.
+        func: Callable being measured. Called with `setup` return value.
+        setup: Optional callable called once before measurements. Its
+            return value is passed to `func`.
+        setup_each: Optional callable called with `setup` return value
+            before each `func` call, outside of measured time. Its return
+            value is passed to `func` instead. Used by benchmarks which
+            consume their state (e.g. deletions).
+        teardown: Optional callable called with `setup` return value
+            after measurements.
+        params: Dict of parameters stored with results.
+        number: Number of `func` calls per measured round.
+    """
+    def __init__(self, name, func, setup=None, teardown=None, params=None,
+                 number=1, setup_each=None):
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.setup_each = setup_each
+        self.teardown = teardown
+        self.params = params or {}
+        self.number = number
+
+    def run(self, repeat):
+        """ Run benchmark :repeat: rounds and return timings in seconds
+        per single `func` call.
+        """
+        state = self.setup() if self.setup is not None else None
+        try:
+            if self.setup_each is not None:
+                return self._run_each(state, repeat)
+            # Warm up
+            self.func(state)
+            timings = []
+            for _ in range(repeat):
+                start = timeit.default_timer()
+                for _ in range(self.number):
+                    self.func(state)
+                timings.append(
+                    (timeit.default_timer() - start) / self.number)
+        finally:
+            if self.teardown is not None:
+                self.teardown(state)
+        return timings
+
+    def _run_each(self, state, repeat):
+        """ Run benchmark calling `setup_each` before each `func` call. """
+        # Warm up
+        self.func(self.setup_each(state))
+        timings = []
+        for _ in range(repeat):
+            elapsed = 0
+            for _ in range(self.number):
+                arg = self.setup_each(state)
+                start = timeit.default_timer()
+                self.func(arg)
+                elapsed += timeit.default_timer() - start
+            timings.append(elapsed / self.number)
+        return timings
+
+
+def summarize(benchmark, timings):
+    """ Compute statistics of :timings: of :benchmark:. """
+    timings = sorted(timings)
+    count = len(timings)
+    mean = sum(timings) / count
+    middle = count // 2
+    if count % 2:
+        median = timings[middle]
+    else:
+        median = (timings[middle - 1] + timings[middle]) / 2
+    variance = sum((t - mean) ** 2 for t in timings) / count
+    return {
+        'name': benchmark.name,
+        'params': benchmark.params,
+        'rounds': count,
+        'number': benchmark.number,
+        'min': timings[0],
+        'max': timings[-1],
+        'mean': mean,
+        'median': median,
+        'stdev': math.sqrt(variance),
+        'ops_per_sec': 1.0 / median if median else None,
+    }
+
+
+def run_benchmarks(benchmarks, repeat=5, match=None, meta=None):
+    """ Run :benchmarks: and return results dict.
+
+    :param match: Optional substring. Only benchmarks which names
+        contain it are run.
+    :param meta: Dict of additional metadata stored with results.
+    """
+    results = []
+    for bench in benchmarks:
+        if match and match not in bench.name:
+            continue
+        timings = bench.run(repeat)
+        result = summarize(bench, timings)
+        print('{:<55} {:>12.6f}s {:>12.1f} ops/s'.format(
+            bench.name, result['median'], result['ops_per_sec'] or 0),
+            file=sys.stderr)
+        results.append(result)
+
+    run_meta = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+    }
+    run_meta.update(meta or {})
+    return {'meta': run_meta, 'results': results}
+
+
+def write_results(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_results(current, baseline, threshold=0.1):
+    """ Compare median timings of :current: results with :baseline:.
+
+    Returns list of (name, baseline_median, current_median, change)
+    tuples of benchmarks that got slower by more than :threshold:
+    (a fraction, e.g. 0.1 is 10%). Prints comparison of all benchmarks
+    present in both results.
+    """
+    baseline_results = {r['name']: r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        base = baseline_results.get(result['name'])
+        if base is None or not base['median']:
+            continue
+        change = (result['median'] - base['median']) / base['median']
+        print('{:<55} {:>12.6f}s {:>12.6f}s {:>+8.1%}'.format(
+            result['name'], base['median'], result['median'], change),
+            file=sys.stderr)
+        if change > threshold:
+            regressions.append(
+                (result['name'], base['median'], result['median'], change))
+    return regressions
+
+
+def add_arguments(parser, repeat=5):
+    """ Add arguments common to benchmark scripts to argparse :parser:. """
+    parser.add_argument(
+        '--repeat', type=int, default=repeat,
+        help='Number of measured rounds of each benchmark')
+    parser.add_argument(
+        '--match', help='Only run benchmarks which names contain MATCH')
+    parser.add_argument(
+        '--output', help='Path of JSON file to write results to')
+    parser.add_argument(
+        '--compare', help='Path of JSON file with baseline results')
+    parser.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='Slowdown (fraction) reported as regression by --compare')
+    return parser
+
+
+def add_rates(results, param):
+    """ Add rates of :param: benchmark parameter (e.g. number of
+    documents processed by a call) per second to :results:.
+    """
+    for result in results['results']:
+        count = result['params'].get(param)
+        if count and result['median']:
+            key = '%s_per_sec' % param
+            result[key] = count / result['median']
+            print('{:<55} {:>14.1f} {}/s'.format(
+                result['name'], result[key], param), file=sys.stderr)
+    return results
+
+
+def report(results, args):
+    """ Write :results: as requested by :args: parsed by a parser set up
+    with `add_arguments`.
+
+    Returns exit code of benchmark script: 1 when `--compare` found
+    regressions, 0 otherwise.
+    """
+    if args.output:
+        write_results(results, args.output)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.compare:
+        regressions = compare_results(
+            results, load_results(args.compare), args.threshold)
+        if regressions:
+            print('%d benchmark(s) regressed' % len(regressions),
+                  file=sys.stderr)
+            return 1
+    return 0
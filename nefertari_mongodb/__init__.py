@@ -1,12 +1,14 @@
 import logging
 
 import mongoengine
+from pyramid.settings import asbool
 
 from .documents import (
     BaseDocument, ESBaseDocument, BaseMixin,
     get_document_cls, get_document_classes)
 from .serializers import JSONEncoder, ESJSONSerializer
 from .metaclasses import ESMetaclass
+from .signals import disable_es_signals
 from .utils import (
     relationship_fields, is_relationship_field,
     get_relationship_cls)
@@ -28,6 +30,7 @@ from .fields import (
     TimeField,
     UnicodeField,
     UnicodeTextField,
+    CaseInsensitiveStringField,
     Relationship,
     IdField,
     ForeignKeyField,
@@ -53,6 +56,7 @@ __all__ = [
     'TimeField',
     'UnicodeField',
     'UnicodeTextField',
+    'CaseInsensitiveStringField',
     'Relationship',
     'IdField',
     'ForeignKeyField',
@@ -77,7 +81,22 @@ log = logging.getLogger(__name__)
 
 def includeme(config):
     """ Include required packages. """
-    pass
+    settings = config.registry.settings
+    config.include('nefertari_mongodb.query_limits')
+    query_budget = asbool(settings.get('mongodb.query_budget', False))
+    if query_budget or asbool(settings.get('mongodb.instrumentation', False)):
+        config.include('nefertari_mongodb.instrumentation')
+    if query_budget:
+        config.include('nefertari_mongodb.query_budget')
+    if asbool(settings.get('mongodb.identity_map', False)):
+        config.include('nefertari_mongodb.identity_map')
+    if asbool(settings.get('mongodb.unit_of_work', False)):
+        config.include('nefertari_mongodb.unit_of_work')
+    if not asbool(settings.get('mongodb.es_signals', True)):
+        # ES is synced by `nefertari_mongodb.scripts.es_sync` runner
+        # (`nefertari-mongodb-es-sync` console script)
+        disable_es_signals()
+        log.info('ES signals disabled')
 
 
 def setup_database(config):
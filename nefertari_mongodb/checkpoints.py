@@ -0,0 +1,53 @@
+""" Persistent checkpoints of long running ES synchronisation jobs.
+
+Checkpoints make sync and reindex jobs resumable: a job stores its
+progress (e.g. a resume token or a watermark) under a key after each
+processed batch and starts from the stored value when restarted.
+"""
+import datetime
+import re
+
+from mongoengine.connection import get_db
+
+
+class CheckpointStore(object):
+    """ Stores checkpoints as documents of a mongo collection.
+
+    :collection_name: Name of collection checkpoints are stored in.
+    :db: pymongo database. Defaults to the default mongoengine database.
+    """
+    def __init__(self, collection_name='nefertari_checkpoints', db=None):
+        self.collection_name = collection_name
+        self._db = db
+
+    @property
+    def collection(self):
+        db = self._db if self._db is not None else get_db()
+        return db[self.collection_name]
+
+    def get(self, key, default=None):
+        """ Get value of checkpoint :key:. """
+        checkpoint = self.collection.find_one({'_id': key})
+        if checkpoint is None:
+            return default
+        return checkpoint['value']
+
+    def set(self, key, value):
+        """ Store :value: of checkpoint :key:. """
+        self.collection.update(
+            {'_id': key},
+            {'$set': {
+                'value': value,
+                'updated_at': datetime.datetime.utcnow(),
+            }},
+            upsert=True)
+
+    def delete(self, key):
+        self.collection.remove({'_id': key})
+
+    def keys(self, prefix=''):
+        """ Get keys of checkpoints that start with :prefix:. """
+        query = {}
+        if prefix:
+            query['_id'] = {'$regex': '^%s' % re.escape(prefix)}
+        return [doc['_id'] for doc in self.collection.find(query, ['_id'])]
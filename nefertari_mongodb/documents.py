@@ -1,8 +1,16 @@
 import copy
+import datetime
 import logging
+import re
+from functools import partial
 
 import six
 import mongoengine as mongo
+from bson import ObjectId, SON
+from pymongo.errors import (
+    BulkWriteError, DuplicateKeyError, ExecutionTimeout, OperationFailure)
+from mongoengine.base.document import NON_FIELD_ERRORS
+from mongoengine.queryset import transform
 
 from nefertari.json_httpexceptions import (
     JHTTPBadRequest, JHTTPNotFound, JHTTPConflict)
@@ -10,18 +18,43 @@ from nefertari.utils import (
     process_fields, process_limit, _split, dictset, drop_reserved_params)
 from .metaclasses import ESMetaclass, DocumentMetaclass
 from .signals import on_bulk_update
+from .utils import (
+    es_mapping_cache, get_counted_relationships, BackgroundCall,
+    iter_prefetched)
+from .identity_map import get_identity_map, active_identity_map
+from .unit_of_work import get_unit_of_work
+from .filtering import filter_documents, UnsupportedQuery
+from . import query_limits, query_hints
 from .fields import (
     DateTimeField, IntegerField, ForeignKeyField, RelationshipField,
     DictField, ListField, ChoiceField, ReferenceField, StringField,
     TextField, UnicodeField, UnicodeTextField,
     IdField, BooleanField, BinaryField, DecimalField, FloatField,
     BigIntegerField, SmallIntegerField, IntervalField, DateField,
-    TimeField, BaseFieldMixin
+    TimeField, BaseFieldMixin, LazyValue, CaseInsensitiveStringField,
+    normalize_case,
 )
 
 
 log = logging.getLogger(__name__)
 
+# Keys other than field names accepted by init of loaded documents
+INTERNAL_INIT_KEYS = (
+    'id', 'pk', '_cls', '_text_score',
+    '__auto_convert', '__only_fields', '_created',
+)
+
+# Types of stored values returned unchanged by `to_python` of mongoengine
+# fields. Types are matched exactly, so e.g. bool is not an int.
+STORED_TYPES = (
+    (mongo.StringField, (six.text_type,)),
+    (mongo.IntField, (int,)),
+    (mongo.FloatField, (float,)),
+    (mongo.BooleanField, (bool,)),
+    (mongo.ObjectIdField, (ObjectId,)),
+    (mongo.DateTimeField, (datetime.datetime,)),
+)
+
 
 def get_document_cls(name):
     try:
@@ -30,6 +63,20 @@ def get_document_cls(name):
         raise ValueError('`%s` does not exist in mongo db' % name)
 
 
+def get_stored_types(field):
+    """ Get types of stored values :field: `to_python` returns unchanged.
+
+    Fields which override `to_python` of their mongoengine base have no
+    such types.
+    """
+    to_python = six.get_unbound_function(type(field).to_python)
+    for base, types in STORED_TYPES:
+        if (isinstance(field, base) and
+                to_python is six.get_unbound_function(base.to_python)):
+            return types
+    return ()
+
+
 def get_document_classes():
     """ Get all defined not abstract document classes
 
@@ -63,11 +110,141 @@ def process_bools(_dict):
     return _dict
 
 
+def case_insensitive_condition(op, value):
+    """ Get condition of :op: filter by :value: on normalized values of
+    a case-insensitive field. Returns None for unsupported operators.
+    """
+    if op in ('', 'iexact'):
+        return normalize_case(value)
+    if op == 'in':
+        return {'$in': [normalize_case(val) for val in value]}
+    if op in ('startswith', 'istartswith'):
+        prefix = re.escape(normalize_case(value))
+        return {'$regex': '^' + prefix}
+    return None
+
+
+def prefix_query(query, prefix):
+    """ Prefix field names of mongo :query: with :prefix:.
+
+    Used to filter embedded documents, e.g. the ones joined by `$lookup`.
+    """
+    prefixed = {}
+    for key, value in query.items():
+        if key in ('$and', '$or', '$nor'):
+            prefixed[key] = [prefix_query(val, prefix) for val in value]
+        else:
+            prefixed['%s.%s' % (prefix, key)] = value
+    return prefixed
+
+
+def _query_key(query):
+    """ Get hashable key of equality-only mongo :query:.
+
+    Returns None if query contains operators or unhashable values.
+    """
+    keys = tuple(sorted(query.keys()))
+    values = tuple(query[key] for key in keys)
+    if any(key.startswith('$') or isinstance(val, (dict, list))
+           for key, val in zip(keys, values)):
+        return None
+    return (keys, values)
+
+
+def _projected_fields(model, projection):
+    """ Get names of fields of :model: loaded with mongo :projection:. """
+    include = 1 in projection.values()
+    names = []
+    for name, field in model._fields.items():
+        value = projection.get(field.db_field)
+        if value is None:
+            # `_id` is loaded unless it is excluded explicitly
+            loaded = not include or field.db_field == '_id'
+        else:
+            loaded = bool(value)
+        if loaded:
+            names.append(name)
+    return names
+
+
+def _project_documents(model, documents, _fields):
+    """ Get copies of loaded :documents: of :model: with only the fields
+    selected by :_fields:, like `apply_fields` loads them from the
+    database.
+    """
+    fields_only, fields_exclude = process_fields(_fields)
+    if fields_only and fields_exclude:
+        raise UnsupportedQuery('Included and excluded _fields')
+    projection = {}
+    for name in fields_only or fields_exclude:
+        field = model._fields.get(name)
+        if field is None:
+            raise UnsupportedQuery('Unknown field `%s` in _fields' % name)
+        projection[field.db_field] = 1 if fields_only else 0
+    only_fields = _projected_fields(model, projection)
+    db_fields = set(model._fields[name].db_field for name in only_fields)
+    return [
+        model._from_son(
+            {key: val for key, val in document.to_mongo().items()
+             if key in db_fields},
+            only_fields=only_fields)
+        for document in documents]
+
+
+def _index_by_queries(documents, queries):
+    """ Index mongo :documents: by keys of equality-only :queries:
+    they match.
+
+    Returns a tuple of (index, ambiguous) where `ambiguous` is a set of
+    keys matched by more than one document.
+    """
+    key_sets = set(tuple(sorted(query.keys())) for query in queries)
+    index = {}
+    ambiguous = set()
+    for son in documents:
+        for keys in key_sets:
+            key = (keys, tuple(son.get(key) for key in keys))
+            try:
+                if index.setdefault(key, son) is not son:
+                    ambiguous.add(key)
+            except TypeError:  # Unhashable value
+                continue
+    return index, ambiguous
+
+
+def chunk_ids(ids, size):
+    """ Split :ids: into lists of at most :size: unique ids. """
+    seen = set()
+    chunk = []
+    for id_ in ids:
+        key = six.text_type(id_)
+        if key in seen:
+            continue
+        seen.add(key)
+        chunk.append(id_)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class DocumentsList(list):
+    """ List of documents.
+
+    Used to return documents which are not loaded by a QuerySet. Like
+    query sets returned by `BaseMixin.get_collection`, it may hold
+    `_nefertari_meta`.
+    """
+    _nefertari_meta = None
+
+
 TYPES_MAP = {
     StringField: {'type': 'string'},
     TextField: {'type': 'string'},
     UnicodeField: {'type': 'string'},
     UnicodeTextField: {'type': 'string'},
+    CaseInsensitiveStringField: {'type': 'string'},
     mongo.fields.ObjectIdField: {'type': 'string'},
     ForeignKeyField: {'type': 'string'},
     IdField: {'type': 'string'},
@@ -107,42 +284,95 @@ class BaseMixin(object):
         _nesting_depth: Depth of relationship field nesting in JSON.
             Defaults to 1(one) which makes only one level of relationship
             nested.
+        _atomic_iterables: Boolean, defaults to False. When True, updates
+            of ListField and DictField values are applied server-side with
+            atomic update operators. See `update_iterables`.
+        _validate_changed_only: Boolean, defaults to False. When True,
+            `update` only validates fields that were changed instead of
+            validating the whole document. Creation always performs full
+            validation.
+        _ids_chunk_size: Integer, defaults to 1000. Max number of ids
+            queried at once by `get_by_ids` and `iter_by_ids`.
+        _concurrent_count: Boolean, defaults to False. When True,
+            `get_collection` counts documents in a background thread while
+            the page of documents is fetched.
+        _max_time_ms: Integer, defaults to None. Time limit in
+            milliseconds of queries of the model after which MongoDB aborts
+            them. When None, 'mongodb.max_time_ms' setting is used. See
+            `nefertari_mongodb.query_limits`.
+        _allow_disk_use: Boolean, defaults to False. When True,
+            aggregations of the model may write temporary files.
+        _hint: Index forced for queries of `get_collection`, as a list or
+            a comma-separated string of field names prefixed with '-' for
+            descending order. Defaults to None. See
+            `nefertari_mongodb.query_hints`.
+        _covered_queries: Boolean, defaults to False. When True, `_id` is
+            excluded from projection of queries which only filter, sort
+            and load fields of an index, so they are served from the index.
     """
     _public_fields = None
     _auth_fields = None
     _hidden_fields = None
     _nested_relationships = ()
     _backref_hooks = ()
+    # Atomic updates of iterables deferred to `save`
+    _pending_updates = ()
     _nesting_depth = 1
+    _atomic_iterables = False
+    _validate_changed_only = False
+    _ids_chunk_size = 1000
+    _concurrent_count = False
+    _max_time_ms = None
+    _allow_disk_use = False
+    _hint = None
+    _covered_queries = False
 
     _type = property(lambda self: self.__class__.__name__)
     Q = mongo.Q
 
     @classmethod
     def get_es_mapping(cls, _depth=None, types_map=None):
-        """ Generate ES mapping from model schema. """
-        from nefertari.elasticsearch import ES
+        """ Generate ES mapping from model schema.
+
+        Generated mappings are cached per model, depth and types map.
+        Cache is cleared each time a new document class is defined, as
+        it may add backreference fields to existing models.
+        """
         if types_map is None:
             types_map = TYPES_MAP
         if _depth is None:
             _depth = cls._nesting_depth
-        depth_reached = _depth <= 0
+        return copy.deepcopy(cls._get_es_mapping(_depth, types_map))
+
+    @classmethod
+    def _get_es_mapping(cls, _depth, types_map):
+        """ Get cached ES mapping or generate and cache a new one.
 
+        Mappings of nested relationships are taken from the same cache,
+        thus each (model, depth) mapping is only generated once even if
+        it is shared by many models. Returned mapping must not be
+        modified as it is shared.
+        """
+        from nefertari.elasticsearch import ES
+        key = (cls, _depth, id(types_map))
+        if key in es_mapping_cache:
+            return es_mapping_cache[key][1]
+
+        depth_reached = _depth <= 0
         properties = {}
         mapping = {
             ES.src2type(cls.__name__): {
                 'properties': properties
             }
         }
-        fields = cls._fields.copy()
-        for name, field in fields.items():
+        for name, field in cls._fields.items():
             if isinstance(field, RelationshipField):
                 field = field.field
             if isinstance(field, (ReferenceField, RelationshipField)):
                 if name in cls._nested_relationships and not depth_reached:
                     field_mapping = {'type': 'nested'}
-                    submapping = field.document_type.get_es_mapping(
-                        _depth=_depth-1)
+                    submapping = field.document_type._get_es_mapping(
+                        _depth-1, types_map)
                     field_mapping.update(list(submapping.values())[0])
                 else:
                     field_mapping = types_map[
@@ -160,6 +390,8 @@ class BaseMixin(object):
             properties[name] = types_map[field_type]
 
         properties['_pk'] = {'type': 'string'}
+        # `types_map` is kept to make sure its id is not reused
+        es_mapping_cache[key] = (types_map, mapping)
         return mapping
 
     @classmethod
@@ -212,6 +444,28 @@ class BaseMixin(object):
             if name.split('__')[0] in fields
         })
 
+    @classmethod
+    def _pop_case_insensitive_filters(cls, params):
+        """ Pop filters of case-insensitive fields from :params:.
+
+        Returns raw query which performs them on normalized values, so
+        they use the index of normalized values.
+        """
+        conditions = []
+        for key in list(params.keys()):
+            name, _, op = key.partition('__')
+            field = cls._fields.get(name)
+            if not getattr(field, 'case_insensitive', False):
+                continue
+            condition = case_insensitive_condition(op, params[key])
+            if condition is None:
+                continue
+            params.pop(key)
+            conditions.append({field.shadow_field: condition})
+        if len(conditions) > 1:
+            return {'$and': conditions}
+        return conditions[0] if conditions else {}
+
     @classmethod
     def apply_fields(cls, query_set, _fields):
         fields_only, fields_exclude = process_fields(_fields)
@@ -222,6 +476,10 @@ class BaseMixin(object):
 
             if fields_exclude:
                 query_set = query_set.exclude(*fields_exclude)
+                # Documents loaded without some of the fields are not
+                # put in identity map
+                query_set.only_fields = _projected_fields(
+                    cls, query_set._loaded_fields.as_dict())
 
         except mongo.InvalidQueryError as e:
             raise JHTTPBadRequest('Bad _fields param: %s ' % e)
@@ -234,6 +492,32 @@ class BaseMixin(object):
             return query_set
         return query_set.order_by(*_sort)
 
+    @classmethod
+    def has_text_index(cls):
+        """ Check if model has a text index (e.g. `'$title'` index in
+        `meta['indexes']`), which is required for text search.
+        """
+        for spec in cls._meta.get('index_specs') or ():
+            if any(kind == 'text' for _, kind in spec['fields']):
+                return True
+        return False
+
+    @classmethod
+    def apply_text_search(cls, query_set, text, sort=True):
+        """ Apply MongoDB `$text` search of :text: to :query_set:.
+
+        Text score of documents is projected and documents are sorted by
+        it when :sort: is True.
+        Raises JHTTPBadRequest if model has no text index.
+        """
+        if not cls.has_text_index():
+            raise JHTTPBadRequest(
+                'Text search is not supported by `%s`' % cls.__name__)
+        query_set = query_set.search_text(text)
+        if sort:
+            query_set = query_set.order_by('$text_score')
+        return query_set
+
     @classmethod
     def count(cls, query_set):
         return query_set.count(with_limit_and_skip=True)
@@ -242,10 +526,23 @@ class BaseMixin(object):
     def filter_objects(cls, objects, first=False, **params):
         """ Perform query with :params: on instances sequence :objects:
 
+        When all :objects: are instances of :cls:, query is evaluated in
+        memory if possible (see `nefertari_mongodb.filtering`). Otherwise
+        objects are queried from the database by their ids.
+
         Arguments:
             :object: Sequence of :cls: instances on which query should be run.
             :params: Query parameters to filter :objects:.
         """
+        objects = list(objects)
+        if all(isinstance(obj, cls) for obj in objects):
+            try:
+                return cls._filter_loaded_objects(
+                    objects, first=first, **params)
+            except UnsupportedQuery as ex:
+                log.debug('Filtering %s objects in database: %s',
+                          cls.__name__, ex)
+
         id_name = cls.pk_field()
         key = '{}__in'.format(id_name)
         ids = [getattr(obj, id_name, None) for obj in objects]
@@ -257,12 +554,97 @@ class BaseMixin(object):
         else:
             return cls.get_collection(**params)
 
+    @classmethod
+    def _filter_loaded_objects(cls, objects, first=False, **params):
+        """ Evaluate query with :params: on loaded :objects: in memory.
+
+        Params are processed like in `get_collection`. Raises
+        UnsupportedQuery if query can't be evaluated in memory.
+        """
+        unsupported = {
+            '_q', '_explain', '_query_only', 'query_set'} & set(params)
+        if unsupported:
+            raise UnsupportedQuery(', '.join(unsupported))
+        params.pop('__confirmation', False)
+        _strict = params.pop('_strict', True)
+        _sort = _split(params.pop('_sort', []))
+        _fields = _split(params.pop('_fields', []))
+        _limit = params.pop('_limit', None)
+        _page = params.pop('_page', None)
+        _start = params.pop('_start', None)
+        _count = '_count' in params
+        params.pop('_count', None)
+        _raise_on_empty = params.pop('_raise_on_empty', first)
+        params.pop('_item_request', None)
+
+        params = dictset({
+            key: val for key, val in params.items()
+            if not key.startswith('__')
+        })
+        params = drop_reserved_params(params)
+        if _strict:
+            _check_fields = [
+                f.strip('-+') for f in list(params.keys()) + _fields + _sort]
+            cls.check_fields_allowed(_check_fields)
+        else:
+            params = cls.filter_fields(params)
+        process_lists(params)
+        process_bools(params)
+        params.pop_by_values('_all')
+
+        results = filter_documents(cls, objects, params, _sort=_sort)
+        _total = len(results)
+        if _count:
+            return _total
+        if first:
+            _start, _limit = 0, 1
+        elif _limit is not None:
+            _start, _limit = process_limit(_start, _page, _limit)
+        if _limit is not None:
+            results = results[_start:_start+_limit]
+
+        if _fields:
+            results = _project_documents(cls, results, _fields)
+
+        if not results:
+            msg = "'%s(%s)' resource not found" % (cls.__name__, params)
+            if _raise_on_empty:
+                raise JHTTPNotFound(msg)
+            log.debug(msg)
+        if first:
+            return results[0] if results else None
+
+        documents = DocumentsList(results)
+        documents._nefertari_meta = dict(
+            total=_total,
+            start=_start,
+            fields=_fields)
+        return documents
+
     @classmethod
     def get_collection(cls, **params):
         """
-        Params may include '_limit', '_page', '_sort', '_fields'.
+        Params may include '_limit', '_page', '_sort', '_fields', '_q'.
         Returns paginated and sorted query set.
         Raises JHTTPBadRequest for bad values in params.
+
+        '_q' performs MongoDB text search (see `apply_text_search`).
+        Results are sorted by text score unless '_sort' is passed.
+
+        When '_query_only' is passed, the query set is returned without
+        performing any queries (it is not counted).
+
+        When `_concurrent_count` is True and '_limit' is passed, the page
+        of documents is fetched while documents are counted in a
+        background thread, which is waited for before the query set is
+        returned.
+
+        '_max_time_ms' changes time limit of queries (see
+        `nefertari_mongodb.query_limits`). Queries which exceed it raise
+        `JHTTPServiceUnavailable`.
+
+        '_hint' forces index used by queries (see
+        `nefertari_mongodb.query_hints`).
         """
         log.debug('Get collection: {}, {}'.format(cls.__name__, params))
         params.pop('__confirmation', False)
@@ -281,6 +663,23 @@ class BaseMixin(object):
         _explain = '_explain' in params
         params.pop('_explain', None)
         _raise_on_empty = params.pop('_raise_on_empty', False)
+        _query_only = params.pop('_query_only', False)
+        _q = params.pop('_q', None)
+        _max_time_ms = query_limits.get_max_time_ms(
+            cls, params.pop('_max_time_ms', None))
+        # Only aggregations may use disk
+        params.pop('_allow_disk_use', None)
+        _hint = params.pop('_hint', None)
+        if _hint:
+            query_hints.check_request_hint()
+            if _q:
+                raise JHTTPBadRequest('_hint can not be used with _q')
+        elif not _q:
+            _hint = cls._hint
+
+        _concurrent = (
+            cls._concurrent_count and _limit is not None and
+            not (_query_only or _count or _explain))
 
         if query_set is None:
             query_set = cls.objects
@@ -304,23 +703,51 @@ class BaseMixin(object):
 
         # If param is _all then remove it
         params.pop_by_values('_all')
+        normalized_query = cls._pop_case_insensitive_filters(params)
 
         try:
             query_set = query_set(**params)
-            _total = query_set.count()
-            if _count:
-                return _total
+            if normalized_query:
+                query_set = query_set(__raw__=normalized_query)
+            if _q:
+                query_set = cls.apply_text_search(
+                    query_set, _q, sort=not _sort)
+            if _hint:
+                _hint = query_hints.parse_hint(cls, _hint)
+                query_set = query_set.hint(_hint)
+            if _query_only:
+                _total = None
+            elif _concurrent:
+                count_set = query_limits.apply_max_time_ms(
+                    query_set.clone(), _max_time_ms)
+                _total = BackgroundCall(count_set.count)
+            else:
+                query_limits.apply_max_time_ms(query_set, _max_time_ms)
+                _total = query_set.count()
+                if _count:
+                    return _total
 
             # Filtering by fields has to be the first thing to do on the
             # query_set!
             query_set = cls.apply_fields(query_set, _fields)
             query_set = cls.apply_sort(query_set, _sort)
+            if cls._covered_queries and not _query_only:
+                query_set = query_hints.apply_covered_projection(
+                    cls, query_set, hint=_hint)
 
             if _limit is not None:
                 _start, _limit = process_limit(_start, _page, _limit)
                 query_set = query_set[_start:_start+_limit]
+            query_set = query_limits.apply_max_time_ms(
+                query_set, _max_time_ms)
 
-            if not query_set.count():
+            if _concurrent:
+                # Fetches the page while documents are counted
+                found = len(query_set)
+                _total = _total.result()
+            else:
+                found = _query_only or query_set.count()
+            if not found:
                 msg = "'%s(%s)' resource not found" % (cls.__name__, params)
                 if _raise_on_empty:
                     raise JHTTPNotFound(msg)
@@ -335,6 +762,11 @@ class BaseMixin(object):
                 raise JHTTPBadRequest(str(ex), extra={'data': ex})
         except mongo.InvalidQueryError as ex:
             raise JHTTPBadRequest(str(ex), extra={'data': ex})
+        except ExecutionTimeout as ex:
+            query_limits.raise_timeout(cls, ex)
+
+        if _query_only:
+            return query_set
 
         if _explain:
             return query_set.explain()
@@ -349,6 +781,100 @@ class BaseMixin(object):
 
         return query_set
 
+    @classmethod
+    def get_facets(cls, **params):
+        """ Count documents matching :params: by values of '_facets'.
+
+        Params are the same as of `get_collection`. '_facets' are names of
+        fields to count documents by. Documents are counted by each item
+        of ListField values. All counts are performed by a single `$facet`
+        aggregation, which requires MongoDB 3.4.
+
+        Returns dict with 'facets' which maps each field name to a list of
+        {'value': value, 'count': count} buckets sorted by count. When
+        '_limit' is passed, a page of documents is returned as 'data' and
+        number of matching documents as 'total'. 'total' is also returned
+        when '_count' is passed.
+        """
+        _facets = _split(params.pop('_facets', []))
+        if not _facets:
+            raise JHTTPBadRequest('Missing _facets param')
+        cls.check_fields_allowed(_facets)
+        not_fields = set(_facets) - set(cls._fields)
+        if not_fields:
+            raise JHTTPBadRequest(
+                "'%s' object does not have fields: %s" % (
+                    cls.__name__, ', '.join(not_fields)))
+        _sort = _split(params.pop('_sort', []))
+        _limit = params.pop('_limit', None)
+        _page = params.pop('_page', None)
+        _start = params.pop('_start', None)
+        _count = '_count' in params or _limit is not None
+        params.pop('_count', None)
+        _fields = _split(params.get('_fields', []))
+        limits = dict(
+            max_time_ms=query_limits.get_max_time_ms(
+                cls, params.get('_max_time_ms')),
+            allow_disk_use=query_limits.get_allow_disk_use(
+                cls, params.get('_allow_disk_use')))
+        params['_query_only'] = True
+        query_set = cls.get_collection(**params)
+
+        facets = {}
+        for name in _facets:
+            field = cls._fields[name]
+            path = '$' + field.db_field
+            stages = []
+            if isinstance(field, mongo.ListField):
+                stages.append({'$unwind': path})
+            stages += [
+                {'$group': {'_id': path, 'count': {'$sum': 1}}},
+                {'$sort': SON([('count', -1), ('_id', 1)])},
+            ]
+            facets['facet_' + name] = stages
+        if _count:
+            facets['total'] = [{'$count': 'count'}]
+        if _limit is not None:
+            _start, _limit = process_limit(_start, _page, _limit)
+            stages = []
+            ordering = cls.apply_sort(query_set, _sort)._ordering
+            if ordering:
+                stages.append({'$sort': SON(ordering)})
+            stages += [{'$skip': _start}, {'$limit': _limit}]
+            projection = query_set._loaded_fields.as_dict()
+            if projection:
+                stages.append({'$project': projection})
+            facets['data'] = stages
+
+        try:
+            pipeline = [{'$match': query_set._query}, {'$facet': facets}]
+            cursor = cls._aggregate(pipeline, **limits)
+            result = next(iter(cursor), {})
+        except mongo.ValidationError as ex:
+            raise JHTTPBadRequest(str(ex), extra={'data': ex})
+        except ExecutionTimeout as ex:
+            query_limits.raise_timeout(cls, ex)
+        except OperationFailure as ex:
+            raise JHTTPBadRequest('Facets aggregation failed: %s' % ex)
+
+        response = {'facets': {
+            name: [{'value': bucket['_id'], 'count': bucket['count']}
+                   for bucket in result.get('facet_' + name, [])]
+            for name in _facets}}
+        if _count:
+            total = result.get('total')
+            response['total'] = total[0]['count'] if total else 0
+        if _limit is not None:
+            documents = DocumentsList(
+                cls._from_son(son, only_fields=query_set.only_fields)
+                for son in result.get('data', []))
+            documents._nefertari_meta = dict(
+                total=response['total'],
+                start=_start,
+                fields=_fields)
+            response['data'] = documents
+        return response
+
     @classmethod
     def has_field(cls, field):
         return field in cls._fields
@@ -356,16 +882,46 @@ class BaseMixin(object):
     @classmethod
     def fields_to_query(cls):
         query_fields = [
-            'id', '_limit', '_page', '_sort', '_fields', '_count', '_start']
+            'id', '_limit', '_page', '_sort', '_fields', '_count', '_start',
+            '_q', '_max_time_ms', '_allow_disk_use', '_hint']
         return query_fields + list(cls._fields.keys())
 
     @classmethod
     def get_item(cls, **params):
+        document = cls._get_mapped_item(params)
+        if document is not None:
+            return document
         params.setdefault('_raise_on_empty', True)
         params['_limit'] = 1
         params['_item_request'] = True
         query_set = cls.get_collection(**params)
-        return query_set.first()
+        # Unlike `first`, iteration doesn't clone the query set, which
+        # would drop its time limit
+        try:
+            return next(iter(query_set), None)
+        except ExecutionTimeout as ex:
+            query_limits.raise_timeout(cls, ex)
+
+    @classmethod
+    def _get_mapped_item(cls, params):
+        """ Get item from current identity map if :params: only filter
+        by primary key.
+        """
+        identity_map = get_identity_map()
+        if identity_map is None:
+            return None
+        filters = [key for key in params if not key.startswith('_')]
+        ignored = {'_raise_on_empty', '__raise_on_empty', '__confirmation'}
+        if set(params) - set(filters) - ignored or len(filters) != 1:
+            return None
+        pk_field = cls.pk_field()
+        if filters[0] not in (pk_field, 'id', 'pk'):
+            return None
+        try:
+            pk = cls._fields[pk_field].to_mongo(params[filters[0]])
+        except Exception:
+            return None
+        return identity_map.get(cls, pk)
 
     def unique_fields(self):
         pk_field = [self.pk_field()]
@@ -374,14 +930,186 @@ class BaseMixin(object):
 
     @classmethod
     def get_or_create(cls, **params):
+        """ Get document matching :params: or create a new one.
+
+        Existing document is looked up first. When there is none, it is
+        created atomically by a single `findAndModify` upsert which
+        inserts the document built from :params: and `defaults` (using
+        `$setOnInsert`) if no document matches :params: by then.
+
+        Returns a tuple of (document, created). Validation, backref hooks
+        and save signals are only run when the document is created.
+        Raises JHTTPBadRequest when more than one document matches
+        :params:.
+        """
         defaults = params.pop('defaults', {})
+        query = cls._get_upsert_query(params)
+        collection = cls._get_collection()
+        existing = list(collection.find(query).limit(2))
+        if len(existing) > 1:
+            raise JHTTPBadRequest('Bad or Insufficient Params')
+        if existing:
+            return cls._from_son(existing[0]), False
+
+        update, document = cls._get_upsert_operation(
+            query, params, defaults)
+        upsert = partial(
+            collection.find_and_modify, query=query, update=update,
+            upsert=True, new=True, full_response=True)
         try:
-            return cls.objects.get(**params), False
-        except mongo.queryset.DoesNotExist:
-            defaults.update(params)
-            return cls(**defaults).save(), True
-        except mongo.queryset.MultipleObjectsReturned:
+            try:
+                result = upsert()
+            except DuplicateKeyError:
+                # Document was inserted by a concurrent upsert. Retry to
+                # get it
+                result = upsert()
+        except DuplicateKeyError as e:
+            raise JHTTPConflict(
+                detail='Resource `{}` already exists.'.format(
+                    cls.__name__),
+                extra={'data': e})
+
+        created = not result['lastErrorObject']['updatedExisting']
+        # `$setOnInsert` doesn't change matched documents, thus ambiguous
+        # params are only checked when a document exists
+        if not created and cls._is_ambiguous_query(collection, query):
             raise JHTTPBadRequest('Bad or Insufficient Params')
+        obj = cls._from_son(result['value'])
+        if created:
+            cls._on_upsert_created(document, obj)
+        return obj, created
+
+    @classmethod
+    def get_or_create_many(cls, items, defaults=None):
+        """ Bulk version of `get_or_create`.
+
+        :param items: Sequence of dicts of params, each is processed like
+            params of `get_or_create` and may contain its own `defaults`.
+        :param defaults: Defaults common to all the items.
+
+        Existing documents are loaded with a single query, and missing
+        ones are validated and upserted with a single unordered bulk
+        write. Raises JHTTPBadRequest when more than one document matches
+        params of an item.
+
+        Returns a list of (document, created) tuples in order of :items:.
+        """
+        prepared = []
+        for params in items:
+            params = params.copy()
+            item_defaults = dict(defaults or {})
+            item_defaults.update(params.pop('defaults', {}))
+            prepared.append((params, item_defaults))
+        if not prepared:
+            return []
+
+        collection = cls._get_collection()
+        queries = [cls._get_upsert_query(params) for params, _ in prepared]
+        keys = [_query_key(query) for query in queries]
+        documents, ambiguous = _index_by_queries(
+            collection.find({'$or': queries}), queries)
+        for key, query in zip(keys, queries):
+            if key in ambiguous or (
+                    key is None and
+                    cls._is_ambiguous_query(collection, query)):
+                raise JHTTPBadRequest('Bad or Insufficient Params')
+
+        missing = [index for index, key in enumerate(keys)
+                   if key is None or key not in documents]
+        new_documents = {}
+        created_indexes = set()
+        if missing:
+            bulk = collection.initialize_unordered_bulk_op()
+            for index in missing:
+                params, item_defaults = prepared[index]
+                update, new_documents[index] = cls._get_upsert_operation(
+                    queries[index], params, item_defaults)
+                bulk.find(queries[index]).upsert().update_one(update)
+            try:
+                result = bulk.execute()
+            except BulkWriteError as e:
+                # Duplicates are caused by concurrent upserts of the same
+                # documents, which means documents exist
+                result = e.details
+                errors = [err for err in result.get('writeErrors', [])
+                          if err.get('code') not in (11000, 11001)]
+                if errors:
+                    raise JHTTPBadRequest(
+                        detail='Failed to upsert `{}` documents'.format(
+                            cls.__name__),
+                        extra={'data': e})
+            created_indexes = set(
+                missing[upserted['index']]
+                for upserted in result.get('upserted', []))
+            missing_queries = [queries[index] for index in missing]
+            upserted, _ = _index_by_queries(
+                collection.find({'$or': missing_queries}), missing_queries)
+            documents.update(upserted)
+
+        results = []
+        for index, query in enumerate(queries):
+            key = keys[index]
+            son = documents.get(key) if key is not None else None
+            if son is None:
+                son = collection.find_one(query)
+            if son is None:
+                # Upsert conflicted with a document that doesn't match
+                # the query (e.g. on another unique field)
+                raise JHTTPConflict(
+                    detail='Resource `{}` already exists.'.format(
+                        cls.__name__))
+            obj = cls._from_son(son)
+            created = index in created_indexes
+            if created:
+                cls._on_upsert_created(new_documents[index], obj)
+            results.append((obj, created))
+        return results
+
+    @classmethod
+    def _is_ambiguous_query(cls, collection, query):
+        """ Check whether more than one document matches :query:. """
+        return collection.find(query).limit(2).count(True) > 1
+
+    @classmethod
+    def _get_upsert_query(cls, params):
+        """ Get query matching documents of get-or-create :params:. """
+        return cls.objects(**params)._query
+
+    @classmethod
+    def _get_upsert_operation(cls, query, params, defaults):
+        """ Get (update, document) of upsert of :params: by :query:.
+
+        `document` is a new instance built from :params: and :defaults:,
+        validated like `save` does, with `pre_save` and
+        `pre_save_post_validation` signals sent. `update` `$setOnInsert`s
+        all its values not present in `query`.
+        """
+        values = dict(defaults)
+        values.update(params)
+        document = cls(**values)
+        mongo.signals.pre_save.send(cls, document=document)
+        document.validate()
+        insert = {key: val for key, val in document.to_mongo().items()
+                  if key not in query}
+        if '_id' not in query and insert.get('_id') is None:
+            insert['_id'] = ObjectId()
+        if not insert:
+            insert = {'_id': query['_id']}
+        mongo.signals.pre_save_post_validation.send(
+            cls, document=document, created=True)
+        return {'$setOnInsert': insert}, document
+
+    @classmethod
+    def _on_upsert_created(cls, document, obj):
+        """ Run post-save actions for :obj: created by upsert.
+
+        :document: is the instance built from upsert params, which holds
+        backref hooks.
+        """
+        for hook in document._backref_hooks:
+            hook(document=obj)
+        document._backref_hooks = ()
+        mongo.signals.post_save.send(cls, document=obj, created=True)
 
     def _update(self, params, **kw):
         process_bools(params)
@@ -391,14 +1119,24 @@ class BaseMixin(object):
             if isinstance(v, (DictField, ListField)) and
             not isinstance(v, RelationshipField))
         pk_field = self.pk_field()
+        atomic = self._use_atomic_updates(self._atomic_iterables)
+        atomic_updated = False
         for key, value in params.items():
             if key == pk_field:  # can't change the primary key
                 continue
             if key in iter_fields:
-                self.update_iterables(value, key, unique=True, save=False)
+                self.update_iterables(
+                    value, key, unique=True, save=False, atomic=atomic)
+                atomic_updated = atomic
             else:
                 setattr(self, key, value)
-        return self.save(**kw)
+        # When nothing else is changed, `post_save` won't reindex the
+        # document changed by atomic updates
+        reindex = atomic_updated and not self._get_changed_fields()
+        self.save(**kw)
+        if reindex:
+            on_bulk_update(type(self), [self], kw.get('request'))
+        return self
 
     @classmethod
     def _delete_many(cls, items, request=None):
@@ -419,7 +1157,22 @@ class BaseMixin(object):
         trigger any signals on QuerySet.update() call.
         """
         if isinstance(items, mongo.queryset.queryset.QuerySet):
-            items.update(**params)
+            normalized, unset = cls._get_normalized_values(params)
+            if normalized or unset:
+                # Shadow values are changed by the same update, so they
+                # are updated in all the matched documents atomically
+                update = transform.update(cls, **params)
+                if normalized:
+                    update.setdefault('$set', {}).update(normalized)
+                if unset:
+                    update.setdefault('$unset', {}).update(unset)
+                items.update(__raw__=update)
+            else:
+                items.update(**params)
+            # Mapped documents of the model may be stale now
+            identity_map = get_identity_map()
+            if identity_map is not None:
+                identity_map.discard_model(cls)
             on_bulk_update(cls, items, request)
             return cls.count(items)
         items_count = len(items)
@@ -427,6 +1180,32 @@ class BaseMixin(object):
             item.update(params, request)
         return items_count
 
+    @classmethod
+    def _get_normalized_values(cls, params):
+        """ Get shadow values of case-insensitive fields changed by
+        :params: of `_update_many`.
+
+        Returns a tuple of (set, unset) dicts of shadow fields. Shadow
+        values of fields which are unset or set to None are unset.
+        """
+        normalized = {}
+        unset = {}
+        for key, value in params.items():
+            parts = key.split('__')
+            if len(parts) == 1:
+                parts.insert(0, 'set')
+            if len(parts) != 2 or parts[0] not in ('set', 'unset'):
+                continue
+            op, name = parts
+            field = cls._fields.get(name)
+            if not getattr(field, 'case_insensitive', False):
+                continue
+            if op == 'set' and value is not None:
+                normalized[field.shadow_field] = normalize_case(value)
+            else:
+                unset[field.shadow_field] = 1
+        return normalized, unset
+
     def __repr__(self):
         parts = ['%s:' % self.__class__.__name__]
 
@@ -435,12 +1214,114 @@ class BaseMixin(object):
         return '<%s>' % ', '.join(parts)
 
     @classmethod
-    def get_by_ids(cls, ids, **params):
+    def get_by_ids(cls, ids, _keep_order=False, **params):
+        """ Get documents with primary keys in :ids:.
+
+        Query set returned by `get_collection` is returned unless
+        :_keep_order: is True and no '_sort' is given.
+
+        Otherwise documents are loaded in chunks by `iter_by_ids` and
+        DocumentsList of documents in order of :ids: is returned.
+        '_limit', '_page' and '_start' are applied while documents are
+        loaded, so only documents of the requested page are kept.
+        `_nefertari_meta` of the list includes 'missing' ids which were
+        not found.
+        """
+        ids = list(ids)
         pk_field = '{}__in'.format(cls.pk_field())
-        params.update({
-            pk_field: ids,
-        })
-        return cls.get_collection(**params)
+        if not _keep_order or params.get('_sort'):
+            params[pk_field] = ids
+            return cls.get_collection(**params)
+
+        _limit = params.pop('_limit', None)
+        _page = params.pop('_page', None)
+        _start = params.pop('_start', None)
+        _raise_on_empty = params.pop('_raise_on_empty', False)
+        if '_count' in params:
+            return sum(
+                cls.get_collection(**dict(params, **{pk_field: chunk}))
+                for chunk in chunk_ids(ids, cls._ids_chunk_size))
+        if _limit is not None:
+            _start, _limit = process_limit(_start, _page, _limit)
+
+        missing = []
+        documents = []
+        _total = 0
+        for document in cls.iter_by_ids(
+                ids, keep_order=True, missing=missing, **params):
+            if _limit is None or _start <= _total < _start + _limit:
+                documents.append(document)
+            _total += 1
+
+        if not documents:
+            msg = "'%s(%s)' resource not found" % (cls.__name__, params)
+            if _raise_on_empty:
+                raise JHTTPNotFound(msg)
+            log.debug(msg)
+
+        documents = DocumentsList(documents)
+        documents._nefertari_meta = dict(
+            total=_total,
+            start=_start,
+            fields=_split(params.get('_fields', [])),
+            missing=missing)
+        return documents
+
+    @classmethod
+    def iter_by_ids(cls, ids, chunk_size=None, keep_order=False,
+                    missing=None, **params):
+        """ Iterate over documents with primary keys in :ids:.
+
+        Duplicate ids are dropped and the rest are queried in chunks of
+        :chunk_size: ids, which defaults to `_ids_chunk_size`. Query sets
+        of chunks are built and documents are loaded in the calling
+        thread, and only results of the next chunk are fetched in
+        background while documents of the current chunk are consumed, so
+        at most two chunks are held in memory.
+
+        Arguments:
+            :keep_order: Yield documents in order of :ids:.
+            :missing: Optional list to which ids of documents that were
+                not found or didn't match :params: are appended.
+            :params: Query params passed to `get_collection`.
+        """
+        chunk_size = chunk_size or cls._ids_chunk_size
+        pk_field = '{}__in'.format(cls.pk_field())
+
+        def queries():
+            for chunk in chunk_ids(ids, chunk_size):
+                query_params = dict(params, _query_only=True)
+                query_params[pk_field] = chunk
+                yield chunk, cls.get_collection(**query_params)
+
+        def fetch(query):
+            chunk, query_set = query
+            try:
+                sons = list(query_set._cursor)
+            except mongo.ValidationError as ex:
+                raise JHTTPBadRequest(str(ex), extra={'data': ex})
+            except ExecutionTimeout as ex:
+                query_limits.raise_timeout(cls, ex)
+            return chunk, sons, query_set.only_fields
+
+        for chunk, sons, only_fields in iter_prefetched(fetch, queries()):
+            documents = [
+                cls._from_son(son, only_fields=only_fields)
+                for son in sons]
+            if keep_order or missing is not None:
+                positions = {
+                    six.text_type(id_): index
+                    for index, id_ in enumerate(chunk)}
+            if keep_order:
+                documents.sort(
+                    key=lambda doc: positions[six.text_type(doc.pk)])
+            if missing is not None:
+                for doc in documents:
+                    positions.pop(six.text_type(doc.pk), None)
+                missing.extend(
+                    id_ for id_ in chunk if six.text_type(id_) in positions)
+            for document in documents:
+                yield document
 
     @classmethod
     def get_null_values(cls):
@@ -489,6 +1370,8 @@ class BaseMixin(object):
             _data[field] = value
         _data['_type'] = self._type
         _data['_pk'] = str(getattr(self, self.pk_field()))
+        if self._data.get('_text_score') is not None:
+            _data['_score'] = self._data['_text_score']
         return _data
 
     def get_related_documents(self, nested_only=False):
@@ -523,7 +1406,26 @@ class BaseMixin(object):
 
     def update_iterables(self, params, attr, unique=False,
                          value_type=None, save=True,
-                         request=None):
+                         request=None, atomic=None):
+        """ Update DictField/ListField :attr: using :params:.
+
+        Keys of :params: prefixed with '-' are removed from the field,
+        other keys are added to it.
+
+        When :atomic: is True (defaults to `self._atomic_iterables`), the
+        changes are translated into `$set`/`$unset` (dicts) and
+        `$push`/`$addToSet`/`$pull` (lists) operators that are applied
+        server-side to the field's paths instead of rewriting the whole
+        field. The field's value of the instance is then updated from the
+        value returned by mongo. Atomic mode is only used for documents
+        that already exist in the database and outside of units of work.
+        Items are validated before operators are built. When :save: is
+        False, operators are applied by the next `save` after the document
+        is validated.
+        """
+        if atomic is None:
+            atomic = self._atomic_iterables
+        atomic = self._use_atomic_updates(atomic)
         is_dict = isinstance(type(self)._fields[attr], mongo.DictField)
         is_list = isinstance(type(self)._fields[attr], mongo.ListField)
 
@@ -550,6 +1452,11 @@ class BaseMixin(object):
                     '-' + key: val for key, val in final_value.items()}
             positive, negative = split_keys(list(update_params.keys()))
 
+            if atomic:
+                operations = self._dict_update_operations(
+                    attr, positive, negative, update_params)
+                return self._atomic_update(attr, operations, save, request)
+
             # Pop negative keys
             for key in negative:
                 final_value.pop(key, None)
@@ -579,13 +1486,18 @@ class BaseMixin(object):
             if not (positive + negative):
                 raise JHTTPBadRequest('Missing params')
 
+            if atomic:
+                operations = self._list_update_operations(
+                    attr, positive, negative, unique)
+                return self._atomic_update(attr, operations, save, request)
+
             if positive:
                 if unique:
                     positive = [v for v in positive if v not in final_value]
                 final_value += positive
 
             if negative:
-                final_value = list(set(final_value) - set(negative))
+                final_value = [v for v in final_value if v not in negative]
 
             setattr(self, attr, final_value)
             if save:
@@ -597,32 +1509,310 @@ class BaseMixin(object):
         elif is_list:
             update_list(params)
 
+    def _use_atomic_updates(self, atomic):
+        """ Check whether iterables may be updated with atomic operators.
+
+        Units of work write whole changed fields when they are flushed,
+        thus atomic updates, which are written immediately, aren't used
+        within them.
+        """
+        return bool(atomic) and not self._created and (
+            get_unit_of_work() is None)
+
+    def _validate_field_value(self, attr, value):
+        """ Validate :value: of :attr: field. Raises JHTTPBadRequest. """
+        try:
+            self._fields[attr].validate(value)
+        except mongo.ValidationError as e:
+            raise JHTTPBadRequest(
+                'Resource `%s`: %s' % (self.__class__.__name__, e),
+                extra={'data': e})
+
+    def _dict_update_operations(self, attr, positive, negative, params):
+        """ Translate dict update keys to a list of mongo update documents.
+
+        Returns a list with a single update that `$set`s positive keys and
+        `$unset`s negative keys at the `<field>.<key>` paths. Keys and
+        values are validated, and values are converted by the field.
+        """
+        field = self._fields[attr]
+        for key in positive + negative:
+            # Such keys would be treated as paths or operators
+            if '.' in key or '$' in key:
+                raise JHTTPBadRequest(
+                    'Invalid key of `{}`: {}'.format(attr, key))
+        values = {str(key): params[key] for key in positive}
+        self._validate_field_value(attr, values)
+        values = field.to_mongo(values)
+        update = {}
+        for key in negative:
+            if key in positive:
+                continue
+            update.setdefault('$unset', {})[
+                '%s.%s' % (field.db_field, key)] = ''
+        for key in positive:
+            update.setdefault('$set', {})[
+                '%s.%s' % (field.db_field, key)] = values[str(key)]
+        return [update]
+
+    def _list_update_operations(self, attr, positive, negative, unique):
+        """ Translate list update keys to a list of mongo update documents.
+
+        Mongo does not allow updating the same path with more than one
+        operator at once. Thus additions and removals are performed as two
+        consecutive updates, which keeps the semantics of the non-atomic
+        update: values present in both :positive: and :negative: are
+        removed. Added values are validated by the field.
+        """
+        field = self._fields[attr]
+        if positive:
+            self._validate_field_value(attr, positive)
+        item_field = getattr(field, 'field', None)
+        if item_field is not None:
+            positive = [item_field.to_mongo(val) for val in positive]
+            negative = [item_field.to_mongo(val) for val in negative]
+
+        operations = []
+        if positive:
+            operator = '$addToSet' if unique else '$push'
+            operations.append(
+                {operator: {field.db_field: {'$each': positive}}})
+        if negative:
+            operations.append(
+                {'$pull': {field.db_field: {'$in': negative}}})
+        return operations
+
+    def _atomic_update(self, attr, operations, save=True, request=None):
+        """ Apply atomic :operations: of :attr: now when :save: is True or
+        defer them to the next `save`.
+        """
+        if save:
+            return self._apply_atomic_update(attr, operations, save, request)
+        self._pending_updates = list(self._pending_updates) + [
+            (attr, operations)]
+
+    def _apply_pending_updates(self, kw):
+        """ Validate document and apply atomic updates deferred by
+        `update_iterables`, so they are only written for valid documents.
+
+        :kw: are `save` keyword arguments. Validation is not repeated by
+        the save.
+        """
+        if kw.get('validate', True):
+            self.validate(clean=kw.get('clean', True))
+            kw['validate'] = False
+        pending, self._pending_updates = self._pending_updates, ()
+        for attr, operations in pending:
+            self._apply_atomic_update(attr, operations, save=False)
+
+    def _apply_atomic_update(self, attr, operations, save=True,
+                             request=None):
+        """ Apply mongo :operations: to the document's :attr: field.
+
+        Each operation is applied using `findAndModify` and the value of
+        the field returned by the last one is set to the instance, so
+        the instance reflects the state of the document in the database.
+
+        When :save: is True, ES index of the document is updated like it
+        is done after a `save()`.
+        """
+        field = self._fields[attr]
+        collection = self._get_collection()
+        pk_field = self._fields[self.pk_field()]
+        query = {'_id': pk_field.to_mongo(self.pk)}
+        result = None
+        for update in operations:
+            result = collection.find_and_modify(
+                query=query, update=update, new=True,
+                fields={field.db_field: True})
+            if result is None:
+                raise JHTTPNotFound("'%s(%s)' resource not found" % (
+                    self.__class__.__name__, self.pk))
+        if result is None:
+            return
+
+        value = result.get(field.db_field)
+        if value is not None:
+            value = field.to_python(value)
+        self._data[attr] = value
+        if save:
+            on_bulk_update(type(self), [self], request)
+
+    def _update_counted_relationship(self, attr, document, add=True,
+                                     request=None):
+        """ Add :document: to (or remove it from) RelationshipField
+        :attr: with a counter.
+
+        Performed by a single atomic update which only matches when
+        :document: is not related yet (or is related), so the counter is
+        only changed when the relationship is.
+        """
+        field = self._fields[attr]
+        counter = self._fields[field.counter]
+        pk_field = self._fields[self.pk_field()]
+        ref = field.field.to_mongo(document)
+        query = {'_id': pk_field.to_mongo(self.pk)}
+        if add:
+            query[field.db_field] = {'$ne': ref}
+            update = {'$push': {field.db_field: ref},
+                      '$inc': {counter.db_field: 1}}
+        else:
+            query[field.db_field] = ref
+            update = {'$pull': {field.db_field: ref},
+                      '$inc': {counter.db_field: -1}}
+        result = self._get_collection().find_and_modify(
+            query=query, update=update, new=True,
+            fields={field.db_field: True, counter.db_field: True})
+        if result is None:
+            return
+        self._data[attr] = field.to_python(result.get(field.db_field) or [])
+        self._data[field.counter] = result.get(counter.db_field)
+        on_bulk_update(type(self), [self], request)
+
+    @classmethod
+    def _remove_from_counted_relationships(cls, documents, request=None):
+        """ Remove :documents: which are deleted from RelationshipFields
+        with counters and decrement the counters.
+
+        Each document is removed with an update which only matches
+        documents relating it, so counters stay exact. Updates of each
+        model are sent in a single bulk write.
+        """
+        for model, attr in get_counted_relationships(cls):
+            field = model._fields[attr]
+            counter = model._fields[field.counter]
+            refs = [field.field.to_mongo(document) for document in documents]
+            collection = model._get_collection()
+            related = [son['_id'] for son in collection.find(
+                {field.db_field: {'$in': refs}}, {'_id': True})]
+            if not related:
+                continue
+            bulk = collection.initialize_unordered_bulk_op()
+            for ref in refs:
+                bulk.find({field.db_field: ref}).update({
+                    '$pull': {field.db_field: ref},
+                    '$inc': {counter.db_field: -1}})
+            bulk.execute()
+            # Mapped documents of the model may be stale now
+            identity_map = get_identity_map()
+            if identity_map is not None:
+                identity_map.discard_model(model)
+            on_bulk_update(model, model.objects(pk__in=related), request)
+
     @classmethod
     def expand_with(cls, with_cls, join_on=None, attr_name=None, params={},
                     with_params={}):
         """ Acts like "join" and inserts the with_cls objects in
         the result as "attr_name".
+
+        The join is performed by mongo using a single aggregation with
+        a `$lookup` stage (requires MongoDB 3.2+, or 3.4+ when :join_on: is
+        a ListField). :params: filter, sort and paginate :cls: documents
+        like in `get_collection`. :with_params: filter the joined
+        :with_cls: documents: only documents which reference matching
+        documents are returned. Ids of matching documents are queried
+        first, so documents are filtered, counted and paginated before
+        they are joined. Documents which reference missing documents get
+        None (or an empty list).
+
+        Returns a list of :cls: instances with `_nefertari_meta` set.
         """
         if join_on is None:
             join_on = with_cls.__name__.lower()
         if attr_name is None:
             attr_name = with_cls.__name__.lower()
 
-        with_params.pop('_fields', [])
-        with_objs = with_cls.get_by_ids(
-            cls.objects.scalar(join_on),
-            **with_params)
-        with_objs = dict([[str(wth.id), wth] for wth in with_objs])
+        limits = dict(
+            max_time_ms=query_limits.get_max_time_ms(
+                cls, params.get('_max_time_ms')),
+            allow_disk_use=query_limits.get_allow_disk_use(
+                cls, params.get('_allow_disk_use')))
+        params = dict(params, _query_only=True)
+        with_params = dict(with_params, _query_only=True)
+        with_params.pop('_fields', None)
+        query_set = cls.get_collection(**params)
+        with_query = with_cls.get_collection(**with_params)._query
 
-        params['%s__in' % join_on] = list(with_objs.keys())
-        objs = cls.get_collection(**params)
+        join_field = cls._fields.get(join_on)
+        db_field = getattr(join_field, 'db_field', join_on)
+        is_list = isinstance(join_field, mongo.ListField)
 
-        for ob in objs:
-            ob._data[attr_name] = with_objs[getattr(ob, join_on)]
+        match = query_set._query
+        if with_query:
+            # Semi-join: only keep documents referencing matching ones
+            try:
+                with_ids = with_cls._get_collection().distinct(
+                    '_id', with_query)
+            except ExecutionTimeout as ex:
+                query_limits.raise_timeout(with_cls, ex)
+            join_match = {db_field: {'$in': with_ids}}
+            match = {'$and': [match, join_match]} if match else join_match
+
+        pipeline = []
+        if match:
+            pipeline.append({'$match': match})
+        _total = cls._aggregate_count(pipeline, **limits)
+        if query_set._ordering:
+            pipeline.append({'$sort': SON(query_set._ordering)})
+        if query_set._skip:
+            pipeline.append({'$skip': query_set._skip})
+        if query_set._limit is not None:
+            pipeline.append({'$limit': query_set._limit})
+
+        pipeline.append({'$lookup': {
+            'from': with_cls._get_collection_name(),
+            'localField': db_field,
+            'foreignField': '_id',
+            'as': attr_name,
+        }})
+        if not is_list:
+            pipeline.append({'$unwind': {
+                'path': '$' + attr_name,
+                'preserveNullAndEmptyArrays': True,
+            }})
+
+        only_fields = []
+        projection = query_set._loaded_fields.as_dict()
+        if projection:
+            if 1 in projection.values():
+                projection[attr_name] = 1
+            pipeline.append({'$project': projection})
+            only_fields = _projected_fields(cls, projection)
+
+        objs = DocumentsList()
+        for son in cls._aggregate(pipeline, **limits):
+            joined = son.pop(attr_name, None)
+            if is_list:
+                joined = [with_cls._from_son(val) for val in joined or []]
+            elif joined is not None:
+                joined = with_cls._from_son(joined)
+            ob = cls._from_son(son, only_fields=only_fields)
+            ob._data[attr_name] = joined
             setattr(ob, attr_name, ob._data[attr_name])
+            objs.append(ob)
 
+        objs._nefertari_meta = dict(
+            total=_total,
+            start=query_set._skip or 0,
+            fields=_split(params.get('_fields', [])))
         return objs
 
+    @classmethod
+    def _aggregate(cls, pipeline, max_time_ms=None, allow_disk_use=False):
+        """ Run aggregation :pipeline: on the collection of :cls:. """
+        options = query_limits.aggregate_options(max_time_ms, allow_disk_use)
+        return cls._get_collection().aggregate(
+            pipeline, cursor={}, **options)
+
+    @classmethod
+    def _aggregate_count(cls, pipeline, **limits):
+        """ Count documents returned by aggregation :pipeline:. """
+        pipeline = pipeline + [
+            {'$group': {'_id': None, 'count': {'$sum': 1}}}]
+        for result in cls._aggregate(pipeline, **limits):
+            return result['count']
+        return 0
+
     def _is_modified(self):
         """ Determine if instance is modified.
 
@@ -672,14 +1862,218 @@ class BaseDocument(six.with_metaclass(DocumentMetaclass,
         """
         _created = values.get('_created')
         if _created is not None and not _created:
-            internal_fields = [
-                'id', 'pk', '_cls', '_text_score',
-                '__auto_convert', '__only_fields', '_created',
-            ]
-            valid_fields = list(self._fields.keys()) + internal_fields
+            valid_keys = self._get_init_keys()
             values = {key: val for key, val in values.items()
-                      if key in valid_fields}
+                      if key in valid_keys}
         super(BaseDocument, self).__init__(*args, **values)
+        if _created is None or _created:
+            for name, counter in self._get_counters():
+                self._data[counter] = len(self._data.get(name) or [])
+
+    @classmethod
+    def _from_son(cls, son, _auto_dereference=True, only_fields=None,
+                  created=False):
+        """ Load document from :son: using current identity map.
+
+        When identity map is active and a document with the same primary
+        key is already loaded, the loaded document is returned with its
+        unchanged fields refreshed from :son:. Documents loaded with only
+        some of the fields are not mapped.
+
+        Values of fields with lazy decoding are wrapped in `LazyValue` and
+        decoded on first access.
+        """
+        only_fields = only_fields or []
+        identity_map = get_identity_map()
+        mapped = (identity_map is not None and not only_fields and
+                  '_id' in son)
+        lazy_fields = [name for name in cls._get_lazy_db_fields()
+                       if son.get(name) is not None]
+        if lazy_fields:
+            son = dict(son)
+            for name in lazy_fields:
+                son[name] = LazyValue(son[name])
+        document = cls._hydrate(
+            son, _auto_dereference=_auto_dereference,
+            only_fields=only_fields, created=created)
+        if mapped:
+            document = identity_map.add(document)
+        return document
+
+    @classmethod
+    def _hydrate(cls, son, _auto_dereference=True, only_fields=(),
+                 created=False):
+        """ Create document from :son: loaded from the database.
+
+        Does the same as mongoengine `_from_son`, but values which are
+        already in the form returned by `to_python` of their fields are
+        not converted, and fields are looked up in a precomputed plan.
+        Documents of other classes (with `_cls`) are left to mongoengine.
+
+        Mirrors `_from_son` of mongoengine 0.9, which is checked by
+        `test_hydrate_matches_mongoengine`; re-check it when upgrading
+        mongoengine.
+        """
+        if son.get('_cls', cls._class_name) != cls._class_name:
+            return super(BaseDocument, cls)._from_son(
+                son, _auto_dereference=_auto_dereference,
+                only_fields=only_fields, created=created)
+        fields, db_fields = cls._get_hydration_plan()
+        data = {}
+        changed_fields = []
+        errors = {}
+        for name, db_field, field, stored_types in fields:
+            field._auto_dereference = _auto_dereference
+            if db_field in son:
+                value = son[db_field]
+                if value is None or type(value) in stored_types:
+                    data[name] = value
+                    continue
+                try:
+                    data[name] = field.to_python(value)
+                except (AttributeError, ValueError) as ex:
+                    errors[name] = ex
+            elif field.default:
+                default = field.default
+                if callable(default):
+                    default = default()
+                if isinstance(default, mongo.base.BaseDocument):
+                    changed_fields.append(name)
+
+        if errors:
+            errors = '\n'.join(
+                '%s - %s' % (key, val) for key, val in errors.items())
+            raise mongo.errors.InvalidDocumentError(
+                'Invalid data to create a `%s` instance.\n%s' % (
+                    cls._class_name, errors))
+        if not cls.STRICT:
+            init_keys = cls._get_init_keys()
+            for key, value in son.items():
+                if (key not in data and key not in db_fields and
+                        key in init_keys):
+                    data[key] = value
+
+        document = cls(__auto_convert=False, _created=created,
+                       __only_fields=only_fields, **data)
+        document._changed_fields = changed_fields
+        if not _auto_dereference:
+            document._fields = copy.copy(cls._fields)
+        return document
+
+    @classmethod
+    def _get_hydration_plan(cls):
+        """ Get fields used by `_hydrate`.
+
+        Returns tuple of (name, db_field, field, stored types) of each
+        field and a frozenset of db fields.
+        """
+        if '_hydration_plan' not in cls.__dict__:
+            fields = tuple(
+                (name, field.db_field, field, get_stored_types(field))
+                for name, field in cls._fields.items())
+            cls._hydration_plan = (
+                fields, frozenset(field[1] for field in fields))
+        return cls._hydration_plan
+
+    @classmethod
+    def _get_init_keys(cls):
+        """ Get frozenset of keys accepted by init of loaded documents. """
+        if '_init_keys' not in cls.__dict__:
+            cls._init_keys = frozenset(cls._fields).union(
+                INTERNAL_INIT_KEYS)
+        return cls._init_keys
+
+    @classmethod
+    def _reset_fields_cache(cls):
+        """ Drop values cached from `_fields` after fields are added. """
+        names = ('_lazy_db_fields', '_hydration_plan', '_init_keys',
+                 '_case_insensitive_fields', '_counters')
+        for name in names:
+            if name in cls.__dict__:
+                delattr(cls, name)
+
+    @classmethod
+    def _get_lazy_db_fields(cls):
+        """ Get db names of fields with lazy decoding. """
+        if '_lazy_db_fields' not in cls.__dict__:
+            cls._lazy_db_fields = [
+                field.db_field for field in cls._fields.values()
+                if getattr(field, '_lazy_decode', False)]
+        return cls._lazy_db_fields
+
+    @classmethod
+    def _get_case_insensitive_fields(cls):
+        """ Get (name, shadow field) of case-insensitive fields. """
+        if '_case_insensitive_fields' not in cls.__dict__:
+            cls._case_insensitive_fields = [
+                (name, field.shadow_field)
+                for name, field in cls._fields.items()
+                if getattr(field, 'case_insensitive', False)]
+        return cls._case_insensitive_fields
+
+    @classmethod
+    def backfill_case_insensitive_fields(cls, chunk_size=1000):
+        """ Store shadow values of case-insensitive fields in documents
+        which don't have them, e.g. documents saved before a field was
+        changed to `CaseInsensitiveStringField`.
+
+        Collection is accessed without creating indexes, so unique shadow
+        indexes may be created after documents are backfilled. Updates are
+        sent in bulk writes of at most :chunk_size: documents.
+
+        Returns number of updated documents.
+        """
+        fields = [
+            (cls._fields[name].db_field, shadow_field)
+            for name, shadow_field in cls._get_case_insensitive_fields()]
+        if not fields:
+            return 0
+        collection = cls._get_db()[cls._get_collection_name()]
+        query = {'$or': [
+            {db_field: {'$type': 2}, shadow_field: {'$exists': False}}
+            for db_field, shadow_field in fields]}
+        projection = dict.fromkeys(
+            [db_field for db_field, _ in fields], True)
+        updated = 0
+        bulk, pending = None, 0
+        for son in collection.find(query, projection):
+            values = {
+                shadow_field: normalize_case(son[db_field])
+                for db_field, shadow_field in fields
+                if isinstance(son.get(db_field), six.string_types)}
+            if not values:
+                continue
+            if bulk is None:
+                bulk = collection.initialize_unordered_bulk_op()
+            bulk.find({'_id': son['_id']}).update_one({'$set': values})
+            pending += 1
+            if pending >= chunk_size:
+                bulk.execute()
+                updated += pending
+                bulk, pending = None, 0
+        if bulk is not None:
+            bulk.execute()
+            updated += pending
+        return updated
+
+    @classmethod
+    def _get_counters(cls):
+        """ Get (name, counter name) of RelationshipFields with counters.
+        """
+        if '_counters' not in cls.__dict__:
+            cls._counters = [
+                (name, field.counter) for name, field in cls._fields.items()
+                if isinstance(field, RelationshipField) and field.counter]
+        return cls._counters
+
+    def to_mongo(self, *args, **kwargs):
+        """ Add normalized values of case-insensitive fields. """
+        son = super(BaseDocument, self).to_mongo(*args, **kwargs)
+        for name, shadow_field in self._get_case_insensitive_fields():
+            value = self._data.get(name)
+            if value is not None:
+                son[shadow_field] = normalize_case(value)
+        return son
 
     def save(self, request=None, *arg, **kw):
         """
@@ -687,9 +2081,23 @@ class BaseDocument(six.with_metaclass(DocumentMetaclass,
         respected.
         This makes each POST to a collection act as a 'create' operation
         (as opposed to an 'update' for example).
+
+        Within a unit of work, document is validated and marked as dirty
+        instead (see `nefertari_mongodb.unit_of_work`).
         """
         kw['force_insert'] = self._created
         self._request = request
+        validate_changed = kw.pop('validate_changed', False)
+        if validate_changed and not self._created:
+            self.validate_changed()
+            kw['validate'] = False
+        unit = get_unit_of_work()
+        if unit is not None:
+            return self._save_later(
+                unit, validate=kw.get('validate', True),
+                clean=kw.get('clean', True))
+        if self._pending_updates:
+            self._apply_pending_updates(kw)
         try:
             super(BaseDocument, self).save(*arg, **kw)
         except (mongo.NotUniqueError, mongo.OperationError) as e:
@@ -706,6 +2114,31 @@ class BaseDocument(six.with_metaclass(DocumentMetaclass,
             self._backref_hooks = ()
             return self
 
+    def _save_later(self, unit, validate=True, clean=True):
+        """ Validate document and mark it as dirty in :unit: of work.
+
+        New documents with ObjectId primary keys get their keys, so they
+        can be referenced before they are written.
+        """
+        cls = type(self)
+        mongo.signals.pre_save.send(cls, document=self)
+        if validate:
+            self.validate(clean=clean)
+        pk_field = self._fields[self.pk_field()]
+        if self.pk is None and isinstance(pk_field, mongo.ObjectIdField):
+            self.pk = ObjectId()
+        mongo.signals.pre_save_post_validation.send(
+            cls, document=self, created=self._created)
+        unit.add(self)
+        return self
+
+    def reload(self, *fields, **kwargs):
+        """ Reload document bypassing identity map, which would return
+        this document instead of loading it.
+        """
+        with active_identity_map(None):
+            return super(BaseDocument, self).reload(*fields, **kwargs)
+
     def run_backref_hooks(self):
         """ Runs post-save backref hooks.
 
@@ -717,6 +2150,7 @@ class BaseDocument(six.with_metaclass(DocumentMetaclass,
 
     def update(self, params, request=None, **kw):
         kw['request'] = request
+        kw.setdefault('validate_changed', self._validate_changed_only)
         # request are passed to _update and then to save
         try:
             self._update(params, **kw)
@@ -740,9 +2174,88 @@ class BaseDocument(six.with_metaclass(DocumentMetaclass,
                 'Resource `%s`: %s' % (self.__class__.__name__, e),
                 extra={'data': e})
 
+    def validate_changed(self, clean=True):
+        """ Validate only fields changed since document was loaded.
+
+        Works like `validate` but skips unchanged fields. When only some
+        items of a ListField were changed (e.g. `doc.tags[3] = 'foo'`),
+        only these items are validated.
+        """
+        errors = {}
+        if clean:
+            try:
+                self.clean()
+            except mongo.ValidationError as e:
+                errors[NON_FIELD_ERRORS] = e
+
+        for name, indexes in self._get_changed_field_items().items():
+            field = self._fields[name]
+            value = self._data.get(name)
+            try:
+                if value is None:
+                    if field.required:
+                        raise mongo.ValidationError(
+                            'Field is required', field_name=name)
+                elif indexes is None:
+                    field._validate(value)
+                else:
+                    for index in indexes:
+                        if index < len(value):
+                            field.field._validate(value[index])
+            except mongo.ValidationError as e:
+                errors[name] = e.errors or e
+            except (ValueError, AttributeError, AssertionError) as e:
+                errors[name] = e
+
+        if errors:
+            e = mongo.ValidationError(
+                'ValidationError (%s:%s) ' % (self._class_name, self.pk),
+                errors=errors)
+            raise JHTTPBadRequest(
+                'Resource `%s`: %s' % (self.__class__.__name__, e),
+                extra={'data': e})
+
+    def _get_changed_field_items(self):
+        """ Get changed fields of the document.
+
+        Returns a dict of {field_name: indexes}, where indexes is a set of
+        changed item indexes of a ListField or None if the whole field
+        should be validated.
+        """
+        changed = {}
+        for path in self._get_changed_fields():
+            parts = path.split('.')
+            name = self._reverse_db_field_map.get(parts[0], parts[0])
+            field = self._fields.get(name)
+            if field is None:
+                continue
+            indexes = changed.get(name, set())
+            if indexes is None:
+                continue
+            item_changed = (
+                len(parts) > 1 and parts[1].isdigit() and
+                isinstance(field, mongo.ListField) and
+                getattr(field, 'field', None) is not None and
+                not getattr(field, 'list_choices', None))
+            if item_changed:
+                indexes.add(int(parts[1]))
+                changed[name] = indexes
+            else:
+                changed[name] = None
+        return changed
+
     def delete(self, request=None, **kw):
         self._request = request
+        unit = get_unit_of_work()
+        if unit is not None:
+            mongo.signals.pre_delete.send(type(self), document=self)
+            unit.remove(self)
+            return
+        type(self)._remove_from_counted_relationships([self], request)
         super(BaseDocument, self).delete(**kw)
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.discard(self)
 
     @classmethod
     def get_field_params(cls, field_name):
@@ -758,7 +2271,13 @@ class BaseDocument(six.with_metaclass(DocumentMetaclass,
 
 
 class ESBaseDocument(six.with_metaclass(ESMetaclass, BaseDocument)):
-    """ Base for document classes which should be indexed by ES. """
+    """ Base for document classes which should be indexed by ES.
+
+    Indexing may be disabled for a model by setting `_index_enabled` to
+    False in its class body, which is inherited by its subclasses. Such
+    models may use MongoDB text search instead (see
+    `BaseMixin.apply_text_search`).
+    """
     meta = {
         'abstract': True,
     }
@@ -1,12 +1,59 @@
 import datetime
 import pickle
+import re
 from functools import partial
 
 import six
 import dateutil.parser
+import dateutil.tz
 import mongoengine as mongo
 from mongoengine import fields
 from mongoengine.queryset import DO_NOTHING, NULLIFY, CASCADE, DENY, PULL
+from bson import DBRef
+
+from .identity_map import get_identity_map
+
+
+_ISO_DATETIME_RE = re.compile(
+    r'([0-9]{4})-([0-9]{2})-([0-9]{2})'
+    r'(?:T([0-9]{2}):([0-9]{2}):([0-9]{2})Z)?$')
+_ISO_TIME_RE = re.compile(r'([0-9]{2}):([0-9]{2}):([0-9]{2})$')
+_UTC = dateutil.tz.tzutc()
+
+
+def parse_datetime(value, **kwargs):
+    """ Parse datetime from string :value:.
+
+    Canonical ISO formats emitted by `JSONEncoderMixin` (`%Y-%m-%d` and
+    `%Y-%m-%dT%H:%M:%SZ`) are parsed with a strict fast parser. Other
+    formats are parsed with `dateutil.parser.parse` called with :kwargs:.
+    Results of both parsers are the same.
+    """
+    match = _ISO_DATETIME_RE.match(value)
+    if match is not None:
+        parts = match.groups()
+        try:
+            if parts[3] is None:
+                return datetime.datetime(*map(int, parts[:3]))
+            return datetime.datetime(*map(int, parts), tzinfo=_UTC)
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value, **kwargs)
+
+
+def parse_time(value):
+    """ Parse time from string :value:.
+
+    Canonical `%H:%M:%S` format is parsed with a strict fast parser,
+    other formats are parsed with `dateutil.parser.parse`.
+    """
+    match = _ISO_TIME_RE.match(value)
+    if match is not None:
+        try:
+            return datetime.time(*map(int, match.groups()))
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value).time()
 
 
 class BaseFieldMixin(object):
@@ -80,6 +127,36 @@ class BaseFieldMixin(object):
         return {k: v for k, v in kwargs.items() if k in valid_kwargs}
 
 
+class LazyValue(object):
+    """ Raw database value of a lazily decoded field. """
+    __slots__ = ('raw',)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+
+class LazyDecodeMixin(object):
+    """ Mixin for fields which values are expensive to decode.
+
+    When a document is loaded from the database, values of these fields
+    are kept raw (wrapped in `LazyValue`) and are decoded on first
+    attribute access. Raw values are stored back as is, unless changed.
+    """
+    _lazy_decode = True
+
+    def __get__(self, instance, owner):
+        if instance is not None:
+            value = instance._data.get(self.name)
+            if isinstance(value, LazyValue):
+                instance._data[self.name] = self.to_python(value.raw)
+        return super(LazyDecodeMixin, self).__get__(instance, owner)
+
+    def _validate(self, value, **kwargs):
+        # Raw values were valid when stored
+        if not isinstance(value, LazyValue):
+            super(LazyDecodeMixin, self)._validate(value, **kwargs)
+
+
 class IntegerField(BaseFieldMixin, fields.IntField):
     _valid_kwargs = ('min_value', 'max_value')
 
@@ -99,7 +176,7 @@ class BooleanField(BaseFieldMixin, fields.BooleanField):
     _valid_kwargs = ()
 
 
-class DateField(BaseFieldMixin, fields.DateTimeField):
+class DateField(LazyDecodeMixin, BaseFieldMixin, fields.DateTimeField):
     """ Custom field that stores `datetime.date` instances.
 
     This is basically mongoengine's `DateTimeField` which gets
@@ -113,17 +190,26 @@ class DateField(BaseFieldMixin, fields.DateTimeField):
         if not isinstance(new_value, datetime.date):
             self.error("Can't parse date `%s`" % value)
 
-    def to_python(self, *args, **kwargs):
-        value = super(DateField, self).to_python(*args, **kwargs)
+    def to_python(self, value):
+        if isinstance(value, LazyValue):
+            return value
+        value = super(DateField, self).to_python(value)
         if isinstance(value, six.string_types):
-            value = dateutil.parser.parse(value, dayfirst=False).date()
+            value = parse_datetime(value, dayfirst=False).date()
         return value
 
-    def to_mongo(self, *args, **kwargs):
+    def to_mongo(self, value):
         """ Override mongo's DateTimeField value conversion to get
         date instead of datetime.
         """
-        value = super(DateField, self).to_mongo(*args, **kwargs)
+        if isinstance(value, LazyValue):
+            return value.raw
+        if isinstance(value, six.string_types):
+            try:
+                value = parse_datetime(value)
+            except (TypeError, ValueError):
+                value = None
+        value = super(DateField, self).to_mongo(value)
         if isinstance(value, datetime.datetime):
             value = value.date()
         return value.strftime('%Y-%m-%d')
@@ -132,6 +218,15 @@ class DateField(BaseFieldMixin, fields.DateTimeField):
 class DateTimeField(BaseFieldMixin, fields.DateTimeField):
     _valid_kwargs = ()
 
+    def to_mongo(self, value):
+        """ Parse strings with a fast path for canonical ISO formats. """
+        if isinstance(value, six.string_types):
+            try:
+                return parse_datetime(value)
+            except (TypeError, ValueError):
+                return None
+        return super(DateTimeField, self).to_mongo(value)
+
 
 class FloatField(BaseFieldMixin, fields.FloatField):
     _valid_kwargs = ('min_value', 'max_value')
@@ -162,6 +257,46 @@ class UnicodeTextField(UnicodeField):
     pass
 
 
+def normalize_case(value):
+    """ Get form of string :value: used for case-insensitive matching. """
+    if not isinstance(value, six.string_types):
+        return value
+    casefold = getattr(value, 'casefold', None)
+    if casefold is not None:
+        return casefold()
+    return value.lower()
+
+
+class CaseInsensitiveStringField(StringField):
+    """ String field which is filtered case-insensitively.
+
+    Values are stored as is, and their case-normalized form is stored in
+    `shadow_field` key of documents, which is indexed (with a unique index
+    when the field is unique). Shadow values are maintained by
+    `BaseDocument.to_mongo` on save and by `_update_many`.
+
+    Equality, 'iexact', 'in', 'startswith' and 'istartswith' filters of
+    `get_collection` on the field are performed on shadow values, thus
+    they are case-insensitive and use the index.
+
+    Documents saved before a field is changed to this type have no shadow
+    values, so such filters don't match them (and a unique shadow index
+    can't be built) until they are backfilled with
+    `BaseDocument.backfill_case_insensitive_fields`.
+    """
+    case_insensitive = True
+
+    @property
+    def shadow_field(self):
+        return '_{}_normalized'.format(self.db_field)
+
+    def __set__(self, instance, value):
+        """ Mark shadow value as changed together with the value. """
+        if instance._initialised and instance._data.get(self.name) != value:
+            instance._mark_as_changed(self.shadow_field)
+        super(CaseInsensitiveStringField, self).__set__(instance, value)
+
+
 class ChoiceField(fields.BaseField):
     """
     As mongoengine does not have an explicit ChoiceField, but all mongoengine
@@ -227,7 +362,7 @@ class DecimalField(BaseFieldMixin, fields.DecimalField):
         return kwargs
 
 
-class TimeField(BaseFieldMixin, fields.BaseField):
+class TimeField(LazyDecodeMixin, BaseFieldMixin, fields.BaseField):
     """ Custom field that stores `datetime.date` instances. """
     _valid_kwargs = ()
 
@@ -237,13 +372,15 @@ class TimeField(BaseFieldMixin, fields.BaseField):
             self.error("Can't parse time `%s`" % value)
 
     def to_mongo(self, value):
+        if isinstance(value, LazyValue):
+            return value.raw
         value = super(TimeField, self).to_mongo(value)
         if not isinstance(value, six.string_types):
             value = value.strftime('%H:%M:%S')
         return value
 
     def to_python(self, value):
-        if value is None:
+        if value is None or isinstance(value, LazyValue):
             return value
         if isinstance(value, datetime.time):
             return value
@@ -256,7 +393,7 @@ class TimeField(BaseFieldMixin, fields.BaseField):
             return None
 
         try:
-            return dateutil.parser.parse(value).time()
+            return parse_time(value)
         except (TypeError, ValueError):
             return None
 
@@ -264,11 +401,11 @@ class TimeField(BaseFieldMixin, fields.BaseField):
         return self.to_mongo(value)
 
 
-class PickleField(BinaryField):
+class PickleField(LazyDecodeMixin, BinaryField):
     """ Custom field that stores pickled data as a BinaryField.
 
-    Data is pickled when saving to mongo and unpickled when retrieving
-    from mongo.
+    Data is pickled when saving to mongo and unpickled on first access
+    after retrieving from mongo.
     The `pickler` kwarg may be provided that may reference any object with
     pickle-compatible `dumps` and `loads` methods. Defaults to python's
     built-in `pickle`.
@@ -284,10 +421,14 @@ class PickleField(BinaryField):
         return super(PickleField, self).validate(value)
 
     def to_mongo(self, value):
+        if isinstance(value, LazyValue):
+            return value.raw
         value = self.pickler.dumps(value)
         return super(PickleField, self).to_mongo(value)
 
     def to_python(self, value):
+        if isinstance(value, LazyValue):
+            return value
         value = super(PickleField, self).to_python(value)
         return self.pickler.loads(value)
 
@@ -420,6 +561,22 @@ class ReferenceField(BaseFieldMixin, fields.ReferenceField):
         super(ReferenceField, self).__init__(*args, **kwargs)
         self._init_kwargs = _init_kwargs
 
+    def __get__(self, instance, owner):
+        """ Take referenced document from current identity map if it
+        is already loaded there instead of dereferencing it.
+        """
+        if instance is None:
+            return self
+        value = instance._data.get(self.name)
+        identity_map = get_identity_map()
+        auto_dereference = instance._fields[self.name]._auto_dereference
+        if (identity_map is not None and auto_dereference and
+                isinstance(value, DBRef)):
+            document = identity_map.get(self.document_type, value.id)
+            if document is not None:
+                instance._data[self.name] = document
+        return super(ReferenceField, self).__get__(instance, owner)
+
     def _register_deletion_hook(self, old_object, instance):
         """ Register a backref hook to delete the `instance` from the
         `old_object`'s field to which the `instance` was related before
@@ -434,9 +591,13 @@ class ReferenceField(BaseFieldMixin, fields.ReferenceField):
         """
         def _delete_from_old(old_obj, document, field_name):
             from mongoengine.fields import ListField
+            field_object = old_obj._fields[field_name]
+            if getattr(field_object, 'counter', None):
+                old_obj._update_counted_relationship(
+                    field_name, document, add=False)
+                return
             field_value = getattr(old_obj, field_name, None)
             if field_value:
-                field_object = old_obj._fields[field_name]
                 if isinstance(field_object, ListField):
                     new_value = list(field_value or [])
                     if document in new_value:
@@ -467,8 +628,12 @@ class ReferenceField(BaseFieldMixin, fields.ReferenceField):
         """
         def _add_to_new(new_obj, document, field_name):
             from mongoengine.fields import ListField
-            field_value = getattr(new_obj, field_name, None)
             field_object = new_obj._fields[field_name]
+            if getattr(field_object, 'counter', None):
+                new_obj._update_counted_relationship(
+                    field_name, document, add=True)
+                return
+            field_value = getattr(new_obj, field_name, None)
             if isinstance(field_object, ListField):
                 new_value = list(field_value or [])
                 if document not in new_value:
@@ -570,6 +735,12 @@ class RelationshipField(BaseFieldMixin, fields.ListField):
     `reverse_rel_field`: string name of a field on the related document.
         Used when generating backreferences so that fields on each side
         know the name of the field on the other side.
+
+    `counter`: optional name of an IntegerField which is added to the model
+        and holds the number of related documents. It is set when the
+        field value is set. Backref hooks add and remove documents with
+        atomic updates which `$inc` the counter. Documents removed when
+        related documents are deleted decrement the counter as well.
     """
     _valid_kwargs = ('field',)
     _common_valid_kwargs = (
@@ -587,8 +758,32 @@ class RelationshipField(BaseFieldMixin, fields.ListField):
         self.backref_kwargs = {
             k[len(self._backref_prefix):]: v for k, v in kwargs.items()
             if k.startswith(self._backref_prefix)}
+        self.counter = kwargs.get('counter')
         super(RelationshipField, self).__init__(*args, **kwargs)
 
+    def __get__(self, instance, owner):
+        """ Replace references to documents that are already loaded in
+        current identity map with these documents, so only the rest of
+        references are dereferenced.
+
+        Lists which are already dereferenced are returned as is.
+        """
+        if instance is None:
+            return self
+        value = instance._data.get(self.name)
+        identity_map = get_identity_map()
+        auto_dereference = instance._fields[self.name]._auto_dereference
+        if (identity_map is not None and auto_dereference and value and
+                not getattr(value, '_dereferenced', False)):
+            document_type = self.field.document_type
+            mapped = [
+                (identity_map.get(document_type, item.id) or item)
+                if isinstance(item, DBRef) else item
+                for item in value]
+            if any(new is not old for new, old in zip(mapped, value)):
+                instance._data[self.name] = mapped
+        return super(RelationshipField, self).__get__(instance, owner)
+
     def _register_addition_hook(self, new_object, instance):
         """ Define and register addition hook.
 
@@ -639,6 +834,9 @@ class RelationshipField(BaseFieldMixin, fields.ListField):
         """
         super_set = super(RelationshipField, self).__set__
 
+        if self.counter and instance._initialised:
+            setattr(instance, self.counter, len(value or []))
+
         if not self.reverse_rel_field:
             return super_set(instance, value)
 
@@ -688,6 +886,9 @@ def Relationship(**kwargs):
     you passed to SQLA's `ForeignKeyField`.
     `ondelete` kwargs may be kept in both fields with no side-effects when
     switching between the sqla and mongo engines.
+
+    One-to-many relationships may pass `counter` with the name of a field
+    which counts related documents (see `RelationshipField`).
     """
     uselist = kwargs.pop('uselist', True)
     field_cls = RelationshipField if uselist else ReferenceField
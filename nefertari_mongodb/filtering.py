@@ -0,0 +1,214 @@
+""" In-memory evaluation of nefertari queries on loaded documents.
+
+Used by `BaseMixin.filter_objects` to filter documents which are already
+loaded without querying the database again. Query values are converted
+to their stored form with `prepare_query_value` of model fields and are
+compared with stored forms of document values, like MongoDB does.
+
+Supported are equality and `ne`, `lt`, `lte`, `gt`, `gte`, `in`, `nin`
+and `all` operators on top-level fields. ListFields only support
+equality, `ne`, `in`, `nin` and `all`. `UnsupportedQuery` is raised for
+other operators, nested fields, relationship fields, case-insensitive
+fields and values which can't be compared like MongoDB does (values of
+incomparable types, aware and naive datetimes).
+"""
+import datetime
+import operator
+
+import mongoengine as mongo
+import six
+from mongoengine.queryset.transform import MATCH_OPERATORS
+
+from .fields import ReferenceField, RelationshipField, DictField
+
+
+COMPARISONS = {
+    'lt': operator.lt,
+    'lte': operator.le,
+    'gt': operator.gt,
+    'gte': operator.ge,
+}
+LIST_OPERATORS = ('in', 'nin', 'all')
+OPERATORS = (None, 'ne') + LIST_OPERATORS + tuple(COMPARISONS.keys())
+
+# mongoengine query operators, used to tell them from field names
+MONGO_OPERATORS = set(MATCH_OPERATORS)
+
+
+class UnsupportedQuery(Exception):
+    """ Raised when a query can't be evaluated in memory. """
+
+
+def _split_key(key):
+    parts = key.split('__')
+    op = None
+    if len(parts) > 1 and parts[-1] in MONGO_OPERATORS:
+        op = parts.pop()
+    if len(parts) != 1:
+        raise UnsupportedQuery('Nested field query `%s`' % key)
+    if op not in OPERATORS:
+        raise UnsupportedQuery('Operator `%s`' % op)
+    return parts[0], op
+
+
+def get_field(model, name):
+    """ Get field of :model: named :name: which may be evaluated. """
+    if name == 'pk':
+        name = model._meta['id_field']
+    field = model._fields.get(name)
+    if field is None:
+        raise UnsupportedQuery('Unknown field `%s`' % name)
+    if isinstance(field, (ReferenceField, RelationshipField, DictField)):
+        raise UnsupportedQuery('Relationship or dict field `%s`' % name)
+    if isinstance(field, mongo.ListField):
+        item_field(field)
+    return field
+
+
+def item_field(field):
+    """ Get field of :field: ListField items.
+
+    Item field is either ListField `field` or an instance of its
+    `item_type`, cached per ListField.
+    """
+    if field.field is not None:
+        return field.field
+    item_type = getattr(field, 'item_type', None)
+    if isinstance(item_type, type) and issubclass(
+            item_type, mongo.base.BaseField):
+        if getattr(field, '_query_item_field', None) is None:
+            field._query_item_field = item_type()
+        return field._query_item_field
+    raise UnsupportedQuery('ListField `%s` of unknown type' % field.name)
+
+
+def stored_value(field, document):
+    """ Get stored form of :field: value of :document:. """
+    value = getattr(document, field.name, None)
+    if value is None:
+        return None
+    if isinstance(field, mongo.ListField):
+        field = item_field(field)
+        return [field.to_mongo(item) for item in value]
+    return field.to_mongo(value)
+
+
+def _is_aware(value):
+    return (isinstance(value, datetime.datetime) and
+            value.utcoffset() is not None)
+
+
+def _check_datetimes(stored, value):
+    """ Raise UnsupportedQuery when aware datetimes are compared with
+    naive ones, which MongoDB compares as UTC.
+    """
+    items = list(stored) if isinstance(stored, list) else [stored]
+    items += list(value) if isinstance(value, list) else [value]
+    aware = set(_is_aware(item) for item in items
+                if isinstance(item, datetime.datetime))
+    if len(aware) > 1:
+        raise UnsupportedQuery('Comparison of aware and naive datetimes')
+
+
+def _match(op, stored, value):
+    _check_datetimes(stored, value)
+    try:
+        return _compare(op, stored, value)
+    except TypeError as ex:
+        raise UnsupportedQuery('Incomparable values: %s' % ex)
+
+
+def _compare(op, stored, value):
+    if isinstance(stored, list):
+        if op is None:
+            return value in stored or stored == value
+        if op == 'ne':
+            return value not in stored and stored != value
+        if op == 'in':
+            return any(item in stored for item in value)
+        if op == 'nin':
+            return not any(item in stored for item in value)
+        if op == 'all':
+            return all(item in stored for item in value)
+        raise UnsupportedQuery('Operator `%s` on ListField' % op)
+    if op is None:
+        return stored == value
+    if op == 'ne':
+        return stored != value
+    if op == 'in':
+        return stored in value
+    if op == 'nin':
+        return stored not in value
+    if op == 'all':
+        return stored in value and len(set(value)) <= 1
+    if stored is None or value is None:
+        return False
+    return COMPARISONS[op](stored, value)
+
+
+def compile_filter(model, key, value):
+    """ Get predicate of documents matching :key: = :value: query. """
+    name, op = _split_key(key)
+    field = get_field(model, name)
+    if getattr(field, 'case_insensitive', False):
+        raise UnsupportedQuery('Case-insensitive field `%s`' % name)
+    query_field = field
+    if isinstance(field, mongo.ListField):
+        query_field = item_field(field)
+    try:
+        if op in LIST_OPERATORS:
+            if isinstance(value, six.string_types) or not isinstance(
+                    value, (list, tuple, set)):
+                value = [value]
+            value = [query_field.prepare_query_value(op, item)
+                     for item in value]
+        elif value is not None:
+            value = query_field.prepare_query_value(op, value)
+    except (mongo.ValidationError, ValueError, TypeError) as ex:
+        raise UnsupportedQuery('Invalid value of `%s`: %s' % (key, ex))
+
+    def predicate(document):
+        return _match(op, stored_value(field, document), value)
+    return predicate
+
+
+def sort_documents(model, documents, _sort):
+    """ Sort :documents: by :_sort: field names prefixed with `-` for
+    descending order. None values go first, like in MongoDB.
+    """
+    documents = list(documents)
+    for key in reversed(_sort):
+        name = key.lstrip('-+')
+        field = get_field(model, name)
+        if isinstance(field, mongo.ListField):
+            raise UnsupportedQuery('Sorting by ListField `%s`' % name)
+
+        def sort_key(document, field=field):
+            value = stored_value(field, document)
+            return (value is not None, value)
+        try:
+            documents.sort(key=sort_key, reverse=key.startswith('-'))
+        except TypeError:
+            raise UnsupportedQuery('Sorting by mixed types of `%s`' % name)
+    return documents
+
+
+def filter_documents(model, documents, params, _sort=None):
+    """ Filter and sort :documents: of :model: by query :params:.
+
+    Duplicate and unsaved documents are dropped. Returns list of
+    documents.
+    """
+    predicates = [
+        compile_filter(model, key, value) for key, value in params.items()]
+    seen = set()
+    results = []
+    for document in documents:
+        if document.pk is None or document.pk in seen:
+            continue
+        seen.add(document.pk)
+        if all(predicate(document) for predicate in predicates):
+            results.append(document)
+    if _sort:
+        results = sort_documents(model, results, _sort)
+    return results
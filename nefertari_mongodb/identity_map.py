@@ -0,0 +1,158 @@
+""" Request-scoped identity map of documents.
+
+When identity map is active, documents loaded from the database are
+registered in it by (model, primary key) and documents loaded again in the
+same scope (e.g. by `get_item` or by dereferencing relationship fields in
+`to_dict`, backref hooks or ES relations indexing) are taken from the map
+instead of being queried again. Thus there is one instance of each
+document per scope.
+
+Identity map is enabled per request by setting
+`mongodb.identity_map = true`. Max number of documents kept in a map is
+set with `mongodb.identity_map.maxsize` (defaults to 1000). Least recently
+used documents are evicted when the limit is reached.
+
+Outside of requests, use the `identity_map_scope` context manager.
+"""
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+_local = threading.local()
+
+
+class IdentityMap(object):
+    """ Bounded LRU map of (model, pk) to document instances.
+
+    Primary keys are stored in their mongo (stored) form, so they can be
+    matched against DBRef ids.
+    """
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._documents = OrderedDict()
+        # Map may be shared with background threads of a request
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, key):
+        return key in self._documents
+
+    @staticmethod
+    def document_key(document):
+        model = type(document)
+        pk_field = model._fields[model.pk_field()]
+        return (model, pk_field.to_mongo(document.pk))
+
+    def get(self, model, pk):
+        """ Get document of :model: with stored primary key :pk:. """
+        key = (model, pk)
+        with self._lock:
+            document = self._documents.pop(key, None)
+            if document is not None:
+                self._documents[key] = document
+        return document
+
+    def add(self, document):
+        """ Register :document: unless a document with the same key is
+        already registered. Returns the registered document.
+
+        Fields of already registered document which are not changed are
+        refreshed from :document:, so loading a document again doesn't
+        return stale values.
+        """
+        if document.pk is None:
+            return document
+        key = self.document_key(document)
+        with self._lock:
+            registered = self.get(*key)
+            if registered is not None:
+                if registered is not document:
+                    refresh(registered, document)
+                return registered
+            self._documents[key] = document
+            while len(self._documents) > self.maxsize:
+                self._documents.popitem(last=False)
+        return document
+
+    def discard(self, document):
+        if document.pk is not None:
+            with self._lock:
+                self._documents.pop(self.document_key(document), None)
+
+    def discard_model(self, model):
+        """ Discard all documents of :model:. """
+        with self._lock:
+            for key in list(self._documents.keys()):
+                if key[0] is model:
+                    del self._documents[key]
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+
+def refresh(document, loaded):
+    """ Set fields of :document: which are not changed to values of
+    :loaded: document with the same primary key.
+    """
+    changed = set(
+        name.split('.')[0] for name in document._get_changed_fields())
+    for name, field in document._fields.items():
+        if field.db_field in changed or name not in loaded._data:
+            continue
+        value = loaded._data[name]
+        if getattr(value, '_instance', None) is not None:
+            # Embedded documents refer to their parent document
+            value._instance = weakref.proxy(document)
+        document._data[name] = value
+
+
+def get_identity_map():
+    """ Get identity map of current scope if any. """
+    return getattr(_local, 'identity_map', None)
+
+
+@contextmanager
+def identity_map_scope(maxsize=1000):
+    """ Activate a new identity map for the duration of the block. """
+    previous = get_identity_map()
+    _local.identity_map = IdentityMap(maxsize)
+    try:
+        yield _local.identity_map
+    finally:
+        _local.identity_map.clear()
+        _local.identity_map = previous
+
+
+@contextmanager
+def active_identity_map(identity_map):
+    """ Make :identity_map: current for the duration of the block, e.g.
+    in background threads of a request. When it is None, identity map is
+    deactivated, e.g. to load fresh copies of documents which are mapped.
+    """
+    previous = get_identity_map()
+    _local.identity_map = identity_map
+    try:
+        yield identity_map
+    finally:
+        _local.identity_map = previous
+
+
+def identity_map_tween_factory(handler, registry):
+    """ Tween that activates an identity map for each request. """
+    maxsize = int(registry.settings.get(
+        'mongodb.identity_map.maxsize', 1000))
+
+    def identity_map_tween(request):
+        with identity_map_scope(maxsize):
+            return handler(request)
+    return identity_map_tween
+
+
+def includeme(config):
+    config.add_tween(
+        'nefertari_mongodb.identity_map.identity_map_tween_factory')
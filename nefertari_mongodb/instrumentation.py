@@ -0,0 +1,502 @@
+""" Instrumentation of mongo commands.
+
+Records each command sent to mongo with the model (collection) it was
+sent for, the operation and its latency, and reports them to a pluggable
+metrics sink. Commands are also grouped per nefertari request.
+
+Commands are captured using pymongo command monitoring when it is
+available (pymongo 3.1+). With older pymongo versions the methods of
+pymongo `Collection`, `Cursor`, `CommandCursor` and bulk operations that
+perform round trips to the server are wrapped instead.
+
+To enable instrumentation of requests, set `mongodb.instrumentation = true`
+in the app settings. The sink is configured with
+`mongodb.instrumentation.sink` which is a dotted path to a callable that
+accepts settings and returns a sink. Defaults to `MemorySink`.
+"""
+import bisect
+import functools
+import logging
+import threading
+from collections import namedtuple
+from timeit import default_timer
+
+from contextlib import contextmanager
+
+import six
+from pymongo.bulk import BulkOperationBuilder
+from pymongo.collection import Collection
+from pymongo.command_cursor import CommandCursor
+from pymongo.cursor import Cursor
+from pyramid.tweens import EXCVIEW
+try:
+    from pymongo import monitoring
+except ImportError:  # pymongo < 3.1
+    monitoring = None
+
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+_recorder = None
+
+# Names of operations by the name of mongo command
+OPERATIONS = {
+    'find': 'find',
+    'getMore': 'find',
+    'count': 'count',
+    'distinct': 'distinct',
+    'aggregate': 'aggregate',
+    'insert': 'insert',
+    'update': 'update',
+    'findAndModify': 'update',
+    'findandmodify': 'update',
+    'delete': 'delete',
+}
+
+CommandRecord = namedtuple('CommandRecord', [
+    'model', 'collection', 'operation', 'duration', 'failed', 'query'])
+
+
+class Histogram(object):
+    """ Histogram with fixed buckets, Prometheus-style.
+
+    :buckets: is a sorted sequence of upper bounds of buckets. Values
+    greater than the last bound are counted in an implicit +Inf bucket.
+    """
+    DEFAULT_BUCKETS = (
+        1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """ Get approximate :q: quantile (upper bound of the bucket). """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class MetricsSink(object):
+    """ Interface of metrics sinks.
+
+    Sinks receive counters increments and observations of values (e.g.
+    latencies), each with a dict of tags.
+    """
+    def increment(self, name, value=1, tags=None):
+        raise NotImplementedError
+
+    def observe(self, name, value, tags=None):
+        raise NotImplementedError
+
+
+class MemorySink(MetricsSink):
+    """ Sink that keeps counters and histograms in memory.
+
+    Meant to be used in tests and for debugging.
+    """
+    def __init__(self, buckets=Histogram.DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, tags):
+        return (name, tuple(sorted((tags or {}).items())))
+
+    def increment(self, name, value=1, tags=None):
+        key = self._key(name, tags)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, tags=None):
+        key = self._key(name, tags)
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(value)
+
+    def get_counter(self, name, **tags):
+        return self.counters.get(self._key(name, tags), 0)
+
+    def get_histogram(self, name, **tags):
+        return self.histograms.get(self._key(name, tags))
+
+
+class StatsdSink(MetricsSink):
+    """ Sink that reports metrics to a statsd :client:.
+
+    The client must provide `incr(name, count)` and `timing(name, value)`
+    methods, like the `statsd` package client. Tag values are appended to
+    metric names, e.g. `mongo.command.Story.find`. Tags without values
+    are skipped.
+    """
+    def __init__(self, client, prefix='mongo'):
+        self.client = client
+        self.prefix = prefix
+
+    def _name(self, name, tags):
+        parts = [self.prefix, name]
+        parts += [str(val) for key, val in sorted((tags or {}).items())
+                  if val is not None]
+        return '.'.join(part for part in parts if part)
+
+    def increment(self, name, value=1, tags=None):
+        self.client.incr(self._name(name, tags), value)
+
+    def observe(self, name, value, tags=None):
+        self.client.timing(self._name(name, tags), value)
+
+
+class RequestStats(object):
+    """ Mongo commands performed while processing a single request. """
+    def __init__(self, request=None):
+        self.request = request
+        self.commands = []
+        # Commands may be recorded by background threads of the request
+        self.lock = threading.Lock()
+
+    @property
+    def count(self):
+        return len(self.commands)
+
+    @property
+    def duration(self):
+        return sum(command.duration for command in self.commands)
+
+
+class CommandRecorder(object):
+    """ Records mongo commands and reports them to :sink:.
+
+    Each command is reported as a `command` counter increment and a
+    `command.duration` observation (milliseconds) tagged with model and
+    operation. Per-request totals are reported when request is finished.
+
+    :listeners: are callables that are called with `RequestStats` and a
+    `CommandRecord` after a command is recorded during a request.
+    :finish_listeners: are callables that are called with `RequestStats`
+    when a request is finished.
+    """
+    def __init__(self, sink=None):
+        self.sink = sink if sink is not None else MemorySink()
+        self.listeners = []
+        self.finish_listeners = []
+        self._models = {}
+
+    def get_model_name(self, collection):
+        """ Get name of model that uses :collection:. """
+        if collection not in self._models:
+            from .documents import get_document_classes
+            self._models = {
+                model._get_collection_name(): name
+                for name, model in get_document_classes().items()
+                if model._meta.get('collection')}
+            self._models.setdefault(collection, collection)
+        return self._models[collection]
+
+    def record(self, collection, operation, duration, failed=False,
+               query=None):
+        model = self.get_model_name(collection)
+        tags = {'model': model, 'operation': operation}
+        self.sink.increment('command', tags=tags)
+        self.sink.observe('command.duration', duration, tags=tags)
+        if failed:
+            self.sink.increment('command.failed', tags=tags)
+
+        stats = get_request_stats()
+        if stats is None:
+            return
+        record = CommandRecord(
+            model, collection, operation, duration, failed, query)
+        with stats.lock:
+            stats.commands.append(record)
+            for listener in self.listeners:
+                listener(stats, record)
+
+    def start_request(self, request=None):
+        _local.stats = RequestStats(request)
+        return _local.stats
+
+    def finish_request(self, failed=False):
+        """ Report stats of current request and call finish listeners.
+
+        When request has :failed:, errors raised by finish listeners are
+        logged, so they don't replace the original error.
+        """
+        stats = get_request_stats()
+        _local.stats = None
+        if stats is None:
+            return
+        route = getattr(stats.request, 'matched_route', None)
+        tags = {'route': getattr(route, 'name', None)}
+        self.sink.observe('request.commands', stats.count, tags=tags)
+        self.sink.observe('request.duration', stats.duration, tags=tags)
+        for listener in self.finish_listeners:
+            if not failed:
+                listener(stats)
+                continue
+            try:
+                listener(stats)
+            except Exception:
+                log.exception('Finish listener failed on failed request')
+        return stats
+
+
+def get_request_stats():
+    """ Get `RequestStats` of current request if any. """
+    return getattr(_local, 'stats', None)
+
+
+@contextmanager
+def request_stats(stats):
+    """ Record commands of the block in :stats: of a request.
+
+    Used by background threads which perform queries of a request.
+    """
+    previous = get_request_stats()
+    _local.stats = stats
+    try:
+        yield stats
+    finally:
+        _local.stats = previous
+
+
+def get_recorder():
+    """ Get installed `CommandRecorder` if any. """
+    return _recorder
+
+
+if monitoring is not None:
+    _ListenerBase = monitoring.CommandListener
+else:
+    _ListenerBase = object
+
+
+class CommandListener(_ListenerBase):
+    """ pymongo command listener that reports commands to the installed
+    recorder.
+    """
+    def __init__(self):
+        self._started = {}
+
+    @staticmethod
+    def _event_key(event):
+        return (event.connection_id, event.request_id)
+
+    def started(self, event):
+        if _recorder is None:
+            return
+        name = event.command_name
+        operation = OPERATIONS.get(name)
+        if operation is None:
+            return
+        command = event.command
+        if name == 'getMore':
+            collection = command.get('collection')
+        else:
+            collection = command.get(name)
+        query = command.get('filter', command.get('query'))
+        self._started[self._event_key(event)] = (
+            collection, operation, query)
+
+    def _record(self, event, failed):
+        started = self._started.pop(self._event_key(event), None)
+        if started is None or _recorder is None:
+            return
+        collection, operation, query = started
+        _recorder.record(
+            collection, operation, event.duration_micros / 1000.0,
+            failed=failed, query=query)
+
+    def succeeded(self, event):
+        self._record(event, failed=False)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+
+def _cursor_query(cursor, *args, **kwargs):
+    return getattr(cursor, '_Cursor__spec', None)
+
+
+def _first_arg(collection, *args, **kwargs):
+    if args:
+        return args[0]
+    return kwargs.get('spec', kwargs.get('query'))
+
+
+def _find_and_modify_query(collection, query=None, *args, **kwargs):
+    return query
+
+
+def _no_query(*args, **kwargs):
+    return None
+
+
+def _cursor_needs_refresh(cursor):
+    """ Check if `_refresh` of a cursor will perform a round trip. """
+    prefix = '_CommandCursor' if isinstance(cursor, CommandCursor) else (
+        '_Cursor')
+    data = getattr(cursor, prefix + '__data', ())
+    killed = getattr(cursor, prefix + '__killed', False)
+    return not (len(data) or killed)
+
+
+def _target_collection(obj):
+    """ Get collection a command of patched :obj: is sent for. """
+    if isinstance(obj, Collection):
+        return obj
+    if isinstance(obj, CommandCursor):
+        return obj._CommandCursor__collection
+    if isinstance(obj, BulkOperationBuilder):
+        return obj._BulkOperationBuilder__bulk.collection
+    return obj.collection
+
+
+# (class, method name, operation, query getter)
+_PATCHES = (
+    (Cursor, '_refresh', 'find', _cursor_query),
+    (Cursor, 'count', 'count', _cursor_query),
+    (Cursor, 'distinct', 'distinct', _cursor_query),
+    (Collection, 'insert', 'insert', _no_query),
+    (Collection, 'update', 'update', _first_arg),
+    (Collection, 'remove', 'delete', _first_arg),
+    (Collection, 'find_and_modify', 'update', _find_and_modify_query),
+    (Collection, 'aggregate', 'aggregate', _no_query),
+    (CommandCursor, '_refresh', 'find', _no_query),
+    (BulkOperationBuilder, 'execute', 'bulk', _no_query),
+)
+_originals = {}
+
+
+def _wrap(method, operation, get_query):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        recorder = _recorder
+        if recorder is None:
+            return method(self, *args, **kwargs)
+        if operation == 'find' and not _cursor_needs_refresh(self):
+            return method(self, *args, **kwargs)
+        collection = _target_collection(self)
+        start = default_timer()
+        failed = False
+        try:
+            return method(self, *args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            duration = (default_timer() - start) * 1000
+            recorder.record(
+                collection.name, operation, duration, failed=failed,
+                query=get_query(self, *args, **kwargs))
+    return wrapper
+
+
+def _patch_driver():
+    for cls, name, operation, get_query in _PATCHES:
+        if (cls, name) in _originals or not hasattr(cls, name):
+            continue
+        original = getattr(cls, name)
+        _originals[(cls, name)] = original
+        setattr(cls, name, _wrap(original, operation, get_query))
+
+
+def _unpatch_driver():
+    for (cls, name), original in list(_originals.items()):
+        setattr(cls, name, original)
+        del _originals[(cls, name)]
+
+
+_listener = None
+
+
+def install(recorder):
+    """ Install :recorder: to record mongo commands.
+
+    When pymongo command monitoring is available, the listener must be
+    installed before connecting to the database.
+    """
+    global _recorder, _listener
+    _recorder = recorder
+    if monitoring is not None:
+        if _listener is None:
+            _listener = CommandListener()
+            monitoring.register(_listener)
+    else:
+        _patch_driver()
+    return recorder
+
+
+def uninstall():
+    """ Stop recording mongo commands. """
+    global _recorder
+    _recorder = None
+    _unpatch_driver()
+
+
+def instrumentation_tween_factory(handler, registry):
+    """ Tween that groups mongo commands per request.
+
+    `RequestStats` of current request are available as
+    `request.mongo_stats`.
+    """
+    def instrumentation_tween(request):
+        recorder = get_recorder()
+        if recorder is None:
+            return handler(request)
+        request.mongo_stats = recorder.start_request(request)
+        try:
+            response = handler(request)
+        except Exception:
+            recorder.finish_request(failed=True)
+            raise
+        # Finish listeners may raise (e.g. query budget in 'raise' mode)
+        recorder.finish_request()
+        return response
+    return instrumentation_tween
+
+
+def get_sink(settings):
+    """ Create a metrics sink as configured in :settings:. """
+    from zope.dottedname.resolve import resolve
+    factory = settings.get('mongodb.instrumentation.sink')
+    if not factory:
+        return MemorySink()
+    if isinstance(factory, six.string_types):
+        factory = resolve(factory)
+    return factory(settings)
+
+
+def includeme(config):
+    """ Install command recorder and register the instrumentation tween. """
+    settings = config.registry.settings
+    recorder = CommandRecorder(get_sink(settings))
+    config.registry.mongo_recorder = install(recorder)
+    # Placed under the exception view tween, so errors raised by views
+    # reach the tween and errors raised by finish listeners are rendered.
+    # When unit of work is used, the tween is placed under it, so such
+    # errors discard changes of the request before they are committed
+    config.add_tween(
+        'nefertari_mongodb.instrumentation.instrumentation_tween_factory',
+        under=('nefertari_mongodb.unit_of_work.unit_of_work_tween_factory',
+               EXCVIEW))
+    log.info('Mongo commands instrumentation enabled')
@@ -2,7 +2,8 @@ from mongoengine import Document
 from mongoengine.queryset import DO_NOTHING
 
 from .signals import setup_es_signals_for
-from .fields import ReferenceField, RelationshipField
+from .fields import ReferenceField, RelationshipField, IntegerField
+from .utils import es_mapping_cache, counted_relationships
 
 
 class DocumentMetaclass(Document.my_metaclass):
@@ -33,6 +34,11 @@ class DocumentMetaclass(Document.my_metaclass):
 
         """
         super(DocumentMetaclass, self).__init__(name, bases, attrs)
+        # New class may add backrefs to other classes, which changes
+        # their ES mappings
+        es_mapping_cache.clear()
+        self._add_normalized_indexes()
+        self._add_relationship_counters()
         for field_name, field in self._fields.items():
 
             # Field is not a relationship field
@@ -78,6 +84,8 @@ class DocumentMetaclass(Document.my_metaclass):
 
             # Set new field as an attribute of target class
             setattr(target_cls, backref_name, backref_field)
+            if hasattr(target_cls, '_reset_fields_cache'):
+                target_cls._reset_fields_cache()
 
             # Register reverse deletion rules
             delete_rule = getattr(backref_field, 'reverse_delete_rule',
@@ -88,9 +96,49 @@ class DocumentMetaclass(Document.my_metaclass):
                     backref_name,
                     delete_rule)
 
+    def _add_relationship_counters(self):
+        """ Add counter fields of RelationshipFields with `counter`. """
+        for field_name, field in list(self._fields.items()):
+            if not isinstance(field, RelationshipField) or not field.counter:
+                continue
+            if not self._meta.get('abstract'):
+                counted_relationships.append((self, field_name))
+            # Counter is inherited from a base class
+            if field.counter in self._fields:
+                continue
+            counter_field = IntegerField(default=0)
+            counter_field.name = field.counter
+            counter_field.db_field = field.counter
+            counter_field.owner_document = self
+            self._fields[field.counter] = counter_field
+            self._fields_ordered = sorted(
+                list(self._fields_ordered) + [field.counter])
+            setattr(self, field.counter, counter_field)
+            if hasattr(self, '_reset_fields_cache'):
+                self._reset_fields_cache()
+
+    def _add_normalized_indexes(self):
+        """ Index shadow values of case-insensitive fields. """
+        index_specs = self._meta.get('index_specs')
+        if index_specs is None:
+            return
+        indexed = [spec['fields'] for spec in index_specs]
+        for field in self._fields.values():
+            if not getattr(field, 'case_insensitive', False):
+                continue
+            spec = {'fields': [(field.shadow_field, 1)]}
+            if spec['fields'] in indexed:
+                continue
+            if field.unique:
+                spec.update(unique=True, sparse=field.sparse)
+            index_specs.append(spec)
+
 
 class ESMetaclass(DocumentMetaclass):
     def __init__(self, name, bases, attrs):
-        self._index_enabled = True
-        setup_es_signals_for(self)
+        # Resolved through bases, so subclasses of disabled models
+        # aren't indexed unless they enable indexing explicitly
+        self._index_enabled = getattr(self, '_index_enabled', True)
+        if self._index_enabled:
+            setup_es_signals_for(self)
         return super(ESMetaclass, self).__init__(name, bases, attrs)
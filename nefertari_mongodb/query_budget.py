@@ -0,0 +1,186 @@
+""" Detection of N+1 queries and per-request query budgets.
+
+Uses commands recorded by `nefertari_mongodb.instrumentation` to detect
+requests that repeat the same query (same collection, operation and query
+shape) many times, which usually happens when documents are lazily
+dereferenced in a loop (e.g. in `to_dict` or backref hooks), and requests
+that perform more commands than allowed.
+
+Enabled with `mongodb.query_budget = true`. Other settings:
+    mongodb.query_budget.max_queries: Max number of commands per request.
+        Defaults to 100.
+    mongodb.query_budget.max_repeats: Max number of repeats of the same
+        query shape per request. Defaults to 10.
+    mongodb.query_budget.mode: 'log' (default) to log violations as
+        warnings or 'raise' to raise `QueryBudgetExceeded` after request
+        handler returns, which is rendered as 500 Internal Server Error
+        response. When unit of work is used, changes of the request are
+        discarded. Violations of requests which fail are logged.
+"""
+import logging
+import os
+import traceback
+
+from nefertari.json_httpexceptions import JHTTPInternalServerError
+
+
+log = logging.getLogger(__name__)
+
+_IGNORED_PACKAGES = ('pymongo', 'mongoengine', 'bson', 'nefertari_mongodb')
+
+
+class QueryBudgetExceeded(Exception):
+    """ Raised when request violates a query budget in 'raise' mode. """
+    def __init__(self, violations):
+        self.violations = violations
+        super(QueryBudgetExceeded, self).__init__(
+            '\n'.join(str(violation) for violation in violations))
+
+
+class Violation(object):
+    """ Query budget violation.
+
+    Attributes:
+        kind: 'repeated_query' or 'max_queries'.
+        count: Number of queries performed.
+        record: `CommandRecord` of the query which caused the violation.
+        shape: Query shape of repeated query.
+        call_site: (filename, line number, function name) of the first
+            frame outside of mongo libraries and nefertari_mongodb which
+            performed the query.
+    """
+    def __init__(self, kind, count, record, shape=None, call_site=None):
+        self.kind = kind
+        self.count = count
+        self.record = record
+        self.shape = shape
+        self.call_site = call_site
+
+    def __str__(self):
+        if self.kind == 'repeated_query':
+            msg = '%s query %s on `%s` repeated %d times' % (
+                self.record.operation, self.shape, self.record.model,
+                self.count)
+        else:
+            msg = 'Request performed more than %d queries' % self.count
+        if self.call_site is not None:
+            msg += ' (called at %s:%d in %s)' % self.call_site
+        return msg
+
+
+def query_shape(query):
+    """ Get hashable shape of a mongo :query: with values stripped. """
+    if isinstance(query, dict):
+        return tuple(sorted(
+            (key, query_shape(val)) for key, val in query.items()))
+    if isinstance(query, (list, tuple)):
+        if query and isinstance(query[0], dict):
+            return tuple(query_shape(val) for val in query)
+        return '[?]'
+    return '?'
+
+
+def _ignored_paths():
+    paths = []
+    for name in _IGNORED_PACKAGES:
+        try:
+            module = __import__(name)
+        except ImportError:
+            continue
+        paths.append(os.path.dirname(os.path.abspath(module.__file__)))
+    return tuple(paths)
+
+
+def get_call_site(ignored_paths):
+    """ Get (filename, line number, function name) of the innermost frame
+    that is not located in :ignored_paths:.
+    """
+    for filename, lineno, func, _ in reversed(traceback.extract_stack()):
+        if not os.path.abspath(filename).startswith(ignored_paths):
+            return (filename, lineno, func)
+
+
+class QueryBudget(object):
+    """ Command recorder listener that checks query budgets of requests.
+
+    :max_queries: Max number of commands per request.
+    :max_repeats: Max number of commands with the same shape per request.
+    :mode: 'log' or 'raise'.
+    """
+    def __init__(self, max_queries=100, max_repeats=10, mode='log'):
+        if mode not in ('log', 'raise'):
+            raise ValueError('Invalid query budget mode: %s' % mode)
+        self.max_queries = max_queries
+        self.max_repeats = max_repeats
+        self.mode = mode
+        self.ignored_paths = _ignored_paths()
+
+    def _violations(self, stats):
+        if not hasattr(stats, 'query_violations'):
+            stats.query_shapes = {}
+            stats.query_violations = []
+        return stats.query_violations
+
+    def on_command(self, stats, record):
+        """ Check budgets after :record: is recorded in :stats:. """
+        violations = self._violations(stats)
+        shape = query_shape(record.query)
+        key = (record.collection, record.operation, shape)
+        count = stats.query_shapes.get(key, 0) + 1
+        stats.query_shapes[key] = count
+
+        # Stack is only inspected when a violation is found
+        if count == self.max_repeats + 1:
+            violations.append(Violation(
+                'repeated_query', count, record, shape=shape,
+                call_site=get_call_site(self.ignored_paths)))
+        if stats.count == self.max_queries + 1:
+            violations.append(Violation(
+                'max_queries', self.max_queries, record,
+                call_site=get_call_site(self.ignored_paths)))
+
+    def on_request_finished(self, stats):
+        """ Report violations of the finished request. """
+        violations = self._violations(stats)
+        if not violations:
+            return
+        # Report final counts of repeated queries
+        for violation in violations:
+            if violation.kind == 'repeated_query':
+                record = violation.record
+                violation.count = stats.query_shapes[(
+                    record.collection, record.operation, violation.shape)]
+        request = stats.request
+        url = getattr(request, 'url', None)
+        if self.mode == 'raise':
+            raise QueryBudgetExceeded(violations)
+        for violation in violations:
+            log.warning('Query budget violation in %s: %s', url, violation)
+
+
+def query_budget_exceeded_view(context, request):
+    """ Render `QueryBudgetExceeded` raised in 'raise' mode. """
+    log.warning('Query budget exceeded in %s: %s',
+                getattr(request, 'url', None), context)
+    return JHTTPInternalServerError(detail=str(context))
+
+
+def includeme(config):
+    """ Register query budget listeners at the installed command recorder.
+
+    Requires `nefertari_mongodb.instrumentation` to be included first.
+    """
+    settings = config.registry.settings
+    budget = QueryBudget(
+        max_queries=int(settings.get(
+            'mongodb.query_budget.max_queries', 100)),
+        max_repeats=int(settings.get(
+            'mongodb.query_budget.max_repeats', 10)),
+        mode=settings.get('mongodb.query_budget.mode', 'log'))
+    recorder = config.registry.mongo_recorder
+    recorder.listeners.append(budget.on_command)
+    recorder.finish_listeners.append(budget.on_request_finished)
+    config.add_view(query_budget_exceeded_view, context=QueryBudgetExceeded)
+    config.registry.mongo_query_budget = budget
+    log.info('Mongo query budget enabled: %s queries, %s repeats, %s',
+             budget.max_queries, budget.max_repeats, budget.mode)
@@ -0,0 +1,130 @@
+""" Index hints and covered queries.
+
+Index used by queries of `get_collection` may be forced with '_hint'
+model attribute or '_hint' request param. Indexes are specified like
+'_sort': a list or a comma-separated string of field names prefixed with
+'-' for descending order (e.g. 'username,-created_at'). Model hints may
+also be lists of (db field, direction) tuples. Model hints are not used
+by text search queries.
+
+'_hint' request param is only accepted from requests which have
+'mongodb.hint_principal' principal, which defaults to 'g:admin'. Other
+requests get 403 Forbidden response.
+
+When '_covered_queries' model attribute is True, queries of
+`get_collection` which only filter, sort and load fields of an index are
+served from the index without fetching documents. For that `_id` is
+excluded from projection of such queries, so the primary key is not
+loaded unless it is included in '_fields'.
+"""
+import six
+import mongoengine as mongo
+from pyramid.threadlocal import get_current_request
+
+from nefertari.json_httpexceptions import JHTTPBadRequest, JHTTPForbidden
+from nefertari.utils import _split
+
+
+DEFAULT_HINT_PRINCIPAL = 'g:admin'
+
+# Query operators which can't be evaluated on index keys
+NOT_COVERED_OPERATORS = frozenset([
+    '$exists', '$type', '$elemMatch', '$size', '$where', '$not'])
+
+
+def parse_hint(model, hint):
+    """ Get index spec of :hint: for :model:. """
+    if isinstance(hint, six.string_types):
+        hint = _split(hint)
+    spec = []
+    for key in hint:
+        if isinstance(key, (list, tuple)):
+            spec.append(tuple(key))
+            continue
+        name = key.strip('-+')
+        if name in ('pk', 'id'):
+            name = model._meta['id_field']
+        field = model._fields.get(name)
+        if field is None:
+            raise JHTTPBadRequest(
+                "'%s' object does not have fields: %s" % (
+                    model.__name__, name))
+        direction = -1 if key.startswith('-') else 1
+        spec.append((field.db_field, direction))
+    if not spec:
+        raise JHTTPBadRequest('Empty _hint param')
+    return spec
+
+
+def check_request_hint():
+    """ Raise JHTTPForbidden when current request may not pass '_hint'.
+
+    Hints passed outside of requests are always accepted, thus it must be
+    called in the thread of the request before queries are performed in
+    background threads.
+    """
+    request = get_current_request()
+    if request is None:
+        return
+    principal = request.registry.settings.get(
+        'mongodb.hint_principal', DEFAULT_HINT_PRINCIPAL)
+    if principal not in request.effective_principals:
+        raise JHTTPForbidden('_hint param is not allowed')
+
+
+def get_covering_indexes(model):
+    """ Get sets of db field names of :model: indexes which may cover
+    queries. Indexes of ListFields (multikey indexes), sparse indexes and
+    special indexes (text, geo, hashed) can't cover queries.
+    """
+    multikey = set(
+        field.db_field for field in model._fields.values()
+        if isinstance(field, mongo.ListField))
+    indexes = []
+    for spec in model._meta.get('index_specs') or ():
+        keys = [key for key, _ in spec['fields']]
+        if spec.get('sparse') or multikey.intersection(keys):
+            continue
+        if any(direction not in (1, -1) for _, direction in spec['fields']):
+            continue
+        indexes.append(set(keys))
+    return indexes
+
+
+def query_keys(query):
+    """ Get db field names used by :query: or None when :query: can't be
+    evaluated on index keys.
+    """
+    keys = set()
+    for key, value in query.items():
+        if key.startswith('$') or '.' in key or value is None:
+            return None
+        if isinstance(value, dict) and NOT_COVERED_OPERATORS.intersection(
+                value):
+            return None
+        keys.add(key)
+    return keys
+
+
+def apply_covered_projection(model, query_set, hint=None):
+    """ Exclude `_id` from projection of :query_set: when its filter, sort
+    and projection fit an index of :model: (or :hint: index), so the query
+    is covered by the index.
+    """
+    projection = query_set._loaded_fields.as_dict()
+    if not projection or set(projection.values()) != {1}:
+        return query_set
+    if '_id' in projection:
+        return query_set
+    keys = query_keys(query_set._query)
+    if keys is None:
+        return query_set
+    keys.update(projection)
+    keys.update(key for key, _ in query_set._ordering or ())
+    indexes = get_covering_indexes(model)
+    if hint is not None:
+        hint_keys = set(key for key, _ in hint)
+        indexes = [index for index in indexes if index == hint_keys]
+    if any(keys <= index for index in indexes):
+        query_set = query_set.exclude(model._meta['id_field'])
+    return query_set
@@ -0,0 +1,137 @@
+""" Time limits and disk use of queries.
+
+Queries performed by `get_collection`, `get_item`, `get_by_ids`,
+`get_facets` and `expand_with` are aborted by MongoDB when they run
+longer than a time limit (`maxTimeMS`). The limit is taken from
+'_max_time_ms' model attribute or 'mongodb.max_time_ms' setting. Requests
+may pass '_max_time_ms' param to change it, which is capped by
+'mongodb.max_time_ms.limit' setting. When the setting is not set,
+requests may only lower the limit.
+
+Aggregations may write temporary files when their stages exceed memory
+limits (`allowDiskUse`) when '_allow_disk_use' model attribute is True.
+Requests may enable it with '_allow_disk_use' param only when
+'mongodb.allow_disk_use' setting is true.
+
+Queries which exceed their time limit raise `JHTTPServiceUnavailable`
+(503 Service Unavailable).
+
+Settings:
+    mongodb.max_time_ms: Default time limit in milliseconds of queries
+        of models which don't set '_max_time_ms'. Defaults to no limit.
+    mongodb.max_time_ms.limit: Max time limit in milliseconds that may be
+        requested with '_max_time_ms' param.
+    mongodb.allow_disk_use: Whether requests may enable disk use of
+        aggregations. Defaults to false.
+"""
+import logging
+
+from pymongo.errors import ExecutionTimeout
+from pyramid.settings import asbool
+
+from nefertari.json_httpexceptions import (
+    JHTTPBadRequest, JHTTPServiceUnavailable)
+
+
+log = logging.getLogger(__name__)
+
+_settings = {
+    'max_time_ms': None,
+    'max_time_ms_limit': None,
+    'allow_disk_use': False,
+}
+
+
+def _parse_ms(value, name):
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise JHTTPBadRequest('Invalid value of `{}`: {}'.format(name, value))
+    if value < 0:
+        raise JHTTPBadRequest('Invalid value of `{}`: {}'.format(name, value))
+    return value
+
+
+def configure(settings):
+    """ Set query limits from app :settings:. """
+    max_time_ms = settings.get('mongodb.max_time_ms')
+    limit = settings.get('mongodb.max_time_ms.limit')
+    _settings.update(
+        max_time_ms=int(max_time_ms) if max_time_ms else None,
+        max_time_ms_limit=int(limit) if limit else None,
+        allow_disk_use=asbool(settings.get('mongodb.allow_disk_use', False)),
+    )
+
+
+def get_max_time_ms(model, requested=None):
+    """ Get time limit in milliseconds of queries of :model:.
+
+    :requested: is the value of '_max_time_ms' request param. It is capped
+    by 'mongodb.max_time_ms.limit' setting or, when it is not set, by the
+    default limit of :model:. Returns None when queries are not limited.
+    """
+    default = getattr(model, '_max_time_ms', None)
+    if default is None:
+        default = _settings['max_time_ms']
+    if requested is None or requested == '':
+        return default or None
+    requested = _parse_ms(requested, '_max_time_ms')
+    cap = _settings['max_time_ms_limit'] or default
+    if cap:
+        requested = min(requested, cap) if requested else cap
+    return requested or None
+
+
+def get_allow_disk_use(model, requested=None):
+    """ Get whether aggregations of :model: may use disk.
+
+    :requested: is the value of '_allow_disk_use' request param, which is
+    only used when 'mongodb.allow_disk_use' setting is true.
+    """
+    if requested is not None and _settings['allow_disk_use']:
+        return asbool(requested)
+    return bool(getattr(model, '_allow_disk_use', False))
+
+
+def apply_max_time_ms(query_set, max_time_ms):
+    """ Limit execution time of queries of :query_set: cursor.
+
+    Cursors are not copied when query sets are cloned, thus limits have to
+    be applied to final query sets.
+    """
+    if max_time_ms:
+        query_set._cursor.max_time_ms(max_time_ms)
+    return query_set
+
+
+def aggregate_options(max_time_ms=None, allow_disk_use=False):
+    """ Get options of `aggregate` command. """
+    options = {}
+    if max_time_ms:
+        options['maxTimeMS'] = max_time_ms
+    if allow_disk_use:
+        options['allowDiskUse'] = True
+    return options
+
+
+def raise_timeout(model, ex):
+    """ Raise `JHTTPServiceUnavailable` for `ExecutionTimeout` :ex: of
+    :model:.
+    """
+    log.warning('Query of %s exceeded time limit: %s', model.__name__, ex)
+    raise JHTTPServiceUnavailable(
+        detail='Query of `{}` took too long'.format(model.__name__),
+        extra={'data': ex})
+
+
+def execution_timeout_view(context, request):
+    """ Render `ExecutionTimeout` raised while query sets are iterated
+    outside of models methods (e.g. when rendering a response).
+    """
+    log.warning('Query exceeded time limit: %s', context)
+    return JHTTPServiceUnavailable(detail='Query took too long')
+
+
+def includeme(config):
+    configure(config.registry.settings)
+    config.add_view(execution_timeout_view, context=ExecutionTimeout)
@@ -0,0 +1,387 @@
+""" Parallel reindex of models in ES.
+
+A collection is split into `_id` ranges, using the `splitVector` command
+when it is available and boundaries sampled from the `_id` index
+otherwise. Ranges are reindexed by a pool of processes. Each process
+streams documents of its range in `_id` order, loading only the fields
+used by `to_dict`, and indexes them in ES in bulk batches.
+
+The ranges plan and the last indexed `_id` of each range are stored in a
+`CheckpointStore`, so an interrupted reindex may be resumed.
+
+`IncrementalReindex` only reindexes documents modified after the last
+run, using a DateTimeField maintained with `onupdate`.
+
+Run with:
+
+    nefertari-mongodb-reindex --config development.ini --processes 4
+    nefertari-mongodb-reindex --config development.ini --incremental
+"""
+import logging
+import multiprocessing
+import time
+
+import mongoengine
+from pymongo.errors import OperationFailure
+from nefertari.utils import to_dicts
+
+from .checkpoints import CheckpointStore
+from .identity_map import identity_map_scope
+
+
+log = logging.getLogger(__name__)
+
+DONE = 'done'
+
+# Per-process state of pool workers
+_worker = {}
+
+
+def _thin(bounds, partitions):
+    """ Pick at most :partitions: - 1 evenly spaced :bounds:. """
+    if len(bounds) < partitions:
+        return bounds
+    step = float(len(bounds) + 1) / partitions
+    return [bounds[int(step * i) - 1] for i in range(1, partitions)]
+
+
+def split_vector_bounds(collection, partitions):
+    """ Get `_id` bounds of :partitions: using `splitVector` command.
+
+    Returns None if the command is not available (e.g. on mongos).
+    """
+    db = collection.database
+    try:
+        size = db.command('collstats', collection.name).get('size', 0)
+        if not size:
+            return []
+        result = db.command(
+            'splitVector', collection.full_name, keyPattern={'_id': 1},
+            maxChunkSizeBytes=max(size // partitions, 1))
+    except OperationFailure as ex:
+        log.debug('splitVector failed: %s', ex)
+        return None
+    return _thin([key['_id'] for key in result['splitKeys']], partitions)
+
+
+def sampled_bounds(collection, partitions):
+    """ Get `_id` bounds of :partitions: by skipping over `_id` index. """
+    step = collection.count() // partitions
+    if not step:
+        return []
+    bounds = []
+    for index in range(1, partitions):
+        cursor = collection.find({}, ['_id']).sort('_id', 1)
+        for doc in cursor.skip(index * step).limit(1):
+            bounds.append(doc['_id'])
+    return bounds
+
+
+def split_ranges(collection, partitions):
+    """ Split :collection: into :partitions: `_id` ranges.
+
+    Returns list of (lower, upper) bounds. Lower bounds are inclusive,
+    upper bounds are exclusive. None means no bound.
+    """
+    bounds = split_vector_bounds(collection, partitions)
+    if bounds is None:
+        bounds = sampled_bounds(collection, partitions)
+    edges = [None] + bounds + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def range_query(lower, upper, start_after=None):
+    """ Get query of documents with `_id` in range. """
+    conditions = {}
+    if start_after is not None:
+        conditions['$gt'] = start_after
+    elif lower is not None:
+        conditions['$gte'] = lower
+    if upper is not None:
+        conditions['$lt'] = upper
+    return {'_id': conditions} if conditions else {}
+
+
+def get_projection(model):
+    """ Get projection of fields used by `to_dict` of :model:. """
+    from .fields import ForeignKeyField
+    return {
+        field.db_field: True for field in model._fields.values()
+        if not isinstance(field, ForeignKeyField)}
+
+
+class RangeTask(object):
+    """ Reindex of :model_name: documents in `_id` range.
+
+    :checkpoint_key: Key of checkpoint with the last indexed `_id`.
+    :start_after: `_id` after which reindex starts (when resumed).
+    """
+    def __init__(self, model_name, checkpoint_key, lower, upper,
+                 start_after=None, batch_size=500):
+        self.model_name = model_name
+        self.checkpoint_key = checkpoint_key
+        self.lower = lower
+        self.upper = upper
+        self.start_after = start_after
+        self.batch_size = batch_size
+
+
+def reindex_range(task, checkpoints=None, progress=None):
+    """ Reindex documents of :task: range. Returns number of indexed
+    documents.
+
+    :progress: Optional `multiprocessing.Value` incremented with number
+        of indexed documents after each batch.
+    """
+    from nefertari.elasticsearch import ES
+    from .documents import get_document_cls, _projected_fields
+    checkpoints = checkpoints or CheckpointStore()
+    model = get_document_cls(task.model_name)
+    es = ES(model.__name__)
+    projection = get_projection(model)
+    only_fields = _projected_fields(model, projection)
+    cursor = model._get_collection().find(
+        range_query(task.lower, task.upper, task.start_after),
+        projection).sort('_id', 1).batch_size(task.batch_size)
+
+    count = 0
+    batch = []
+
+    def flush():
+        # Related documents are loaded once per batch
+        with identity_map_scope(maxsize=task.batch_size * 10):
+            es.index(to_dicts(
+                model._from_son(son, only_fields=only_fields)
+                for son in batch))
+        checkpoints.set(task.checkpoint_key, batch[-1]['_id'])
+        if progress is not None:
+            with progress.get_lock():
+                progress.value += len(batch)
+
+    for son in cursor:
+        batch.append(son)
+        if len(batch) >= task.batch_size:
+            flush()
+            count += len(batch)
+            batch = []
+    if batch:
+        flush()
+        count += len(batch)
+    checkpoints.set(task.checkpoint_key, DONE)
+    return count
+
+
+def _init_worker(settings, progress):
+    """ Connect pool worker to mongo and ES. """
+    from nefertari.elasticsearch import ES
+    mongoengine.connection.disconnect()
+    mongoengine.connect(settings['mongodb.db'],
+                        host=settings['mongodb.host'],
+                        port=int(settings['mongodb.port']))
+    ES.setup(settings)
+    _worker['progress'] = progress
+
+
+def _run_task(task):
+    return reindex_range(task, progress=_worker.get('progress'))
+
+
+class ParallelReindex(object):
+    """ Reindex of :model: in ES by :processes: processes.
+
+    :partitions: Number of `_id` ranges. Defaults to 4 ranges per
+        process, so faster processes pick more ranges.
+    :batch_size: Number of documents indexed in one ES bulk request.
+    :checkpoints: `CheckpointStore`.
+    :report_interval: Seconds between progress reports.
+    """
+    def __init__(self, model, processes=4, partitions=None, batch_size=500,
+                 checkpoints=None, report_interval=5):
+        self.model = model
+        self.processes = processes
+        self.partitions = partitions or processes * 4
+        self.batch_size = batch_size
+        self.checkpoints = checkpoints or CheckpointStore()
+        self.report_interval = report_interval
+        self.key = 'reindex:%s' % model.__name__
+
+    def plan(self, resume=False):
+        """ Get `RangeTask`s of reindex.
+
+        When :resume: is True, stored plan is used and ranges are resumed
+        from their checkpoints. Otherwise a new plan is created.
+        """
+        ranges = self.checkpoints.get(self.key) if resume else None
+        if ranges is None:
+            collection = self.model._get_collection()
+            ranges = [list(bounds) for bounds in split_ranges(
+                collection, self.partitions)]
+            self.finish()
+            self.checkpoints.set(self.key, ranges)
+
+        tasks = []
+        for index, (lower, upper) in enumerate(ranges):
+            checkpoint_key = '%s:%d' % (self.key, index)
+            start_after = self.checkpoints.get(checkpoint_key)
+            if start_after == DONE:
+                continue
+            tasks.append(RangeTask(
+                self.model.__name__, checkpoint_key, lower, upper,
+                start_after=start_after, batch_size=self.batch_size))
+        return tasks
+
+    def report(self, indexed, total, started):
+        elapsed = time.time() - started
+        rate = indexed / elapsed if elapsed else 0
+        percent = 100.0 * indexed / total if total else 100.0
+        log.info('%s: %d/%d documents indexed (%.1f%%), %.1f docs/s',
+                 self.model.__name__, indexed, total, percent, rate)
+
+    def run(self, settings, resume=False):
+        """ Run reindex. :settings: are app settings used to connect
+        worker processes to mongo and ES.
+
+        Returns number of indexed documents.
+        """
+        tasks = self.plan(resume=resume)
+        total = self.model._get_collection().count()
+        started = time.time()
+        log.info('Reindexing %s: %d ranges by %d processes',
+                 self.model.__name__, len(tasks), self.processes)
+        if not tasks:
+            self.finish()
+            return 0
+        if self.processes == 1:
+            indexed = sum(reindex_range(task, self.checkpoints)
+                          for task in tasks)
+            self.report(indexed, total, started)
+            self.finish()
+            return indexed
+
+        progress = multiprocessing.Value('l', 0)
+        pool = multiprocessing.Pool(
+            self.processes, _init_worker, (dict(settings), progress))
+        try:
+            result = pool.map_async(_run_task, tasks, chunksize=1)
+            while not result.ready():
+                result.wait(self.report_interval)
+                self.report(progress.value, total, started)
+            indexed = sum(result.get())
+        finally:
+            pool.terminate()
+            pool.join()
+        self.finish()
+        return indexed
+
+    def finish(self):
+        """ Delete checkpoints of finished reindex. """
+        for key in self.checkpoints.keys(self.key + ':'):
+            self.checkpoints.delete(key)
+        self.checkpoints.delete(self.key)
+
+
+def get_watermark_field(model, name=None):
+    """ Get name of :model: DateTimeField maintained with `onupdate`.
+
+    Raises ValueError if :model: has no such field or if field :name: is
+    not such a field.
+    """
+    from .fields import DateTimeField
+    names = sorted(
+        field_name for field_name, field in model._fields.items()
+        if isinstance(field, DateTimeField) and field.onupdate is not None)
+    if name is not None and name not in names:
+        raise ValueError('`%s.%s` is not a DateTimeField with onupdate' % (
+            model.__name__, name))
+    if not names:
+        raise ValueError('`%s` has no DateTimeField with onupdate' % (
+            model.__name__))
+    return name or names[0]
+
+
+class IncrementalReindex(object):
+    """ Reindex of :model: documents modified after a stored watermark.
+
+    Documents are processed in batches in (timestamp, `_id`) order, where
+    timestamp is the value of DateTimeField :field: maintained with
+    `onupdate`. The (timestamp, `_id`) watermark of the last indexed
+    document is stored after each batch, so runs may be interrupted and
+    restarted at any time. Each batch is a separate indexed query, so a
+    compound index on (:field:, `_id`) is recommended.
+
+    The field should also have a `default`, because documents with no
+    timestamp are never reindexed. Deleted documents are not handled.
+
+    :overlap: `datetime.timedelta`. Documents modified within this period
+        before the watermark are reindexed again, to catch documents
+        which were written with an older timestamp after the last run.
+    """
+    def __init__(self, model, field=None, batch_size=500, checkpoints=None,
+                 overlap=None):
+        self.model = model
+        self.field = get_watermark_field(model, field)
+        self.db_field = model._fields[self.field].db_field
+        self.batch_size = batch_size
+        self.checkpoints = checkpoints or CheckpointStore()
+        self.overlap = overlap
+        self.key = 'incremental_reindex:%s.%s' % (
+            model.__name__, self.field)
+
+    def get_watermark(self):
+        """ Get stored (timestamp, `_id`) watermark. `_id` is None when
+        documents with the timestamp should be indexed again.
+        """
+        watermark = self.checkpoints.get(self.key)
+        if watermark is None:
+            return None
+        timestamp, pk = watermark['timestamp'], watermark['id']
+        if self.overlap:
+            timestamp, pk = timestamp - self.overlap, None
+        return timestamp, pk
+
+    def query(self, watermark):
+        """ Get query of documents past :watermark:. """
+        if watermark is None:
+            return {self.db_field: {'$ne': None}}
+        timestamp, pk = watermark
+        if pk is None:
+            return {self.db_field: {'$gte': timestamp}}
+        return {'$or': [
+            {self.db_field: {'$gt': timestamp}},
+            {self.db_field: timestamp, '_id': {'$gt': pk}},
+        ]}
+
+    def run(self):
+        """ Reindex documents modified since the last run. Returns number
+        of indexed documents.
+        """
+        from nefertari.elasticsearch import ES
+        from .documents import _projected_fields
+        es = ES(self.model.__name__)
+        collection = self.model._get_collection()
+        projection = get_projection(self.model)
+        only_fields = _projected_fields(self.model, projection)
+        watermark = self.get_watermark()
+        log.info('Reindexing %s modified after %s', self.model.__name__,
+                 watermark[0] if watermark else 'the beginning')
+        count = 0
+        while True:
+            batch = list(collection.find(
+                self.query(watermark), projection).sort(
+                [(self.db_field, 1), ('_id', 1)]).limit(self.batch_size))
+            if not batch:
+                break
+            with identity_map_scope(maxsize=self.batch_size * 10):
+                es.index(to_dicts(
+                    self.model._from_son(son, only_fields=only_fields)
+                    for son in batch))
+            last = batch[-1]
+            watermark = (last[self.db_field], last['_id'])
+            self.checkpoints.set(
+                self.key, {'timestamp': watermark[0], 'id': watermark[1]})
+            count += len(batch)
+            log.info('%s: %d documents indexed up to %s',
+                     self.model.__name__, count, watermark[0])
+            if len(batch) < self.batch_size:
+                break
+        return count
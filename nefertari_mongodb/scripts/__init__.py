@@ -0,0 +1,15 @@
+from ..documents import get_document_classes
+
+
+def get_indexed_models(names=None):
+    """ Get models indexed in ES. Only models named in :names: are
+    returned if it is passed.
+    """
+    models = get_document_classes()
+    if names:
+        missing = set(names) - set(models.keys())
+        if missing:
+            raise ValueError('Unknown models: %s' % ', '.join(missing))
+        models = {name: models[name] for name in names}
+    return [model for model in models.values()
+            if getattr(model, '_index_enabled', False)]
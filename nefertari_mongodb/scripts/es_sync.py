@@ -0,0 +1,56 @@
+""" Sync ES with changes of MongoDB collections. """
+import argparse
+import logging
+
+from pyramid.paster import bootstrap, setup_logging
+
+from ..sync import ESSyncRunner
+from . import get_indexed_models
+
+
+log = logging.getLogger(__name__)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '-c', '--config', required=True,
+        help='Config file of the application')
+    parser.add_argument(
+        '--models',
+        help='Comma-separated names of models to sync. Defaults to all '
+             'models indexed in ES')
+    parser.add_argument(
+        '--flush-size', type=int,
+        help='Max number of changes indexed in a single batch')
+    parser.add_argument(
+        '--flush-interval', type=float,
+        help='Max number of seconds changes are kept before indexing')
+    parser.add_argument(
+        '--name', default='es_sync',
+        help='Name of the checkpoint. Runners syncing different models '
+             'must use different names')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.config)
+    env = bootstrap(args.config)
+    settings = env['registry'].settings
+
+    from nefertari.elasticsearch import ES
+    ES.setup(settings)
+
+    names = args.models.split(',') if args.models else None
+    runner = ESSyncRunner(
+        get_indexed_models(names),
+        flush_size=args.flush_size or int(
+            settings.get('mongodb.es_sync.flush_size', 500)),
+        flush_interval=args.flush_interval or float(
+            settings.get('mongodb.es_sync.flush_interval', 1.0)),
+        name=args.name)
+    try:
+        runner.run()
+    finally:
+        env['closer']()
@@ -0,0 +1,88 @@
+""" Reindex MongoDB collections in ES in parallel. """
+import argparse
+import datetime
+import logging
+
+from pyramid.paster import bootstrap, setup_logging
+
+from ..reindex import (
+    ParallelReindex, IncrementalReindex, get_watermark_field)
+from . import get_indexed_models
+
+
+log = logging.getLogger(__name__)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '-c', '--config', required=True,
+        help='Config file of the application')
+    parser.add_argument(
+        '--models',
+        help='Comma-separated names of models to reindex. Defaults to all '
+             'models indexed in ES')
+    parser.add_argument(
+        '--processes', type=int, default=4,
+        help='Number of worker processes')
+    parser.add_argument(
+        '--partitions', type=int,
+        help='Number of _id ranges per model. Defaults to 4 per process')
+    parser.add_argument(
+        '--batch-size', type=int, default=500,
+        help='Number of documents indexed in a single bulk request')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Resume interrupted reindex from checkpoints')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='Only reindex documents modified after the last incremental '
+             'reindex. Requires a DateTimeField with onupdate')
+    parser.add_argument(
+        '--field',
+        help='DateTimeField used by incremental reindex. Defaults to the '
+             'first DateTimeField with onupdate')
+    parser.add_argument(
+        '--overlap', type=float, default=0,
+        help='Seconds before the stored watermark from which incremental '
+             'reindex starts')
+    return parser.parse_args(argv)
+
+
+def reindex_incremental(model, args):
+    try:
+        field = get_watermark_field(model, args.field)
+    except ValueError as ex:
+        log.warning('Skipping incremental reindex: %s', ex)
+        return
+    reindex = IncrementalReindex(
+        model, field=field, batch_size=args.batch_size,
+        overlap=datetime.timedelta(seconds=args.overlap))
+    indexed = reindex.run()
+    log.info('Reindexed %d modified documents of %s', indexed,
+             model.__name__)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_logging(args.config)
+    env = bootstrap(args.config)
+    settings = env['registry'].settings
+
+    from nefertari.elasticsearch import ES
+    ES.setup(settings)
+
+    names = args.models.split(',') if args.models else None
+    try:
+        for model in get_indexed_models(names):
+            if args.incremental:
+                reindex_incremental(model, args)
+                continue
+            reindex = ParallelReindex(
+                model, processes=args.processes,
+                partitions=args.partitions, batch_size=args.batch_size)
+            indexed = reindex.run(settings, resume=args.resume)
+            log.info('Reindexed %d documents of %s', indexed,
+                     model.__name__)
+    finally:
+        env['closer']()
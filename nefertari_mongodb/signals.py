@@ -3,12 +3,39 @@ import logging
 from mongoengine import signals
 from nefertari.utils import to_dicts
 
+from .unit_of_work import get_unit_of_work
+
 
 log = logging.getLogger(__name__)
 
+# ES signal handlers are disabled when ES is synced by an external runner
+# (see `nefertari_mongodb.sync`)
+_es_signals = {'enabled': True}
+
+
+def disable_es_signals():
+    """ Stop indexing documents in ES on save, delete and bulk update. """
+    _es_signals['enabled'] = False
+
+
+def enable_es_signals():
+    _es_signals['enabled'] = True
+
+
+def es_signals_enabled():
+    return _es_signals['enabled']
+
+
+def _indexing_deferred():
+    """ Check if documents are indexed by a unit of work flush. """
+    unit = get_unit_of_work()
+    return unit is not None and unit.indexing_deferred
+
 
 def on_post_save(sender, document, **kw):
     """ Add new document to index or update existing. """
+    if not es_signals_enabled() or _indexing_deferred():
+        return
     from nefertari.elasticsearch import ES
     common_kw = {'request': getattr(document, '_request', None)}
     created = kw.get('created', False)
@@ -22,6 +49,8 @@ def on_post_save(sender, document, **kw):
 
 
 def on_post_delete(sender, document, **kw):
+    if not es_signals_enabled() or _indexing_deferred():
+        return
     from nefertari.elasticsearch import ES
     request = getattr(document, '_request', None)
     ES(document.__class__.__name__).delete(
@@ -29,6 +58,9 @@ def on_post_delete(sender, document, **kw):
 
 
 def on_bulk_update(model_cls, objects, request):
+    if not es_signals_enabled():
+        return
+
     if not getattr(model_cls, '_index_enabled', False):
         return
 
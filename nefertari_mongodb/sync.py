@@ -0,0 +1,272 @@
+""" Synchronisation of ES with MongoDB changes.
+
+`ESSyncRunner` tails changes of `ESBaseDocument` collections and indexes
+or deletes changed documents in ES in batches. Unlike ES signals, it
+catches all writes, including raw queryset updates and writes made by
+other services, and moves indexing out of API requests. When the runner
+is used, ES signals should be disabled with `mongodb.es_signals = false`.
+
+Changes are read from MongoDB change streams when they are supported by
+pymongo (3.7+) and from the replica set oplog otherwise. Both require
+MongoDB to run as a replica set. The position in the changes log is
+stored in a `CheckpointStore` after each flushed batch, so the runner
+resumes where it stopped when restarted.
+
+Run with:
+
+    nefertari-mongodb-es-sync --config development.ini
+"""
+import logging
+import time
+
+import six
+from mongoengine.connection import get_db
+from nefertari.utils import to_dicts
+
+from .checkpoints import CheckpointStore
+
+try:
+    from pymongo import CursorType
+    _TAILABLE = {'cursor_type': CursorType.TAILABLE_AWAIT}
+except ImportError:  # pymongo < 3.0
+    _TAILABLE = {'tailable': True, 'await_data': True}
+
+
+log = logging.getLogger(__name__)
+
+INDEX = 'index'
+DELETE = 'delete'
+
+
+class Change(object):
+    """ Change of a document.
+
+    :action: INDEX or DELETE.
+    :collection: Name of changed document collection.
+    :pk: Primary key of the changed document.
+    :token: Position in the changes log after this change.
+    """
+    __slots__ = ('action', 'collection', 'pk', 'token')
+
+    def __init__(self, action, collection, pk, token):
+        self.action = action
+        self.collection = collection
+        self.pk = pk
+        self.token = token
+
+
+class OplogSource(object):
+    """ Reads changes of :collections: from the replica set oplog.
+
+    Token is the timestamp of the last read oplog entry.
+    """
+    name = 'oplog'
+    OPERATIONS = {'i': INDEX, 'u': INDEX, 'd': DELETE}
+
+    def __init__(self, db, collections, token=None, poll_interval=1.0):
+        self.db = db
+        self.namespaces = [
+            '%s.%s' % (db.name, name) for name in collections]
+        self.token = token
+        self.poll_interval = poll_interval
+
+    @property
+    def oplog(self):
+        client = getattr(self.db, 'client', None) or self.db.connection
+        return client.local['oplog.rs']
+
+    def _last_timestamp(self):
+        entry = self.oplog.find().sort('$natural', -1).limit(1)
+        for doc in entry:
+            return doc['ts']
+
+    def _cursor(self):
+        if self.token is None:
+            self.token = self._last_timestamp()
+        query = {'ns': {'$in': self.namespaces}}
+        if self.token is not None:
+            query['ts'] = {'$gt': self.token}
+        return self.oplog.find(query, oplog_replay=True, **_TAILABLE)
+
+    def changes(self):
+        """ Yield `Change` objects. Yields None when no changes are
+        available to let consumers flush pending changes.
+        """
+        while True:
+            cursor = self._cursor()
+            while cursor.alive:
+                for entry in cursor:
+                    self.token = entry['ts']
+                    action = self.OPERATIONS.get(entry['op'])
+                    if action is None:
+                        continue
+                    doc = entry['o2'] if entry['op'] == 'u' else entry['o']
+                    yield Change(
+                        action, entry['ns'].split('.', 1)[1],
+                        doc['_id'], self.token)
+                yield None
+            time.sleep(self.poll_interval)
+
+
+class ChangeStreamSource(object):
+    """ Reads changes of :collections: from a MongoDB change stream.
+
+    Token is the resume token of the change stream.
+    """
+    name = 'change_stream'
+    OPERATIONS = {
+        'insert': INDEX, 'update': INDEX, 'replace': INDEX,
+        'delete': DELETE,
+    }
+
+    def __init__(self, db, collections, token=None):
+        self.db = db
+        self.collections = list(collections)
+        self.token = token
+
+    @staticmethod
+    def is_supported(db):
+        return hasattr(db, 'watch')
+
+    def changes(self):
+        pipeline = [{'$match': {
+            'ns.coll': {'$in': self.collections},
+            'operationType': {'$in': list(self.OPERATIONS.keys())},
+        }}]
+        with self.db.watch(pipeline, resume_after=self.token) as stream:
+            while stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    yield None
+                    continue
+                self.token = (
+                    getattr(stream, 'resume_token', None) or change['_id'])
+                yield Change(
+                    self.OPERATIONS[change['operationType']],
+                    change['ns']['coll'], change['documentKey']['_id'],
+                    self.token)
+
+
+def get_source(db, collections, checkpoint=None):
+    """ Create changes source for :collections: of :db:.
+
+    :checkpoint: is a dict of {'source': name, 'token': token} stored by
+    `ESSyncRunner`.
+    """
+    source_cls = OplogSource
+    if ChangeStreamSource.is_supported(db):
+        source_cls = ChangeStreamSource
+    token = None
+    if checkpoint and checkpoint.get('source') == source_cls.name:
+        token = checkpoint['token']
+    elif checkpoint:
+        log.warning('Checkpoint of `%s` source can not be used with `%s`, '
+                    'syncing from now', checkpoint.get('source'),
+                    source_cls.name)
+    return source_cls(db, collections, token=token)
+
+
+class ESSyncRunner(object):
+    """ Indexes changes of :models: in ES in batches.
+
+    :models: Sequence of `ESBaseDocument` subclasses.
+    :checkpoints: `CheckpointStore`. Defaults to a store in the default
+        database.
+    :flush_size: Max number of pending changes. Changes are flushed when
+        this number is reached.
+    :flush_interval: Max number of seconds changes may be pending.
+    :name: Name of checkpoint key.
+    """
+    def __init__(self, models, checkpoints=None, flush_size=500,
+                 flush_interval=1.0, name='es_sync'):
+        self.models = {
+            model._get_collection_name(): model for model in models}
+        self.checkpoints = checkpoints or CheckpointStore()
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.name = name
+        self._pending = {}
+        self._token = None
+        self._last_flush = time.time()
+
+    def get_source(self, db=None):
+        db = db if db is not None else get_db()
+        return get_source(
+            db, list(self.models.keys()),
+            checkpoint=self.checkpoints.get(self.name))
+
+    def add(self, change):
+        """ Add :change: to pending changes. Later changes of a document
+        override earlier ones.
+        """
+        self._pending[(change.collection, change.pk)] = change.action
+        self._token = change.token
+
+    def should_flush(self):
+        if len(self._pending) >= self.flush_size:
+            return True
+        return (time.time() - self._last_flush) >= self.flush_interval
+
+    def flush(self, source_name):
+        """ Index pending changes and store the checkpoint. """
+        self._last_flush = time.time()
+        if self._token is None:
+            return
+        if self._pending:
+            self.index_changes(self._pending)
+            log.info('Synced %d changes to ES', len(self._pending))
+        self.checkpoints.set(
+            self.name, {'source': source_name, 'token': self._token})
+        self._pending = {}
+        self._token = None
+
+    def index_changes(self, changes):
+        """ Index or delete documents from :changes: in ES.
+
+        :changes: is a dict of {(collection, pk): action}. Documents to
+        be indexed are loaded from the database, documents that do not
+        exist anymore are deleted.
+        """
+        from nefertari.elasticsearch import ES
+        grouped = {}
+        for (collection, pk), action in six.iteritems(changes):
+            actions = grouped.setdefault(collection, {INDEX: [], DELETE: []})
+            actions[action].append(pk)
+
+        for collection, actions in six.iteritems(grouped):
+            model = self.models[collection]
+            es = ES(model.__name__)
+            deleted = set(actions[DELETE])
+            if actions[INDEX]:
+                documents = list(model.objects(pk__in=actions[INDEX]))
+                if documents:
+                    es.index(to_dicts(documents))
+                    es.bulk_index_relations(documents, nested_only=True)
+                found = set(doc.pk for doc in documents)
+                deleted.update(
+                    pk for pk in actions[INDEX] if pk not in found)
+            if deleted:
+                es.delete([str(pk) for pk in deleted])
+
+    def run(self, source=None, max_changes=None):
+        """ Sync changes until interrupted.
+
+        :max_changes: Optional number of changes after which runner stops.
+        """
+        source = source if source is not None else self.get_source()
+        log.info('Syncing ES with %s of collections: %s', source.name,
+                 ', '.join(sorted(self.models.keys())))
+        processed = 0
+        try:
+            for change in source.changes():
+                if change is not None:
+                    if change.collection in self.models:
+                        self.add(change)
+                    processed += 1
+                if self.should_flush():
+                    self.flush(source.name)
+                if max_changes is not None and processed >= max_changes:
+                    break
+        except KeyboardInterrupt:
+            log.info('ES sync interrupted')
+        self.flush(source.name)
@@ -1,10 +1,10 @@
 import pytest
-from mock import patch, Mock
+from mock import patch, Mock, call
 
 import mongoengine as mongo
 from mongoengine.errors import FieldDoesNotExist
 from nefertari.utils.dictset import dictset
-from nefertari.json_httpexceptions import JHTTPBadRequest
+from nefertari.json_httpexceptions import JHTTPBadRequest, JHTTPConflict
 
 from .. import documents as docs
 from .. import fields
@@ -61,6 +61,10 @@ class TestDocumentHelpers(object):
         result_dict = docs.process_bools(test_dict)
         assert result_dict == dictset(complete=False, other_arg=5)
 
+    def test_chunk_ids(self):
+        chunks = docs.chunk_ids([1, 2, 1, 3, '2', 4, 5], 2)
+        assert list(chunks) == [[1, 2], [3, 4], [5]]
+
 
 class TestBaseMixin(object):
 
@@ -111,6 +115,23 @@ class TestBaseMixin(object):
             }
         }
 
+    @patch('nefertari.elasticsearch.engine')
+    def test_get_es_mapping_cached(self, mock_conv):
+        from ..utils import es_mapping_cache
+
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField(primary_key=True)
+
+        mapping = MyModel.get_es_mapping()
+        assert (MyModel, 1, id(docs.TYPES_MAP)) in es_mapping_cache
+        mapping['MyModel']['properties']['foo'] = 1
+        assert MyModel.get_es_mapping() != mapping
+
+        class MyModel2(docs.BaseDocument):
+            name = fields.StringField(primary_key=True)
+
+        assert not es_mapping_cache
+
     def test_pk_field(self):
         class MyModel(docs.BaseDocument):
             my_id = fields.IdField()
@@ -174,12 +195,753 @@ class TestBaseMixin(object):
         docs.BaseDocument.apply_sort(query_set, [])
         assert not query_set.order_by.called
 
+    def test_has_text_index(self):
+        class MyModel(docs.BaseDocument):
+            meta = {'indexes': ['$title']}
+            title = fields.StringField()
+
+        class MyModel2(docs.BaseDocument):
+            meta = {'indexes': ['title']}
+            title = fields.StringField()
+
+        assert MyModel.has_text_index()
+        assert not MyModel2.has_text_index()
+
+    def test_apply_text_search(self):
+        class MyModel(docs.BaseDocument):
+            meta = {'indexes': ['$title']}
+            title = fields.StringField()
+
+        query_set = Mock()
+        result = MyModel.apply_text_search(query_set, 'foo bar')
+        query_set.search_text.assert_called_once_with('foo bar')
+        query_set.search_text().order_by.assert_called_once_with(
+            '$text_score')
+        assert result == query_set.search_text().order_by()
+
+        query_set = Mock()
+        MyModel.apply_text_search(query_set, 'foo', sort=False)
+        assert not query_set.search_text().order_by.called
+
+    def test_apply_text_search_no_index(self):
+        class MyModel(docs.BaseDocument):
+            title = fields.StringField()
+
+        with pytest.raises(JHTTPBadRequest):
+            MyModel.apply_text_search(Mock(), 'foo')
+
+    def test_filter_objects_in_memory(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IntegerField(primary_key=True)
+            name = fields.StringField()
+
+        objects = [MyModel(id=1, name='a'), MyModel(id=2, name='b')]
+        with patch.object(MyModel, 'get_collection') as mock_get:
+            result = MyModel.filter_objects(
+                objects, name__in='b,c', _limit=10)
+            assert not mock_get.called
+        assert list(result) == objects[1:]
+        assert result._nefertari_meta == {
+            'total': 1, 'start': 0, 'fields': []}
+        assert MyModel.filter_objects(objects, first=True, id=1) is (
+            objects[0])
+        assert MyModel.filter_objects(objects, _count=None) == 2
+
+    def test_filter_objects_in_memory_fields(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IntegerField(primary_key=True)
+            name = fields.StringField()
+            status = fields.StringField()
+
+        objects = [MyModel(id=1, name='a', status='new')]
+        with patch.object(MyModel, 'get_collection') as mock_get:
+            result = MyModel.filter_objects(objects, _fields=['name'])
+            assert not mock_get.called
+        assert result[0] is not objects[0]
+        assert result[0].id == 1
+        assert result[0].name == 'a'
+        assert result[0].status is None
+        result = MyModel.filter_objects(objects, _fields=['-name'])
+        assert result[0].name is None
+        assert result[0].status == 'new'
+
+        with patch.object(MyModel, 'get_collection') as mock_get:
+            MyModel.filter_objects(objects, _fields=['name', '-status'])
+        mock_get.assert_called_once_with(
+            _fields=['name', '-status'], id__in=['1'])
+
+    def test_filter_objects_in_memory_not_found(self):
+        from nefertari.json_httpexceptions import JHTTPNotFound
+
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        objects = [MyModel(id='1' * 24, name='a')]
+        with pytest.raises(JHTTPNotFound):
+            MyModel.filter_objects(objects, first=True, name='b')
+
+    def test_filter_objects_unsupported(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IntegerField(primary_key=True)
+            name = fields.StringField()
+
+        objects = [MyModel(id=1, name='a')]
+        with patch.object(MyModel, 'get_collection') as mock_get:
+            MyModel.filter_objects(objects, name__contains='a')
+        mock_get.assert_called_once_with(name__contains='a', id__in=['1'])
+
+    def test_get_by_ids(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IntegerField(primary_key=True)
+
+        with patch.object(MyModel, 'get_collection') as mock_get:
+            result = MyModel.get_by_ids(list(range(5000)), _limit=2)
+        mock_get.assert_called_once_with(id__in=list(range(5000)), _limit=2)
+        assert result == mock_get.return_value
+
+    def _chunked_model(self):
+        class MyModel(docs.BaseDocument):
+            _ids_chunk_size = 2
+            id = fields.IntegerField(primary_key=True)
+            name = fields.StringField()
+
+        def get_collection(**params):
+            return Mock(only_fields=[], _cursor=[
+                {'_id': id_, 'name': u'doc%d' % id_}
+                for id_ in sorted(params['id__in'], reverse=True)
+                if id_ != 4])
+        return MyModel, get_collection
+
+    def test_iter_by_ids(self):
+        MyModel, get_collection = self._chunked_model()
+        missing = []
+        with patch.object(MyModel, 'get_collection') as mock_get:
+            mock_get.side_effect = get_collection
+            documents = list(MyModel.iter_by_ids(
+                [3, 1, 4, 3, 2], keep_order=True, missing=missing,
+                name__ne=u'foo'))
+        assert [doc.id for doc in documents] == [3, 1, 2]
+        assert missing == [4]
+        mock_get.assert_any_call(id__in=[3, 1], name__ne=u'foo',
+                                 _query_only=True)
+        mock_get.assert_any_call(id__in=[4, 2], name__ne=u'foo',
+                                 _query_only=True)
+
+    def test_iter_by_ids_queries_in_calling_thread(self):
+        import threading
+        MyModel, get_collection = self._chunked_model()
+        threads = []
+
+        def get_collection_thread(**params):
+            threads.append(threading.current_thread())
+            return get_collection(**params)
+
+        with patch.object(MyModel, 'get_collection') as mock_get:
+            mock_get.side_effect = get_collection_thread
+            documents = list(MyModel.iter_by_ids([1, 2, 3, 5]))
+        assert len(documents) == 4
+        assert threads == [threading.current_thread()] * 2
+
+    def test_get_by_ids_chunked(self):
+        MyModel, get_collection = self._chunked_model()
+        with patch.object(MyModel, 'get_collection') as mock_get:
+            mock_get.side_effect = get_collection
+            documents = MyModel.get_by_ids(
+                [5, 1, 4, 3, 2], _keep_order=True, _limit=2, _page=1)
+        assert isinstance(documents, docs.DocumentsList)
+        assert [doc.id for doc in documents] == [3, 2]
+        assert documents._nefertari_meta == {
+            'total': 4, 'start': 2, 'fields': [], 'missing': [4]}
+
+    def test_get_by_ids_sorted(self):
+        MyModel, _ = self._chunked_model()
+        with patch.object(MyModel, 'get_collection') as mock_get:
+            result = MyModel.get_by_ids(
+                [1, 2, 3], _keep_order=True, _sort='-name')
+        mock_get.assert_called_once_with(id__in=[1, 2, 3], _sort='-name')
+        assert result == mock_get.return_value
+
+    def _facets_model(self):
+        class MyModel(docs.BaseDocument):
+            id = fields.IntegerField(primary_key=True)
+            name = fields.StringField()
+            tags = fields.ListField(
+                item_type=fields.StringField, field=fields.StringField())
+        return MyModel
+
+    def test_get_facets(self):
+        MyModel = self._facets_model()
+        collection = Mock()
+        collection.aggregate.return_value = iter([{
+            'facet_name': [{'_id': 'a', 'count': 2}],
+            'facet_tags': [{'_id': 'x', 'count': 3}, {'_id': 'y', 'count': 1}],
+            'total': [{'count': 2}],
+        }])
+        query_set = Mock(_query={'name': {'$ne': 'b'}})
+        with patch.object(MyModel, 'get_collection', return_value=query_set):
+            with patch.object(MyModel, '_get_collection',
+                              return_value=collection):
+                result = MyModel.get_facets(
+                    _facets='name,tags', name__ne='b', _count=None)
+        assert result == {
+            'facets': {
+                'name': [{'value': 'a', 'count': 2}],
+                'tags': [{'value': 'x', 'count': 3},
+                         {'value': 'y', 'count': 1}],
+            },
+            'total': 2,
+        }
+        pipeline = collection.aggregate.call_args[0][0]
+        assert pipeline[0] == {'$match': {'name': {'$ne': 'b'}}}
+        facets = pipeline[1]['$facet']
+        assert sorted(facets.keys()) == ['facet_name', 'facet_tags', 'total']
+        assert facets['facet_tags'][0] == {'$unwind': '$tags'}
+        assert facets['facet_name'][0] == {
+            '$group': {'_id': '$name', 'count': {'$sum': 1}}}
+
+    def test_get_facets_page(self):
+        MyModel = self._facets_model()
+        collection = Mock()
+        collection.aggregate.return_value = iter([{
+            'facet_name': [], 'total': [{'count': 5}],
+            'data': [{'_id': 3, 'name': u'c'}],
+        }])
+        query_set = Mock(_query={}, only_fields=[], _ordering=[])
+        query_set._loaded_fields.as_dict.return_value = {}
+        with patch.object(MyModel, 'get_collection', return_value=query_set):
+            with patch.object(MyModel, '_get_collection',
+                              return_value=collection):
+                result = MyModel.get_facets(
+                    _facets='name', _limit=1, _page=2)
+        assert result['total'] == 5
+        assert [doc.id for doc in result['data']] == [3]
+        assert result['data']._nefertari_meta == {
+            'total': 5, 'start': 2, 'fields': []}
+        facets = collection.aggregate.call_args[0][0][1]['$facet']
+        assert facets['data'][-2:] == [{'$skip': 2}, {'$limit': 1}]
+
+    def test_get_facets_not_allowed(self):
+        MyModel = self._facets_model()
+        with pytest.raises(JHTTPBadRequest):
+            MyModel.get_facets(_facets='foo')
+        with pytest.raises(JHTTPBadRequest):
+            MyModel.get_facets()
+
+    def test_get_collection_concurrent_count(self):
+        from mock import MagicMock
+
+        class MyModel(docs.BaseDocument):
+            _concurrent_count = True
+            name = fields.StringField()
+
+        query_set = MagicMock()
+        filtered = query_set.return_value
+        filtered.clone().count.return_value = 5
+        page = filtered.__getitem__.return_value
+        page.__len__.return_value = 2
+        result = MyModel.get_collection(
+            query_set=query_set, name='foo', _limit=2)
+        assert result is page
+        assert not filtered.count.called
+        assert result._nefertari_meta['total'] == 5
+        assert result._nefertari_meta['start'] == 0
+
+    def test_get_collection_concurrent_count_timeout(self):
+        from mock import MagicMock
+        from nefertari.json_httpexceptions import JHTTPServiceUnavailable
+
+        class MyModel(docs.BaseDocument):
+            _concurrent_count = True
+            name = fields.StringField()
+
+        query_set = MagicMock()
+        filtered = query_set.return_value
+        filtered.clone().count.side_effect = docs.ExecutionTimeout('foo')
+        filtered.__getitem__.return_value.__len__.return_value = 2
+        with pytest.raises(JHTTPServiceUnavailable):
+            MyModel.get_collection(
+                query_set=query_set, name='foo', _limit=2)
+
+    def test_get_collection_max_time_ms(self):
+        from mock import MagicMock
+
+        class MyModel(docs.BaseDocument):
+            _max_time_ms = 500
+            name = fields.StringField()
+
+        query_set = MagicMock()
+        filtered = query_set.return_value
+        page = filtered.__getitem__.return_value
+        result = MyModel.get_collection(
+            query_set=query_set, name='foo', _limit=2, _max_time_ms='100')
+        assert result is page
+        filtered._cursor.max_time_ms.assert_called_once_with(100)
+        page._cursor.max_time_ms.assert_called_once_with(100)
+
+    def test_get_collection_timeout(self):
+        from mock import MagicMock
+        from nefertari.json_httpexceptions import JHTTPServiceUnavailable
+
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        query_set = MagicMock()
+        query_set.return_value.count.side_effect = docs.ExecutionTimeout('')
+        with pytest.raises(JHTTPServiceUnavailable):
+            MyModel.get_collection(query_set=query_set, name='foo')
+
+    def test_pop_case_insensitive_filters(self):
+        class MyModel(docs.BaseDocument):
+            email = fields.CaseInsensitiveStringField()
+            name = fields.StringField()
+
+        params = {'email': u'Foo@Bar', 'name': 'foo'}
+        assert MyModel._pop_case_insensitive_filters(params) == {
+            '_email_normalized': u'foo@bar'}
+        assert params == {'name': 'foo'}
+
+        params = {'email__in': [u'A', u'b'], 'email__startswith': u'F.',
+                  'email__contains': u'x'}
+        query = MyModel._pop_case_insensitive_filters(params)
+        assert sorted(query['$and'], key=str) == [
+            {'_email_normalized': {'$in': [u'a', u'b']}},
+            {'_email_normalized': {'$regex': u'^f\\.'}},
+        ]
+        assert params == {'email__contains': u'x'}
+
+    def test_update_many_case_insensitive(self):
+        class MyModel(docs.BaseDocument):
+            email = fields.CaseInsensitiveStringField()
+
+        items = Mock(spec=mongo.queryset.queryset.QuerySet, _query={'a': 1})
+        with patch.object(MyModel, '_get_collection') as mock_coll:
+            with patch.object(docs, 'on_bulk_update'):
+                MyModel._update_many(items, {'email': u'Foo'})
+                items.update.assert_called_once_with(__raw__={'$set': {
+                    'email': u'Foo', '_email_normalized': u'foo'}})
+                items.reset_mock()
+                MyModel._update_many(items, {'unset__email': 1})
+                items.update.assert_called_once_with(__raw__={'$unset': {
+                    'email': 1, '_email_normalized': 1}})
+        assert not mock_coll().update.called
+
+    def test_get_normalized_values(self):
+        class MyModel(docs.BaseDocument):
+            email = fields.CaseInsensitiveStringField()
+            name = fields.StringField()
+
+        assert MyModel._get_normalized_values(
+            {'set__email': u'Foo', 'name': u'Bar'}) == (
+            {'_email_normalized': u'foo'}, {})
+        assert MyModel._get_normalized_values({'email': None}) == (
+            {}, {'_email_normalized': 1})
+        assert MyModel._get_normalized_values(
+            {'unset__email': 1, 'inc__count': 1}) == (
+            {}, {'_email_normalized': 1})
+
     def test_count(self):
         query_set = Mock()
         docs.BaseDocument.count(query_set)
         query_set.count.assert_called_once_with(
             with_limit_and_skip=True)
 
+    def test_dict_update_operations(self):
+        class MyModel(docs.BaseDocument):
+            settings = fields.DictField()
+
+        obj = MyModel()
+        operations = obj._dict_update_operations(
+            'settings', ['a'], ['b'], {'a': 1, '-b': None})
+        assert operations == [{
+            '$set': {'settings.a': 1},
+            '$unset': {'settings.b': ''},
+        }]
+
+    def test_list_update_operations(self):
+        class MyModel(docs.BaseDocument):
+            tags = fields.ListField(item_type=fields.StringField)
+
+        obj = MyModel()
+        operations = obj._list_update_operations(
+            'tags', ['a', 'b'], ['c'], unique=True)
+        assert operations == [
+            {'$addToSet': {'tags': {'$each': ['a', 'b']}}},
+            {'$pull': {'tags': {'$in': ['c']}}},
+        ]
+        operations = obj._list_update_operations(
+            'tags', ['a'], [], unique=False)
+        assert operations == [{'$push': {'tags': {'$each': ['a']}}}]
+
+    @patch.object(docs, 'on_bulk_update')
+    def test_update_iterables_atomic(self, mock_bulk):
+        class MyModel(docs.BaseDocument):
+            tags = fields.ListField(item_type=fields.StringField)
+
+        obj = MyModel(id='5600d8d0d3e5d13ab8000001', tags=['a', 'c'])
+        obj._created = False
+        collection = Mock()
+        collection.find_and_modify.return_value = {'tags': ['a', 'b']}
+        obj._get_collection = Mock(return_value=collection)
+        obj.save = Mock()
+        obj.update_iterables(['b', '-c'], 'tags', atomic=True)
+        assert collection.find_and_modify.call_count == 2
+        assert obj.tags == ['a', 'b']
+        assert not obj.save.called
+        mock_bulk.assert_called_once_with(MyModel, [obj], None)
+
+    @patch.object(docs, 'on_bulk_update')
+    def test_update_iterables_atomic_deferred(self, mock_bulk):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField(required=True)
+            tags = fields.ListField(item_type=fields.StringField)
+
+        obj = MyModel(id='5600d8d0d3e5d13ab8000001', tags=['a'])
+        obj._created = False
+        collection = Mock()
+        collection.find_and_modify.return_value = {'tags': ['a', 'b']}
+        obj._get_collection = Mock(return_value=collection)
+        obj.update_iterables(['b'], 'tags', save=False, atomic=True)
+        assert not collection.find_and_modify.called
+        with pytest.raises(mongo.ValidationError):
+            obj.save()
+        assert not collection.find_and_modify.called
+        assert obj._pending_updates
+
+        obj.name = 'foo'
+        with patch.object(docs.mongo.Document, 'save') as mock_save:
+            obj.save()
+        collection.find_and_modify.assert_called_once_with(
+            query={'_id': docs.ObjectId('5600d8d0d3e5d13ab8000001')},
+            update={'$addToSet': {'tags': {'$each': ['b']}}},
+            new=True, fields={'tags': True})
+        mock_save.assert_called_once_with(force_insert=False, validate=False)
+        assert obj.tags == ['a', 'b']
+        assert not obj._pending_updates
+
+    def test_update_iterables_atomic_invalid(self):
+        class MyModel(docs.BaseDocument):
+            tags = fields.ListField(
+                item_type=fields.StringField, choices=['a', 'b'])
+            settings = fields.DictField()
+
+        obj = MyModel(id='5600d8d0d3e5d13ab8000001')
+        obj._created = False
+        obj._get_collection = Mock()
+        with pytest.raises(JHTTPBadRequest):
+            obj.update_iterables(['c'], 'tags', atomic=True)
+        with pytest.raises(JHTTPBadRequest):
+            obj.update_iterables({'a.b': 1}, 'settings', atomic=True)
+        with pytest.raises(JHTTPBadRequest):
+            obj.update_iterables({'-$where': 1}, 'settings', atomic=True)
+        assert not obj._get_collection().find_and_modify.called
+
+    def test_update_iterables_keeps_order(self):
+        class MyModel(docs.BaseDocument):
+            tags = fields.ListField(item_type=fields.StringField)
+
+        obj = MyModel(tags=['c', 'b', 'a'])
+        obj.update_iterables(['-b'], 'tags', save=False)
+        assert obj.tags == ['c', 'a']
+
+    def test_prefix_query(self):
+        query = {'name': 'foo', '$or': [{'a': 1}, {'b': {'$gt': 2}}]}
+        assert docs.prefix_query(query, 'user') == {
+            'user.name': 'foo',
+            '$or': [{'user.a': 1}, {'user.b': {'$gt': 2}}],
+        }
+
+    def test_expand_with(self):
+        class User(docs.BaseDocument):
+            name = fields.StringField()
+
+        class Story(docs.BaseDocument):
+            title = fields.StringField()
+            user = fields.Relationship(document='User', uselist=False)
+
+        query_set = Mock(
+            _query={'title': 'foo'}, _ordering=[('title', 1)],
+            _skip=None, _limit=10)
+        query_set._loaded_fields.as_dict.return_value = {}
+        query_set.count.return_value = 1
+        with_query_set = Mock(_query={})
+        story_id = '5600d8d0d3e5d13ab8000001'
+        user_id = '5600d8d0d3e5d13ab8000002'
+        Story.get_collection = Mock(return_value=query_set)
+        User.get_collection = Mock(return_value=with_query_set)
+        Story._aggregate = Mock(return_value=[{
+            '_id': story_id, 'title': 'foo',
+            'user': {'_id': user_id, 'name': 'bar'},
+        }])
+        Story._aggregate_count = Mock(return_value=1)
+
+        objs = Story.expand_with(User, params={'title': 'foo'})
+        Story.get_collection.assert_called_once_with(
+            title='foo', _query_only=True)
+        pipeline = Story._aggregate.call_args[0][0]
+        match = {'$match': {'title': 'foo'}}
+        assert pipeline == [
+            match,
+            {'$sort': docs.SON([('title', 1)])},
+            {'$limit': 10},
+            {'$lookup': {
+                'from': 'user', 'localField': 'user',
+                'foreignField': '_id', 'as': 'user'}},
+            {'$unwind': {
+                'path': '$user', 'preserveNullAndEmptyArrays': True}},
+        ]
+        Story._aggregate_count.assert_called_once_with(
+            [match], max_time_ms=None, allow_disk_use=False)
+        assert not query_set.count.called
+        assert len(objs) == 1
+        assert objs[0].title == 'foo'
+        assert objs[0].user.name == 'bar'
+        assert objs._nefertari_meta['total'] == 1
+        assert objs._nefertari_meta['start'] == 0
+
+    def test_expand_with_filtered(self):
+        class User(docs.BaseDocument):
+            name = fields.StringField()
+
+        class Story(docs.BaseDocument):
+            title = fields.StringField()
+            user = fields.Relationship(document='User', uselist=False)
+
+        user_id = docs.ObjectId()
+        query_set = Mock(
+            _query={'title': 'foo'}, _ordering=[], _skip=20, _limit=10)
+        query_set._loaded_fields.as_dict.return_value = {'title': 1}
+        Story.get_collection = Mock(return_value=query_set)
+        User.get_collection = Mock(return_value=Mock(_query={'name': 'bar'}))
+        users = Mock()
+        users.distinct.return_value = [user_id]
+        User._get_collection = Mock(return_value=users)
+        Story._aggregate = Mock(return_value=[{
+            '_id': docs.ObjectId(), 'title': 'foo', 'user': None}])
+        Story._aggregate_count = Mock(return_value=21)
+
+        objs = Story.expand_with(
+            User, params={'title': 'foo'}, with_params={'name': 'bar'})
+        users.distinct.assert_called_once_with('_id', {'name': 'bar'})
+        pipeline = Story._aggregate.call_args[0][0]
+        match = {'$match': {'$and': [
+            {'title': 'foo'}, {'user': {'$in': [user_id]}}]}}
+        assert pipeline[:3] == [match, {'$skip': 20}, {'$limit': 10}]
+        assert pipeline[-1] == {'$project': {'title': 1, 'user': 1}}
+        assert Story._aggregate_count.call_args[0][0] == [match]
+        assert objs[0].user is None
+        assert objs._nefertari_meta['start'] == 20
+
+    def test_projected_fields(self):
+        class Story(docs.BaseDocument):
+            title = fields.StringField(name='t')
+            body = fields.StringField()
+
+        assert sorted(docs._projected_fields(Story, {'t': 1})) == [
+            'id', 'title']
+        assert sorted(docs._projected_fields(
+            Story, {'t': 1, '_id': 0})) == ['title']
+        assert sorted(docs._projected_fields(Story, {'body': 0})) == [
+            'id', 'title']
+
+    @patch.object(docs.mongo.signals.pre_save_post_validation, 'send')
+    @patch.object(docs.mongo.signals.pre_save, 'send')
+    def test_get_upsert_operation(self, mock_pre, mock_post_validation):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+            status = fields.StringField()
+
+        with patch.object(MyModel, 'objects') as mock_objects:
+            mock_objects.return_value._query = {'name': 'foo'}
+            query = MyModel._get_upsert_query({'name': 'foo'})
+        mock_objects.assert_called_once_with(name='foo')
+        assert query == {'name': 'foo'}
+        update, document = MyModel._get_upsert_operation(
+            query, {'name': 'foo'}, {'status': 'new'})
+        insert = update['$setOnInsert']
+        assert insert['status'] == 'new'
+        assert 'name' not in insert
+        assert isinstance(insert['_id'], docs.ObjectId)
+        assert document.status == 'new'
+        mock_pre.assert_called_once_with(MyModel, document=document)
+        mock_post_validation.assert_called_once_with(
+            MyModel, document=document, created=True)
+
+    def test_get_upsert_operation_invalid(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField(required=True)
+
+        with pytest.raises(mongo.ValidationError):
+            MyModel._get_upsert_operation({}, {}, {})
+
+    def _get_or_create_model(self, collection, document=None):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        MyModel._get_upsert_query = Mock(return_value={'name': 'foo'})
+        MyModel._get_upsert_operation = Mock(
+            return_value=({}, document or MyModel(name='foo')))
+        MyModel._get_collection = Mock(return_value=collection)
+        return MyModel
+
+    @patch.object(docs.mongo.signals.post_save, 'send')
+    def test_get_or_create_created(self, mock_send):
+        hook = Mock()
+        document = Mock(_backref_hooks=(hook,))
+        collection = Mock()
+        collection.find.return_value.limit.return_value = []
+        collection.find_and_modify.return_value = {
+            'lastErrorObject': {'updatedExisting': False},
+            'value': {'_id': docs.ObjectId(), 'name': 'foo'},
+        }
+        MyModel = self._get_or_create_model(collection, document)
+
+        obj, created = MyModel.get_or_create(
+            name='foo', defaults={'name': 'bar'})
+        assert created
+        assert obj.name == 'foo'
+        MyModel._get_upsert_operation.assert_called_once_with(
+            {'name': 'foo'}, {'name': 'foo'}, {'name': 'bar'})
+        collection.find_and_modify.assert_called_once_with(
+            query={'name': 'foo'}, update={}, upsert=True, new=True,
+            full_response=True)
+        hook.assert_called_once_with(document=obj)
+        mock_send.assert_called_once_with(
+            MyModel, document=obj, created=True)
+
+    @patch.object(docs.mongo.signals.post_save, 'send')
+    def test_get_or_create_existing(self, mock_send):
+        collection = Mock()
+        collection.find.return_value.limit.return_value = [
+            {'_id': docs.ObjectId(), 'name': 'foo'}]
+        MyModel = self._get_or_create_model(collection)
+
+        obj, created = MyModel.get_or_create(name='foo')
+        assert not created
+        assert obj.name == 'foo'
+        collection.find.assert_called_once_with({'name': 'foo'})
+        collection.find.return_value.limit.assert_called_once_with(2)
+        assert not MyModel._get_upsert_operation.called
+        assert not collection.find_and_modify.called
+        assert not mock_send.called
+
+    @patch.object(docs.mongo.signals.post_save, 'send')
+    def test_get_or_create_concurrent(self, mock_send):
+        collection = Mock()
+        collection.find.return_value.limit.side_effect = [
+            [], Mock(count=Mock(return_value=1))]
+        collection.find_and_modify.side_effect = [
+            docs.DuplicateKeyError('E11000'),
+            {'lastErrorObject': {'updatedExisting': True},
+             'value': {'_id': docs.ObjectId(), 'name': 'foo'}},
+        ]
+        MyModel = self._get_or_create_model(collection)
+
+        obj, created = MyModel.get_or_create(name='foo')
+        assert not created
+        assert collection.find_and_modify.call_count == 2
+        assert not mock_send.called
+
+    def test_get_or_create_multiple_existing(self):
+        collection = Mock()
+        collection.find.return_value.limit.return_value = [
+            {'_id': docs.ObjectId(), 'name': 'foo'},
+            {'_id': docs.ObjectId(), 'name': 'foo'}]
+        MyModel = self._get_or_create_model(collection)
+        with pytest.raises(JHTTPBadRequest):
+            MyModel.get_or_create(name='foo')
+        assert not collection.find_and_modify.called
+
+    def _get_or_create_many_model(self, collection):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        MyModel._get_upsert_query = Mock(side_effect=dict)
+        MyModel._get_upsert_operation = Mock(
+            side_effect=lambda query, params, defaults: (
+                {'$setOnInsert': defaults}, MyModel(**params)))
+        MyModel._get_collection = Mock(return_value=collection)
+        return MyModel
+
+    @patch.object(docs.mongo.signals.post_save, 'send')
+    def test_get_or_create_many(self, mock_send):
+        existing = {'_id': docs.ObjectId(), 'name': 'foo'}
+        created = {'_id': docs.ObjectId(), 'name': 'bar'}
+        collection = Mock()
+        collection.find.side_effect = [[existing], [created]]
+        bulk = collection.initialize_unordered_bulk_op.return_value
+        bulk.execute.return_value = {'upserted': [{'index': 0}]}
+        MyModel = self._get_or_create_many_model(collection)
+
+        results = MyModel.get_or_create_many(
+            [{'name': 'foo'}, {'name': 'bar'}], defaults={'status': 'new'})
+        assert [(obj.name, new) for obj, new in results] == [
+            ('foo', False), ('bar', True)]
+        bulk.find.assert_called_once_with({'name': 'bar'})
+        bulk.find.return_value.upsert.return_value.update_one.\
+            assert_called_once_with({'$setOnInsert': {'status': 'new'}})
+        assert collection.find.call_args_list[1][0][0] == {
+            '$or': [{'name': 'bar'}]}
+        mock_send.assert_called_once_with(
+            MyModel, document=results[1][0], created=True)
+
+    def test_get_or_create_many_existing(self):
+        collection = Mock()
+        collection.find.return_value = [
+            {'_id': docs.ObjectId(), 'name': 'foo'}]
+        MyModel = self._get_or_create_many_model(collection)
+        results = MyModel.get_or_create_many([{'name': 'foo'}])
+        assert not results[0][1]
+        assert not MyModel._get_upsert_operation.called
+        assert not collection.initialize_unordered_bulk_op.called
+
+    def test_get_or_create_many_multiple_existing(self):
+        collection = Mock()
+        collection.find.return_value = [
+            {'_id': docs.ObjectId(), 'name': 'foo'},
+            {'_id': docs.ObjectId(), 'name': 'foo'}]
+        MyModel = self._get_or_create_many_model(collection)
+        with pytest.raises(JHTTPBadRequest):
+            MyModel.get_or_create_many([{'name': 'foo'}])
+        assert not collection.initialize_unordered_bulk_op.called
+
+    def test_get_or_create_many_write_error(self):
+        collection = Mock()
+        collection.find.return_value = []
+        bulk = collection.initialize_unordered_bulk_op.return_value
+        bulk.execute.side_effect = docs.BulkWriteError(
+            {'writeErrors': [{'code': 121}]})
+        MyModel = self._get_or_create_many_model(collection)
+        with pytest.raises(JHTTPBadRequest):
+            MyModel.get_or_create_many([{'name': 'foo'}])
+
+    def test_get_or_create_many_conflict(self):
+        collection = Mock()
+        collection.find.return_value = []
+        collection.find_one.return_value = None
+        bulk = collection.initialize_unordered_bulk_op.return_value
+        bulk.execute.side_effect = docs.BulkWriteError(
+            {'writeErrors': [{'code': 11000}]})
+        MyModel = self._get_or_create_many_model(collection)
+        with pytest.raises(JHTTPConflict):
+            MyModel.get_or_create_many([{'name': 'foo'}])
+
+    def test_index_by_queries(self):
+        id_ = docs.ObjectId()
+        documents = [
+            {'_id': id_, 'name': 'foo', 'tags': ['a']},
+            {'_id': docs.ObjectId(), 'name': 'bar', 'tags': ['b']},
+        ]
+        queries = [{'name': 'foo'}, {'_id': id_}, {'tags': ['a']}]
+        index, ambiguous = docs._index_by_queries(documents, queries)
+        assert index[docs._query_key({'name': 'foo'})] is documents[0]
+        assert index[docs._query_key({'_id': id_})] is documents[0]
+        assert not ambiguous
+        documents.append({'_id': docs.ObjectId(), 'name': 'foo'})
+        _, ambiguous = docs._index_by_queries(documents, queries)
+        assert ambiguous == {docs._query_key({'name': 'foo'})}
+        assert docs._query_key({'tags': ['a']}) is None
+        assert docs._query_key({'name': {'$ne': 'a'}}) is None
+
     def test_is_modified_no_changed_fields(self):
         obj = docs.BaseMixin()
         obj.pk_field = Mock(return_value='id')
@@ -220,6 +982,176 @@ class TestBaseDocument(object):
         except FieldDoesNotExist:
             raise Exception('Unexpected error')
 
+    def test_validate_changed(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+            count = fields.IntegerField(max_value=5)
+
+        obj = MyModel(name='foo', count=10)
+        obj._created = False
+        obj._clear_changed_fields()
+        obj.name = 'bar'
+        obj.validate_changed()
+        obj.count = 11
+        with pytest.raises(JHTTPBadRequest) as ex:
+            obj.validate_changed()
+        assert 'count' in str(ex.value)
+
+    def test_from_son_lazy_fields(self):
+        import datetime
+        import pickle
+        from bson import ObjectId
+
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+            date = fields.DateField()
+            data = fields.PickleField()
+
+        assert sorted(MyModel._get_lazy_db_fields()) == ['data', 'date']
+        raw = pickle.dumps({'foo': 1})
+        obj = MyModel._from_son({
+            '_id': ObjectId(), 'name': 'foo', 'date': '2015-01-02',
+            'data': raw})
+        assert isinstance(obj._data['date'], fields.LazyValue)
+        assert isinstance(obj._data['data'], fields.LazyValue)
+        obj.validate()
+        son = obj.to_mongo()
+        assert son['date'] == '2015-01-02'
+        assert son['data'] == raw
+
+        assert obj.date == datetime.date(2015, 1, 2)
+        assert obj.data == {'foo': 1}
+        assert obj._data['date'] == datetime.date(2015, 1, 2)
+        assert not obj._get_changed_fields()
+
+    def test_get_stored_types(self):
+        assert docs.get_stored_types(fields.IntegerField()) == (int,)
+        assert docs.get_stored_types(fields.IdField()) == (docs.ObjectId,)
+        assert docs.get_stored_types(fields.DateField()) == ()
+        assert docs.get_stored_types(fields.IntervalField()) == ()
+
+    def test_from_son_hydration(self):
+        from bson import ObjectId
+
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+            count = fields.IntegerField(name='cnt')
+
+        assert MyModel._get_init_keys() >= {'id', 'name', 'count'}
+        # Plan is built before patching, as stored types depend on
+        # `to_python` of fields
+        MyModel._get_hydration_plan()
+        _id = ObjectId()
+        with patch.object(fields.IntegerField, 'to_python') as mock_conv:
+            obj = MyModel._from_son({
+                '_id': _id, 'name': u'foo', 'cnt': 1, 'unknown': 2})
+        assert not mock_conv.called
+        assert obj.id == _id
+        assert obj.name == u'foo'
+        assert obj.count == 1
+        assert not obj._created
+        assert not obj._get_changed_fields()
+
+        obj = MyModel._from_son({'_id': str(_id), 'cnt': '2'})
+        assert obj.id == _id
+        assert obj.count == 2
+
+    def test_hydrate_matches_mongoengine(self):
+        import datetime
+        from bson import ObjectId
+
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+            title = fields.UnicodeField(default=u'untitled')
+            count = fields.IntegerField(name='cnt')
+            total = fields.BigIntegerField()
+            rank = fields.SmallIntegerField()
+            price = fields.FloatField()
+            amount = fields.DecimalField()
+            active = fields.BooleanField(default=False)
+            status = fields.ChoiceField(choices=['active', 'inactive'])
+            created_at = fields.DateTimeField(default=datetime.datetime.now)
+            birthday = fields.DateField()
+            start_time = fields.TimeField()
+            interval = fields.IntervalField()
+            data = fields.BinaryField()
+            tags = fields.ListField(
+                item_type=fields.StringField, field=fields.StringField())
+            settings = fields.DictField()
+            other_id = fields.IdField()
+
+        now = datetime.datetime(2015, 1, 2, 3, 4, 5)
+        sons = [
+            {'_id': ObjectId(), 'name': u'foo', 'title': u'bar', 'cnt': 1,
+             'total': 2, 'rank': 3, 'price': 1.5, 'amount': '1.50',
+             'active': True, 'status': u'active', 'created_at': now,
+             'birthday': '2015-01-02', 'start_time': '03:04:05',
+             'interval': 60, 'data': b'raw', 'tags': [u'a', u'b'],
+             'settings': {'a': {'b': 1}}, 'other_id': ObjectId(),
+             'unknown': 1},
+            {'_id': str(ObjectId()), 'name': 'foo', 'cnt': '2',
+             'price': 2, 'active': 1, 'created_at': '2015-01-02T03:04:05',
+             'tags': [], 'settings': {}, 'other_id': str(ObjectId())},
+            {'_id': ObjectId(), 'name': None, 'cnt': None, 'price': None,
+             'tags': None},
+        ]
+        for son in sons:
+            for created in (False, True):
+                expected = super(docs.BaseDocument, MyModel)._from_son(
+                    son, created=created)
+                obj = MyModel._hydrate(son, created=created)
+                for name in MyModel._fields:
+                    value = obj._data.get(name)
+                    expected_value = expected._data.get(name)
+                    if name == 'created_at' and 'created_at' not in son:
+                        # Defaults are called on init
+                        continue
+                    assert value == expected_value, name
+                    assert type(value) is type(expected_value), name
+                assert obj._created == expected._created
+                assert obj._get_changed_fields() == \
+                    expected._get_changed_fields()
+                assert set(obj._data) == set(expected._data)
+
+    def test_reset_fields_cache(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        MyModel._get_init_keys()
+        MyModel._get_hydration_plan()
+        MyModel._reset_fields_cache()
+        assert '_init_keys' not in MyModel.__dict__
+        assert '_hydration_plan' not in MyModel.__dict__
+
+    def test_get_changed_field_items(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+            tags = fields.ListField(
+                item_type=fields.StringField, field=fields.StringField())
+
+        obj = MyModel(name='foo', tags=['a', 'b'])
+        obj._created = False
+        obj._clear_changed_fields()
+        obj.tags[1] = 'c'
+        obj.name = 'bar'
+        assert obj._get_changed_field_items() == {
+            'tags': set([1]),
+            'name': None,
+        }
+
+    def test_save_validate_changed(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        obj = MyModel(name='foo')
+        obj._created = False
+        obj.validate_changed = Mock()
+        with patch.object(docs.mongo.Document, 'save') as mock_save:
+            obj.save(validate_changed=True)
+        obj.validate_changed.assert_called_once_with()
+        mock_save.assert_called_once_with(
+            force_insert=False, validate=False)
+
     def test_get_null_values(self):
         class MyModel1(docs.BaseDocument):
             name = fields.StringField(primary_key=True)
@@ -260,3 +1192,107 @@ class TestBaseDocument(object):
             'id': 'foo',
             'name': 'foo',
         }
+
+    def _counted_models(self):
+        from bson import ObjectId
+
+        class CountedChild(docs.BaseDocument):
+            name = fields.StringField()
+
+        class CountedParent(docs.BaseDocument):
+            children = fields.Relationship(
+                document='CountedChild', counter='children_count')
+
+        children = [CountedChild(id=ObjectId()) for _ in range(3)]
+        return CountedParent, children
+
+    def test_relationship_counter(self):
+        from bson import ObjectId
+        Parent, children = self._counted_models()
+        assert isinstance(Parent._fields['children_count'],
+                          fields.IntegerField)
+        obj = Parent(children=children[:2])
+        assert obj.children_count == 2
+        assert obj.to_dict()['children_count'] == 2
+
+        loaded = Parent._from_son({
+            '_id': ObjectId(), 'children': [], 'children_count': 5})
+        assert loaded.children_count == 5
+        loaded.children = children
+        assert loaded.children_count == 3
+        assert 'children_count' in loaded._get_changed_fields()
+
+    @patch.object(docs, 'on_bulk_update')
+    def test_update_counted_relationship(self, mock_update):
+        from bson import ObjectId
+        Parent, children = self._counted_models()
+        obj = Parent._from_son({'_id': ObjectId(), 'children_count': 0})
+        collection = Mock()
+        collection.find_and_modify.return_value = {
+            'children': [children[0].pk], 'children_count': 1}
+        with patch.object(Parent, '_get_collection', return_value=collection):
+            obj._update_counted_relationship('children', children[0])
+        collection.find_and_modify.assert_called_once_with(
+            query={'_id': obj.pk, 'children': {'$ne': children[0].pk}},
+            update={'$push': {'children': children[0].pk},
+                    '$inc': {'children_count': 1}},
+            new=True, fields={'children': True, 'children_count': True})
+        assert obj.children_count == 1
+        assert len(obj._data['children']) == 1
+        mock_update.assert_called_once_with(Parent, [obj], None)
+
+        mock_update.reset_mock()
+        collection.find_and_modify.return_value = None
+        with patch.object(Parent, '_get_collection', return_value=collection):
+            obj._update_counted_relationship(
+                'children', children[1], add=False)
+        assert obj.children_count == 1
+        assert not mock_update.called
+
+    @patch.object(docs, 'on_bulk_update')
+    def test_remove_from_counted_relationships(self, mock_update):
+        Parent, children = self._counted_models()
+        Child = type(children[0])
+        collection = Mock()
+        collection.find.return_value = [{'_id': 1}]
+        bulk = collection.initialize_unordered_bulk_op()
+        with patch.object(docs, 'get_counted_relationships',
+                          return_value=[(Parent, 'children')]):
+            with patch.object(Parent, '_get_collection',
+                              return_value=collection):
+                with patch.object(Parent, 'objects') as mock_objects:
+                    Child._remove_from_counted_relationships(children[:2])
+        collection.find.assert_called_once_with(
+            {'children': {'$in': [children[0].pk, children[1].pk]}},
+            {'_id': True})
+        bulk.find.assert_any_call({'children': children[1].pk})
+        bulk.find().update.assert_called_with({
+            '$pull': {'children': children[1].pk},
+            '$inc': {'children_count': -1}})
+        assert bulk.execute.call_count == 1
+        mock_objects.assert_called_once_with(pk__in=[1])
+        mock_update.assert_called_once_with(
+            Parent, mock_objects(), None)
+
+    @patch('nefertari_mongodb.metaclasses.setup_es_signals_for')
+    def test_es_index_disabled(self, mock_setup):
+        class MyModel1(docs.ESBaseDocument):
+            name = fields.StringField()
+
+        class MyModel2(docs.ESBaseDocument):
+            _index_enabled = False
+            meta = {'allow_inheritance': True}
+            name = fields.StringField()
+
+        class MyModel3(MyModel2):
+            pass
+
+        class MyModel4(MyModel2):
+            _index_enabled = True
+
+        assert MyModel1._index_enabled
+        assert not MyModel2._index_enabled
+        assert not MyModel3._index_enabled
+        assert MyModel4._index_enabled
+        assert mock_setup.call_args_list == [
+            call(MyModel1), call(MyModel4)]
@@ -0,0 +1,97 @@
+import datetime
+
+import dateutil.tz
+from bson import ObjectId
+from mock import MagicMock, patch
+
+from .. import fields
+
+
+class TestParsing(object):
+
+    def test_parse_datetime_date(self):
+        assert fields.parse_datetime('2015-01-02') == datetime.datetime(
+            2015, 1, 2)
+
+    def test_parse_datetime_utc(self):
+        value = fields.parse_datetime('2015-01-02T12:30:05Z')
+        assert value == datetime.datetime(
+            2015, 1, 2, 12, 30, 5, tzinfo=dateutil.tz.tzutc())
+
+    @patch('nefertari_mongodb.fields.dateutil.parser.parse')
+    def test_parse_datetime_fallback(self, mock_parse):
+        fields.parse_datetime('Jan 2 2015', dayfirst=False)
+        fields.parse_datetime('2015-02-30')
+        mock_parse.assert_any_call('Jan 2 2015', dayfirst=False)
+        mock_parse.assert_any_call('2015-02-30')
+
+    def test_parse_time(self):
+        assert fields.parse_time('12:30:05') == datetime.time(12, 30, 5)
+        assert fields.parse_time('12:30') == datetime.time(12, 30)
+
+    def test_date_field_conversion(self):
+        field = fields.DateField()
+        assert field.to_python('2015-01-02') == datetime.date(2015, 1, 2)
+        assert field.to_mongo('2015-01-02T12:30:05Z') == '2015-01-02'
+
+    def test_datetime_field_to_mongo(self):
+        field = fields.DateTimeField()
+        assert field.to_mongo('2015-01-02') == datetime.datetime(2015, 1, 2)
+        assert field.to_mongo('foo') is None
+
+
+class TestCaseInsensitiveStringField(object):
+
+    def _model(self):
+        from .. import documents as docs
+
+        class MyModel(docs.BaseDocument):
+            email = fields.CaseInsensitiveStringField(
+                name='mail', unique=True)
+        return MyModel
+
+    def test_normalize_case(self):
+        assert fields.normalize_case(u'Foo@Bar') == u'foo@bar'
+        assert fields.normalize_case(None) is None
+
+    def test_shadow_index(self):
+        specs = self._model()._meta['index_specs']
+        assert {'fields': [('_mail_normalized', 1)], 'unique': True,
+                'sparse': False} in specs
+
+    def test_to_mongo(self):
+        obj = self._model()(email=u'Foo@Bar')
+        son = obj.to_mongo()
+        assert son['mail'] == u'Foo@Bar'
+        assert son['_mail_normalized'] == u'foo@bar'
+
+    def test_backfill(self):
+        model = self._model()
+        ids = [ObjectId(), ObjectId()]
+        db = MagicMock()
+        collection = db.__getitem__.return_value
+        collection.find.return_value = [
+            {'_id': ids[0], 'mail': u'Foo@Bar'},
+            {'_id': ids[1], 'mail': u'bar@baz'}]
+        bulk = collection.initialize_unordered_bulk_op.return_value
+        with patch.object(model, '_get_db', return_value=db):
+            assert model.backfill_case_insensitive_fields(chunk_size=1) == 2
+        collection.find.assert_called_once_with(
+            {'$or': [{'mail': {'$type': 2},
+                      '_mail_normalized': {'$exists': False}}]},
+            {'mail': True})
+        db.__getitem__.assert_called_once_with('my_model')
+        bulk.find.assert_any_call({'_id': ids[0]})
+        bulk.find().update_one.assert_any_call(
+            {'$set': {'_mail_normalized': u'foo@bar'}})
+        assert bulk.execute.call_count == 2
+
+    def test_delta(self):
+        model = self._model()
+        obj = model._from_son({'_id': ObjectId(), 'mail': u'foo@bar'})
+        obj.email = u'Foo@Baz'
+        assert obj._delta()[0] == {
+            'mail': u'Foo@Baz', '_mail_normalized': u'foo@baz'}
+        obj._clear_changed_fields()
+        obj.email = None
+        assert obj._delta()[1] == {'mail': 1, '_mail_normalized': 1}
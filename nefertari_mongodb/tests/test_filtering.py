@@ -0,0 +1,98 @@
+import pytest
+
+from .. import documents as docs
+from .. import fields
+from .. import filtering
+
+
+def _model():
+    class MyModel(docs.BaseDocument):
+        id = fields.IntegerField(primary_key=True)
+        name = fields.StringField()
+        count = fields.IntegerField()
+        tags = fields.ListField(item_type=fields.StringField)
+        parent = fields.Relationship(document='MyModel')
+    return MyModel
+
+
+def _objects(model):
+    return [
+        model(id=1, name='a', count=3, tags=['x', 'y']),
+        model(id=2, name='b', count=1, tags=['y']),
+        model(id=3, name='c', count=None, tags=[]),
+    ]
+
+
+class TestFiltering(object):
+
+    def _ids(self, documents):
+        return [doc.id for doc in documents]
+
+    def test_equality_and_comparisons(self):
+        model = _model()
+        objects = _objects(model)
+        filter_ = filtering.filter_documents
+        assert self._ids(filter_(model, objects, {'name': 'b'})) == [2]
+        assert self._ids(filter_(model, objects, {'count__gt': '1'})) == [1]
+        assert self._ids(filter_(model, objects, {'count__lte': 3})) == [1, 2]
+        assert self._ids(filter_(model, objects, {'name__ne': 'a'})) == [2, 3]
+
+    def test_list_operators(self):
+        model = _model()
+        objects = _objects(model)
+        filter_ = filtering.filter_documents
+        assert self._ids(filter_(model, objects, {'tags': 'y'})) == [1, 2]
+        assert self._ids(filter_(
+            model, objects, {'tags__all': ['x', 'y']})) == [1]
+        assert self._ids(filter_(
+            model, objects, {'name__in': ['a', 'c']})) == [1, 3]
+        assert self._ids(filter_(
+            model, objects, {'tags__nin': ['x']})) == [2, 3]
+
+    def test_drops_duplicates(self):
+        model = _model()
+        objects = _objects(model)
+        result = filtering.filter_documents(model, objects + objects, {})
+        assert self._ids(result) == [1, 2, 3]
+
+    def test_sort(self):
+        model = _model()
+        objects = _objects(model)
+        result = filtering.filter_documents(
+            model, objects, {}, _sort=['count'])
+        assert self._ids(result) == [3, 2, 1]
+        result = filtering.filter_documents(
+            model, objects, {}, _sort=['-count'])
+        assert self._ids(result) == [1, 2, 3]
+
+    @pytest.mark.parametrize('params', [
+        {'name__contains': 'a'},
+        {'parent': 1},
+        {'name__foo': 'a'},
+        {'count': 'foo'},
+    ])
+    def test_unsupported(self, params):
+        model = _model()
+        with pytest.raises(filtering.UnsupportedQuery):
+            filtering.filter_documents(model, _objects(model), params)
+
+    def test_unsupported_values(self):
+        import datetime
+        from bson.tz_util import utc
+        naive = datetime.datetime(2015, 1, 1)
+        aware = naive.replace(tzinfo=utc)
+        with pytest.raises(filtering.UnsupportedQuery):
+            filtering._match(None, naive, aware)
+        with pytest.raises(filtering.UnsupportedQuery):
+            filtering._match('in', [naive], [aware])
+        with pytest.raises(filtering.UnsupportedQuery):
+            filtering._match('gt', aware, naive)
+        with pytest.raises(filtering.UnsupportedQuery):
+            filtering._match('gt', {'a': 1}, 1)
+        assert filtering._match('gt', aware, aware - datetime.timedelta(1))
+
+    def test_unsupported_sort(self):
+        model = _model()
+        with pytest.raises(filtering.UnsupportedQuery):
+            filtering.filter_documents(
+                model, _objects(model), {}, _sort=['tags'])
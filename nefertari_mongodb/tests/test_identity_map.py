@@ -0,0 +1,156 @@
+from bson import ObjectId
+from mock import Mock, patch
+
+from .. import documents as docs
+from .. import fields
+from .. import identity_map as imap
+
+
+class TestIdentityMap(object):
+
+    def test_add_get(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        pk = ObjectId()
+        obj = MyModel(id=pk, name='foo')
+        identity_map = imap.IdentityMap()
+        assert identity_map.add(obj) is obj
+        assert identity_map.get(MyModel, pk) is obj
+        assert identity_map.add(MyModel(id=pk, name='bar')) is obj
+        assert len(identity_map) == 1
+        identity_map.discard(obj)
+        assert identity_map.get(MyModel, pk) is None
+
+    def test_add_no_pk(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        identity_map = imap.IdentityMap()
+        identity_map.add(MyModel(name='foo'))
+        assert len(identity_map) == 0
+
+    def test_lru_eviction(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        objects = [MyModel(id=ObjectId()) for _ in range(3)]
+        identity_map = imap.IdentityMap(maxsize=2)
+        identity_map.add(objects[0])
+        identity_map.add(objects[1])
+        identity_map.get(MyModel, objects[0].pk)
+        identity_map.add(objects[2])
+        assert (MyModel, objects[0].pk) in identity_map
+        assert (MyModel, objects[1].pk) not in identity_map
+        assert (MyModel, objects[2].pk) in identity_map
+
+    def test_discard_model(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        class MyModel2(docs.BaseDocument):
+            name = fields.StringField()
+
+        identity_map = imap.IdentityMap()
+        identity_map.add(MyModel(id=ObjectId()))
+        obj = identity_map.add(MyModel2(id=ObjectId()))
+        identity_map.discard_model(MyModel)
+        assert list(identity_map._documents.values()) == [obj]
+
+    def test_identity_map_scope(self):
+        assert imap.get_identity_map() is None
+        with imap.identity_map_scope(maxsize=5) as identity_map:
+            assert imap.get_identity_map() is identity_map
+            assert identity_map.maxsize == 5
+            with imap.identity_map_scope() as nested:
+                assert imap.get_identity_map() is nested
+            assert imap.get_identity_map() is identity_map
+        assert imap.get_identity_map() is None
+
+    def test_tween(self):
+        registry = Mock(settings={'mongodb.identity_map.maxsize': '10'})
+        handler = Mock(side_effect=lambda request: imap.get_identity_map())
+        tween = imap.identity_map_tween_factory(handler, registry)
+        identity_map = tween(Mock())
+        assert identity_map.maxsize == 10
+        assert imap.get_identity_map() is None
+
+
+class TestDocumentsIdentityMap(object):
+
+    def test_from_son_mapped(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        son = {'_id': ObjectId(), 'name': 'foo'}
+        with imap.identity_map_scope():
+            obj1 = MyModel._from_son(son)
+            obj2 = MyModel._from_son(dict(son, name='bar'))
+            assert obj1 is obj2
+            assert obj1.name == 'bar'
+            partial = MyModel._from_son(son, only_fields=['name'])
+            assert partial is not obj1
+        assert MyModel._from_son(son) is not obj1
+
+    def test_from_son_refresh_keeps_changes(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+            status = fields.StringField()
+
+        son = {'_id': ObjectId(), 'name': 'foo', 'status': 'new'}
+        with imap.identity_map_scope():
+            obj = MyModel._from_son(son)
+            obj.name = 'changed'
+            assert MyModel._from_son(
+                dict(son, name='bar', status='done')) is obj
+            assert obj.name == 'changed'
+            assert obj.status == 'done'
+
+    def test_reload_not_mapped(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        def reload(self, *fields, **kwargs):
+            assert imap.get_identity_map() is None
+            return self
+
+        with imap.identity_map_scope() as identity_map:
+            obj = MyModel._from_son({'_id': ObjectId(), 'name': 'foo'})
+            with patch.object(docs.mongo.Document, 'reload', reload):
+                assert obj.reload() is obj
+            assert imap.get_identity_map() is identity_map
+
+    def test_apply_fields_exclude_not_mapped(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+            status = fields.StringField()
+
+        query_set = Mock()
+        query_set.exclude.return_value._loaded_fields.as_dict.\
+            return_value = {'status': 0}
+        query_set = MyModel.apply_fields(query_set, ['-status'])
+        assert sorted(query_set.only_fields) == ['id', 'name']
+
+    def test_get_item_mapped(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        pk = ObjectId()
+        with imap.identity_map_scope():
+            obj = MyModel._from_son({'_id': pk, 'name': 'foo'})
+            with patch.object(MyModel, 'get_collection') as get_coll:
+                assert MyModel.get_item(id=str(pk)) is obj
+                assert MyModel.get_item(
+                    id=pk, **{'__raise_on_empty': False}) is obj
+                assert not get_coll.called
+                MyModel.get_item(id=pk, name='foo')
+                assert get_coll.called
+
+    def test_get_item_not_mapped(self):
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+
+        with imap.identity_map_scope():
+            assert MyModel._get_mapped_item({'id': 'invalid'}) is None
+            assert MyModel._get_mapped_item({'id': ObjectId()}) is None
+        assert MyModel._get_mapped_item({'id': ObjectId()}) is None
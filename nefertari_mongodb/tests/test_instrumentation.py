@@ -0,0 +1,142 @@
+import pytest
+from mock import Mock, patch
+
+from .. import instrumentation as instr
+
+
+class TestHistogram(object):
+
+    def test_observe(self):
+        hist = instr.Histogram(buckets=(1, 10, 100))
+        for value in (0.5, 5, 5, 50, 500):
+            hist.observe(value)
+        assert hist.counts == [1, 2, 1, 1]
+        assert hist.count == 5
+        assert hist.sum == 560.5
+
+    def test_quantile(self):
+        hist = instr.Histogram(buckets=(1, 10, 100))
+        assert hist.quantile(0.5) is None
+        for value in (0.5, 5, 5, 50):
+            hist.observe(value)
+        assert hist.quantile(0.5) == 10
+        assert hist.quantile(1) == 100
+        hist.observe(500)
+        assert hist.quantile(1) == float('inf')
+
+
+class TestSinks(object):
+
+    def test_memory_sink(self):
+        sink = instr.MemorySink()
+        sink.increment('command', tags={'model': 'Story'})
+        sink.increment('command', 2, tags={'model': 'Story'})
+        sink.observe('command.duration', 3, tags={'model': 'Story'})
+        assert sink.get_counter('command', model='Story') == 3
+        assert sink.get_counter('command', model='User') == 0
+        assert sink.get_histogram('command.duration', model='Story').count == 1
+
+    def test_statsd_sink(self):
+        client = Mock()
+        sink = instr.StatsdSink(client)
+        sink.increment(
+            'command', tags={'model': 'Story', 'operation': 'find'})
+        client.incr.assert_called_once_with('mongo.command.Story.find', 1)
+        sink.observe('request.commands', 4, tags={'route': None})
+        client.timing.assert_called_once_with('mongo.request.commands', 4)
+
+
+class TestCommandRecorder(object):
+
+    def _recorder(self):
+        recorder = instr.CommandRecorder(instr.MemorySink())
+        recorder._models = {'story': 'Story'}
+        return recorder
+
+    def test_record(self):
+        recorder = self._recorder()
+        recorder.record('story', 'find', 2.5)
+        sink = recorder.sink
+        assert sink.get_counter(
+            'command', model='Story', operation='find') == 1
+        assert sink.get_histogram(
+            'command.duration', model='Story', operation='find').sum == 2.5
+        assert instr.get_request_stats() is None
+
+    def test_record_request(self):
+        recorder = self._recorder()
+        listener = Mock()
+        recorder.listeners.append(listener)
+        request = Mock()
+        request.matched_route.name = 'stories'
+        stats = recorder.start_request(request)
+        recorder.record('story', 'find', 2, query={'name': 'foo'})
+        recorder.record('story', 'count', 1, failed=True)
+        assert instr.get_request_stats() is stats
+        assert stats.count == 2
+        assert stats.duration == 3
+        assert stats.commands[0] == instr.CommandRecord(
+            'Story', 'story', 'find', 2, False, {'name': 'foo'})
+        assert listener.call_count == 2
+
+        assert recorder.finish_request() is stats
+        assert instr.get_request_stats() is None
+        hist = recorder.sink.get_histogram(
+            'request.commands', route='stories')
+        assert hist.sum == 2
+
+    def test_finish_failed_request(self):
+        recorder = self._recorder()
+        listener = Mock(side_effect=ValueError)
+        recorder.finish_listeners.append(listener)
+        stats = recorder.start_request(Mock())
+        assert recorder.finish_request(failed=True) is stats
+        listener.assert_called_once_with(stats)
+        recorder.start_request(Mock())
+        with pytest.raises(ValueError):
+            recorder.finish_request()
+
+    def test_request_stats(self):
+        stats = instr.RequestStats()
+        with instr.request_stats(stats):
+            assert instr.get_request_stats() is stats
+        assert instr.get_request_stats() is None
+
+    def test_background_call_stats(self):
+        from ..utils import BackgroundCall
+        recorder = self._recorder()
+        stats = recorder.start_request(Mock())
+        call = BackgroundCall(recorder.record, 'story', 'count', 1)
+        call.result()
+        assert stats.count == 1
+        recorder.finish_request()
+
+    def test_target_collection(self):
+        collection = Mock(spec=instr.Collection)
+        assert instr._target_collection(collection) is collection
+        cursor = Mock(spec=instr.CommandCursor)
+        cursor._CommandCursor__collection = collection
+        assert instr._target_collection(cursor) is collection
+        bulk = Mock(spec=instr.BulkOperationBuilder)
+        bulk._BulkOperationBuilder__bulk = Mock(collection=collection)
+        assert instr._target_collection(bulk) is collection
+
+    @patch.object(instr, 'get_recorder')
+    def test_tween(self, mock_get):
+        recorder = mock_get.return_value
+        handler = Mock()
+        tween = instr.instrumentation_tween_factory(handler, None)
+        request = Mock()
+        assert tween(request) is handler.return_value
+        recorder.start_request.assert_called_once_with(request)
+        recorder.finish_request.assert_called_once_with()
+        assert request.mongo_stats is recorder.start_request.return_value
+
+    @patch.object(instr, 'get_recorder')
+    def test_tween_handler_error(self, mock_get):
+        recorder = mock_get.return_value
+        handler = Mock(side_effect=ValueError)
+        tween = instr.instrumentation_tween_factory(handler, None)
+        with pytest.raises(ValueError):
+            tween(Mock())
+        recorder.finish_request.assert_called_once_with(failed=True)
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+from mock import Mock, patch
+
+from .. import query_budget as qb
+from ..instrumentation import RequestStats, CommandRecord
+
+
+def make_record(query, collection='story', operation='find'):
+    return CommandRecord('Story', collection, operation, 1, False, query)
+
+
+class TestQueryBudget(object):
+
+    def test_query_shape(self):
+        shape1 = qb.query_shape({'_id': 1, 'tags': {'$in': [1, 2]}})
+        shape2 = qb.query_shape({'tags': {'$in': [3]}, '_id': 2})
+        assert shape1 == shape2
+        assert shape1 != qb.query_shape({'_id': 1})
+        assert qb.query_shape(None) == '?'
+        assert qb.query_shape({'$or': [{'a': 1}, {'b': 2}]}) == (
+            ('$or', ((('a', '?'),), (('b', '?'),))),)
+
+    def test_get_call_site(self):
+        filename, lineno, func = qb.get_call_site(())
+        assert func == 'get_call_site'
+        module_path = os.path.splitext(os.path.abspath(qb.__file__))[0]
+        filename, lineno, func = qb.get_call_site((module_path,))
+        assert func == 'test_get_call_site'
+
+    def _run(self, budget, queries):
+        stats = RequestStats(Mock(url='/stories'))
+        for query in queries:
+            record = make_record(query)
+            stats.commands.append(record)
+            budget.on_command(stats, record)
+        return stats
+
+    @patch.object(qb, 'get_call_site')
+    def test_repeated_query(self, mock_site):
+        mock_site.return_value = ('views.py', 10, 'index')
+        budget = qb.QueryBudget(max_queries=100, max_repeats=2)
+        stats = self._run(budget, [{'_id': i} for i in range(4)])
+        assert len(stats.query_violations) == 1
+        violation = stats.query_violations[0]
+        assert violation.kind == 'repeated_query'
+        assert violation.call_site == ('views.py', 10, 'index')
+        budget.on_request_finished(stats)
+        assert violation.count == 4
+        assert 'repeated 4 times' in str(violation)
+        assert 'views.py:10 in index' in str(violation)
+
+    @patch.object(qb, 'get_call_site')
+    def test_max_queries_raise(self, mock_site):
+        mock_site.return_value = None
+        budget = qb.QueryBudget(max_queries=2, max_repeats=10, mode='raise')
+        stats = self._run(budget, [{'a': 1}, {'b': 1}, {'c': 1}])
+        with pytest.raises(qb.QueryBudgetExceeded) as ex:
+            budget.on_request_finished(stats)
+        assert 'more than 2 queries' in str(ex.value)
+
+    def test_no_violations(self):
+        budget = qb.QueryBudget(max_queries=2, max_repeats=2, mode='raise')
+        stats = self._run(budget, [{'a': 1}])
+        budget.on_request_finished(stats)
+
+    def test_query_budget_exceeded_view(self):
+        from nefertari.json_httpexceptions import JHTTPInternalServerError
+        stats = self._run(
+            qb.QueryBudget(max_queries=2, max_repeats=10), [{'a': 1}] * 3)
+        ex = qb.QueryBudgetExceeded(stats.query_violations)
+        response = qb.query_budget_exceeded_view(ex, Mock(url='/stories'))
+        assert isinstance(response, JHTTPInternalServerError)
+        assert 'more than 2 queries' in response.detail
+
+    def test_invalid_mode(self):
+        with pytest.raises(ValueError):
+            qb.QueryBudget(mode='foo')
@@ -0,0 +1,78 @@
+import pytest
+from mock import Mock, patch
+from nefertari.json_httpexceptions import JHTTPBadRequest, JHTTPForbidden
+
+from .. import documents as docs
+from .. import fields
+from .. import query_hints as qh
+
+
+def _model():
+    class MyModel(docs.BaseDocument):
+        meta = {'indexes': [('username', '-created_at'), 'tags']}
+        username = fields.StringField(name='login')
+        created_at = fields.DateTimeField()
+        tags = fields.ListField(item_type=fields.StringField)
+        bio = fields.StringField()
+    return MyModel
+
+
+def _query_set(query, projection, ordering=()):
+    query_set = Mock(_query=query, _ordering=list(ordering))
+    query_set._loaded_fields.as_dict.return_value = projection
+    return query_set
+
+
+class TestQueryHints(object):
+
+    def test_parse_hint(self):
+        model = _model()
+        assert qh.parse_hint(model, 'username,-created_at') == [
+            ('login', 1), ('created_at', -1)]
+        assert qh.parse_hint(model, ['id']) == [('_id', 1)]
+        assert qh.parse_hint(model, [('login', 1)]) == [('login', 1)]
+        with pytest.raises(JHTTPBadRequest):
+            qh.parse_hint(model, 'foo')
+
+    @patch.object(qh, 'get_current_request')
+    def test_check_request_hint(self, mock_request):
+        mock_request.return_value = None
+        qh.check_request_hint()
+        request = mock_request.return_value = Mock()
+        request.registry.settings = {}
+        request.effective_principals = ['system.Everyone', 'g:admin']
+        qh.check_request_hint()
+        request.effective_principals = ['system.Everyone']
+        with pytest.raises(JHTTPForbidden):
+            qh.check_request_hint()
+
+    def test_get_covering_indexes(self):
+        assert qh.get_covering_indexes(_model()) == [
+            {'login', 'created_at'}]
+
+    def test_apply_covered_projection(self):
+        model = _model()
+        query_set = _query_set(
+            {'login': 'foo'}, {'created_at': 1}, [('created_at', -1)])
+        result = qh.apply_covered_projection(model, query_set)
+        query_set.exclude.assert_called_once_with('id')
+        assert result is query_set.exclude()
+
+    def test_apply_covered_projection_not_covered(self):
+        model = _model()
+        for query_set in [
+                _query_set({'login': 'foo'}, {'bio': 1}),
+                _query_set({'bio': 'foo'}, {'login': 1}),
+                _query_set({'login': 'foo'}, {'login': 1, '_id': 1}),
+                _query_set({'login': 'foo'}, {'created_at': 0}),
+                _query_set({'login': {'$exists': True}}, {'login': 1}),
+                _query_set({'login': 'foo'}, {'login': 1}, [('bio', 1)])]:
+            result = qh.apply_covered_projection(model, query_set)
+            assert result is query_set
+            assert not query_set.exclude.called
+
+    def test_apply_covered_projection_hint(self):
+        model = _model()
+        query_set = _query_set({'login': 'foo'}, {'login': 1})
+        qh.apply_covered_projection(model, query_set, hint=[('tags', 1)])
+        assert not query_set.exclude.called
@@ -0,0 +1,76 @@
+import pytest
+from mock import Mock, patch
+from nefertari.json_httpexceptions import (
+    JHTTPBadRequest, JHTTPServiceUnavailable)
+
+from .. import query_limits as ql
+
+
+class TestQueryLimits(object):
+
+    @patch.dict(ql._settings)
+    def test_configure(self):
+        settings = ql._settings
+        ql.configure({
+            'mongodb.max_time_ms': '1000',
+            'mongodb.allow_disk_use': 'true',
+        })
+        assert settings == {
+            'max_time_ms': 1000,
+            'max_time_ms_limit': None,
+            'allow_disk_use': True,
+        }
+
+    @patch.dict(ql._settings)
+    def test_get_max_time_ms_default(self):
+        settings = ql._settings
+        assert ql.get_max_time_ms(Mock(_max_time_ms=None)) is None
+        settings['max_time_ms'] = 1000
+        assert ql.get_max_time_ms(Mock(_max_time_ms=None)) == 1000
+        assert ql.get_max_time_ms(Mock(_max_time_ms=200)) == 200
+
+    @patch.dict(ql._settings)
+    def test_get_max_time_ms_requested(self):
+        settings = ql._settings
+        model = Mock(_max_time_ms=200)
+        assert ql.get_max_time_ms(model, '100') == 100
+        assert ql.get_max_time_ms(model, '5000') == 200
+        settings['max_time_ms_limit'] = 3000
+        assert ql.get_max_time_ms(model, '5000') == 3000
+        assert ql.get_max_time_ms(Mock(_max_time_ms=None), 0) == 3000
+        with pytest.raises(JHTTPBadRequest):
+            ql.get_max_time_ms(model, 'foo')
+        with pytest.raises(JHTTPBadRequest):
+            ql.get_max_time_ms(model, -1)
+
+    @patch.dict(ql._settings)
+    def test_get_allow_disk_use(self):
+        settings = ql._settings
+        assert not ql.get_allow_disk_use(Mock(_allow_disk_use=False), 'true')
+        assert ql.get_allow_disk_use(Mock(_allow_disk_use=True))
+        settings['allow_disk_use'] = True
+        assert ql.get_allow_disk_use(Mock(_allow_disk_use=False), 'true')
+        assert not ql.get_allow_disk_use(Mock(_allow_disk_use=True), 'false')
+
+    def test_aggregate_options(self):
+        assert ql.aggregate_options() == {}
+        assert ql.aggregate_options(100, True) == {
+            'maxTimeMS': 100, 'allowDiskUse': True}
+
+    def test_apply_max_time_ms(self):
+        query_set = Mock()
+        assert ql.apply_max_time_ms(query_set, None) is query_set
+        assert not query_set._cursor.max_time_ms.called
+        ql.apply_max_time_ms(query_set, 100)
+        query_set._cursor.max_time_ms.assert_called_once_with(100)
+
+    def test_raise_timeout(self):
+        model = Mock(__name__='Story')
+        with pytest.raises(JHTTPServiceUnavailable) as ex:
+            ql.raise_timeout(model, ql.ExecutionTimeout('timeout'))
+        assert 'Story' in ex.value.detail
+
+    def test_execution_timeout_view(self):
+        response = ql.execution_timeout_view(
+            ql.ExecutionTimeout('timeout'), Mock())
+        assert isinstance(response, JHTTPServiceUnavailable)
@@ -0,0 +1,209 @@
+import datetime
+
+import pytest
+from mock import Mock, MagicMock, patch
+from pymongo.errors import OperationFailure
+
+from .. import reindex
+
+
+class FakeCheckpoints(object):
+
+    def __init__(self, data=None):
+        self.data = dict(data or {})
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def keys(self, prefix=''):
+        return [key for key in self.data if key.startswith(prefix)]
+
+
+class TestSplitting(object):
+
+    def test_thin(self):
+        assert reindex._thin([1, 2], 4) == [1, 2]
+        assert reindex._thin(list(range(1, 11)), 4) == [2, 5, 8]
+
+    def test_split_vector_bounds(self):
+        collection = Mock()
+        collection.database.command.side_effect = [
+            {'size': 1000},
+            {'splitKeys': [{'_id': 3}, {'_id': 6}]},
+        ]
+        assert reindex.split_vector_bounds(collection, 3) == [3, 6]
+        collection.database.command.assert_called_with(
+            'splitVector', collection.full_name, keyPattern={'_id': 1},
+            maxChunkSizeBytes=333)
+
+    def test_split_vector_bounds_unsupported(self):
+        collection = Mock()
+        collection.database.command.side_effect = OperationFailure('')
+        assert reindex.split_vector_bounds(collection, 3) is None
+
+    def test_sampled_bounds(self):
+        collection = MagicMock()
+        collection.count.return_value = 9
+        cursor = collection.find().sort().skip().limit()
+        cursor.__iter__.side_effect = [
+            iter([{'_id': 3}]), iter([{'_id': 6}])]
+        assert reindex.sampled_bounds(collection, 3) == [3, 6]
+        collection.find().sort().skip.assert_called_with(6)
+
+    @patch.object(reindex, 'split_vector_bounds', return_value=None)
+    @patch.object(reindex, 'sampled_bounds', return_value=[3, 6])
+    def test_split_ranges(self, mock_sampled, mock_split):
+        assert reindex.split_ranges(Mock(), 3) == [
+            (None, 3), (3, 6), (6, None)]
+
+    def test_range_query(self):
+        assert reindex.range_query(None, None) == {}
+        assert reindex.range_query(1, 5) == {'_id': {'$gte': 1, '$lt': 5}}
+        assert reindex.range_query(1, None, start_after=3) == {
+            '_id': {'$gt': 3}}
+
+
+class TestParallelReindex(object):
+
+    def _model(self):
+        model = Mock(__name__='Story')
+        model._get_collection().count.return_value = 4
+        return model
+
+    @patch.object(reindex, 'split_ranges')
+    def test_plan(self, mock_split):
+        mock_split.return_value = [(None, 3), (3, None)]
+        checkpoints = FakeCheckpoints({'reindex:Story:0': reindex.DONE})
+        job = reindex.ParallelReindex(
+            self._model(), processes=2, checkpoints=checkpoints)
+        tasks = job.plan()
+        assert [(t.lower, t.upper, t.start_after) for t in tasks] == [
+            (None, 3, None), (3, None, None)]
+        assert checkpoints.data == {'reindex:Story': [[None, 3], [3, None]]}
+        mock_split.assert_called_once_with(
+            job.model._get_collection(), 8)
+
+    @patch.object(reindex, 'split_ranges')
+    def test_plan_resume(self, mock_split):
+        checkpoints = FakeCheckpoints({
+            'reindex:Story': [[None, 3], [3, 6], [6, None]],
+            'reindex:Story:0': reindex.DONE,
+            'reindex:Story:1': 4,
+        })
+        job = reindex.ParallelReindex(
+            self._model(), checkpoints=checkpoints)
+        tasks = job.plan(resume=True)
+        assert not mock_split.called
+        assert [(t.checkpoint_key, t.start_after) for t in tasks] == [
+            ('reindex:Story:1', 4), ('reindex:Story:2', None)]
+
+    @patch.object(reindex, 'reindex_range', return_value=2)
+    @patch.object(reindex, 'split_ranges')
+    def test_run_single_process(self, mock_split, mock_reindex):
+        mock_split.return_value = [(None, 3), (3, None)]
+        checkpoints = FakeCheckpoints()
+        job = reindex.ParallelReindex(
+            self._model(), processes=1, checkpoints=checkpoints)
+        assert job.run({}) == 4
+        assert mock_reindex.call_count == 2
+        assert checkpoints.data == {}
+
+
+class TestReindexRange(object):
+
+    @patch('nefertari.elasticsearch.ES')
+    @patch('nefertari_mongodb.documents.get_document_cls')
+    def test_reindex_range(self, mock_get, mock_es):
+        model = mock_get.return_value
+        model.__name__ = 'Story'
+        model._fields = {}
+        model._from_son.side_effect = lambda son, only_fields: Mock(
+            to_dict=Mock(return_value=son))
+        cursor = model._get_collection().find().sort().batch_size()
+        cursor.__iter__.return_value = iter(
+            [{'_id': 1}, {'_id': 2}, {'_id': 3}])
+        checkpoints = FakeCheckpoints()
+        progress = MagicMock(value=0)
+        task = reindex.RangeTask('Story', 'reindex:Story:0', None, None,
+                                 batch_size=2)
+        assert reindex.reindex_range(task, checkpoints, progress) == 3
+        es = mock_es()
+        assert es.index.call_count == 2
+        es.index.assert_called_with([{'_id': 3}])
+        assert checkpoints.data == {'reindex:Story:0': reindex.DONE}
+        assert progress.value == 3
+
+
+class TestIncrementalReindex(object):
+
+    def _model(self):
+        from .. import documents as docs
+        from .. import fields
+
+        class MyModel(docs.BaseDocument):
+            name = fields.StringField()
+            created_at = fields.DateTimeField()
+            updated_at = fields.DateTimeField(
+                name='updated', onupdate=datetime.datetime.utcnow)
+        return MyModel
+
+    def test_get_watermark_field(self):
+        model = self._model()
+        assert reindex.get_watermark_field(model) == 'updated_at'
+        with pytest.raises(ValueError):
+            reindex.get_watermark_field(model, 'created_at')
+
+    def test_query(self):
+        job = reindex.IncrementalReindex(
+            self._model(), checkpoints=FakeCheckpoints())
+        assert job.db_field == 'updated'
+        assert job.query(None) == {'updated': {'$ne': None}}
+        assert job.query((1, None)) == {'updated': {'$gte': 1}}
+        assert job.query((1, 'a')) == {'$or': [
+            {'updated': {'$gt': 1}},
+            {'updated': 1, '_id': {'$gt': 'a'}},
+        ]}
+
+    def test_get_watermark_overlap(self):
+        now = datetime.datetime(2016, 1, 1, 12)
+        model = self._model()
+        checkpoints = FakeCheckpoints({
+            'incremental_reindex:MyModel.updated_at': {
+                'timestamp': now, 'id': 'a'}})
+        job = reindex.IncrementalReindex(model, checkpoints=checkpoints)
+        assert job.get_watermark() == (now, 'a')
+        job.overlap = datetime.timedelta(minutes=5)
+        assert job.get_watermark() == (
+            datetime.datetime(2016, 1, 1, 11, 55), None)
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_run(self, mock_es):
+        model = self._model()
+        checkpoints = FakeCheckpoints()
+        job = reindex.IncrementalReindex(
+            model, batch_size=2, checkpoints=checkpoints)
+        batches = [
+            [{'_id': 'a', 'updated': 1}, {'_id': 'b', 'updated': 2}],
+            [{'_id': 'c', 'updated': 2}],
+        ]
+        collection = MagicMock()
+        collection.find().sort().limit.side_effect = batches
+        with patch.object(model, '_get_collection', return_value=collection):
+            with patch.object(model, '_from_son') as mock_from_son:
+                mock_from_son.side_effect = lambda son, only_fields: Mock(
+                    to_dict=Mock(return_value=son))
+                assert job.run() == 3
+        collection.find.assert_called_with({'$or': [
+            {'updated': {'$gt': 2}},
+            {'updated': 2, '_id': {'$gt': 'b'}},
+        ]}, reindex.get_projection(model))
+        assert mock_es().index.call_count == 2
+        assert checkpoints.data == {
+            'incremental_reindex:MyModel.updated_at': {
+                'timestamp': 2, 'id': 'c'}}
@@ -0,0 +1,151 @@
+from mock import Mock, MagicMock, patch, call
+
+from .. import sync
+from .. import signals
+
+
+def make_runner(**kwargs):
+    model = Mock(__name__='Story')
+    model._get_collection_name.return_value = 'story'
+    checkpoints = Mock()
+    checkpoints.get.return_value = None
+    runner = sync.ESSyncRunner([model], checkpoints=checkpoints, **kwargs)
+    return runner, model
+
+
+class FakeSource(object):
+    name = 'fake'
+
+    def __init__(self, changes):
+        self._changes = changes
+
+    def changes(self):
+        for change in self._changes:
+            yield change
+
+
+class TestESSyncRunner(object):
+
+    def test_add_deduplicates(self):
+        runner, model = make_runner()
+        runner.add(sync.Change(sync.INDEX, 'story', 1, 'a'))
+        runner.add(sync.Change(sync.DELETE, 'story', 1, 'b'))
+        runner.add(sync.Change(sync.INDEX, 'story', 2, 'c'))
+        assert runner._pending == {
+            ('story', 1): sync.DELETE, ('story', 2): sync.INDEX}
+        assert runner._token == 'c'
+
+    def test_should_flush(self):
+        runner, model = make_runner(flush_size=2, flush_interval=100)
+        runner.add(sync.Change(sync.INDEX, 'story', 1, 'a'))
+        assert not runner.should_flush()
+        runner.add(sync.Change(sync.INDEX, 'story', 2, 'b'))
+        assert runner.should_flush()
+
+    @patch.object(sync.ESSyncRunner, 'index_changes')
+    def test_flush(self, mock_index):
+        runner, model = make_runner()
+        runner.flush('fake')
+        assert not mock_index.called
+        assert not runner.checkpoints.set.called
+
+        runner.add(sync.Change(sync.INDEX, 'story', 1, 'a'))
+        runner.flush('fake')
+        mock_index.assert_called_once_with({('story', 1): sync.INDEX})
+        runner.checkpoints.set.assert_called_once_with(
+            'es_sync', {'source': 'fake', 'token': 'a'})
+        assert runner._pending == {}
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_index_changes(self, mock_es):
+        runner, model = make_runner()
+        doc = Mock(pk=1)
+        doc.to_dict.return_value = {'id': 1}
+        model.objects.return_value = [doc]
+        runner.index_changes({
+            ('story', 1): sync.INDEX,
+            ('story', 2): sync.INDEX,
+            ('story', 3): sync.DELETE,
+        })
+        mock_es.assert_called_once_with('Story')
+        pks = model.objects.call_args[1]['pk__in']
+        assert sorted(pks) == [1, 2]
+        es = mock_es()
+        es.index.assert_called_once_with([{'id': 1}])
+        es.bulk_index_relations.assert_called_once_with(
+            [doc], nested_only=True)
+        deleted = es.delete.call_args[0][0]
+        assert sorted(deleted) == ['2', '3']
+
+    @patch.object(sync.ESSyncRunner, 'index_changes')
+    def test_run(self, mock_index):
+        runner, model = make_runner(flush_size=2, flush_interval=100)
+        source = FakeSource([
+            sync.Change(sync.INDEX, 'story', 1, 'a'),
+            None,
+            sync.Change(sync.INDEX, 'other', 5, 'b'),
+            sync.Change(sync.DELETE, 'story', 2, 'c'),
+            sync.Change(sync.INDEX, 'story', 3, 'd'),
+        ])
+        runner.run(source)
+        assert mock_index.call_args_list == [
+            call({('story', 1): sync.INDEX, ('story', 2): sync.DELETE}),
+            call({('story', 3): sync.INDEX}),
+        ]
+        runner.checkpoints.set.assert_called_with(
+            'es_sync', {'source': 'fake', 'token': 'd'})
+
+
+class TestSources(object):
+
+    def test_get_source_oplog(self):
+        db = Mock(spec=['name', 'connection'])
+        source = sync.get_source(
+            db, ['story'], checkpoint={'source': 'oplog', 'token': 1})
+        assert isinstance(source, sync.OplogSource)
+        assert source.token == 1
+
+    def test_get_source_other_checkpoint(self):
+        db = Mock()
+        source = sync.get_source(
+            db, ['story'], checkpoint={'source': 'oplog', 'token': 1})
+        assert isinstance(source, sync.ChangeStreamSource)
+        assert source.token is None
+
+    def test_oplog_changes(self):
+        db = Mock(spec=['name', 'connection'])
+        db.name = 'db'
+        source = sync.OplogSource(db, ['story'], token=1)
+        cursor = MagicMock(alive=True)
+        cursor.__iter__.return_value = iter([
+            {'ts': 2, 'op': 'i', 'ns': 'db.story', 'o': {'_id': 'a'}},
+            {'ts': 3, 'op': 'n', 'ns': 'db.story', 'o': {}},
+            {'ts': 4, 'op': 'u', 'ns': 'db.story', 'o2': {'_id': 'b'},
+             'o': {'$set': {'name': 'foo'}}},
+            {'ts': 5, 'op': 'd', 'ns': 'db.story', 'o': {'_id': 'c'}},
+        ])
+        with patch.object(sync.OplogSource, '_cursor', return_value=cursor):
+            changes = source.changes()
+            results = [next(changes) for _ in range(4)]
+        assert [(c.action, c.collection, c.pk, c.token)
+                for c in results[:3]] == [
+            (sync.INDEX, 'story', 'a', 2),
+            (sync.INDEX, 'story', 'b', 4),
+            (sync.DELETE, 'story', 'c', 5),
+        ]
+        assert results[3] is None
+        assert source.namespaces == ['db.story']
+
+
+class TestESSignals(object):
+
+    @patch('nefertari.elasticsearch.ES')
+    def test_disabled_signals(self, mock_es):
+        signals.disable_es_signals()
+        try:
+            signals.on_post_save(None, Mock(), created=True)
+            signals.on_post_delete(None, Mock())
+            signals.on_bulk_update(Mock(_index_enabled=True), [1], None)
+        finally:
+            signals.enable_es_signals()
+        assert not mock_es.called
@@ -0,0 +1,103 @@
+import pytest
+from bson import ObjectId
+from mock import Mock, patch
+
+from .. import documents as docs
+from .. import fields
+from .. import unit_of_work as uow
+
+
+def _model():
+    class MyModel(docs.BaseDocument):
+        name = fields.StringField()
+    return MyModel
+
+
+class TestUnitOfWork(object):
+
+    def test_add_remove(self):
+        MyModel = _model()
+        unit = uow.UnitOfWork()
+        new = MyModel(name=u'foo')
+        loaded = MyModel._from_son({'_id': ObjectId(), 'name': u'bar'})
+        unit.add(new)
+        unit.add(new)
+        unit.add(loaded)
+        assert len(unit) == 2
+        unit.remove(new)
+        unit.remove(loaded)
+        assert list(unit._dirty.values()) == []
+        assert list(unit._deleted.values()) == [loaded]
+
+    @patch('nefertari_mongodb.signals.on_bulk_update')
+    def test_flush(self, mock_bulk_update):
+        MyModel = _model()
+        collection = Mock()
+        bulk = collection.initialize_ordered_bulk_op()
+        new = MyModel(id=ObjectId(), name=u'foo')
+        loaded = MyModel._from_son({'_id': ObjectId(), 'name': u'bar'})
+        loaded.name = u'baz'
+        hook = Mock()
+        loaded._backref_hooks = (hook,)
+        unit = uow.UnitOfWork()
+        unit.add(new)
+        unit.add(loaded)
+        with patch.object(MyModel, '_get_collection',
+                          return_value=collection):
+            unit.flush()
+        bulk.insert.assert_called_once_with(new.to_mongo())
+        bulk.find.assert_called_once_with({'_id': loaded.pk})
+        bulk.find().update_one.assert_called_once_with(
+            {'$set': {'name': u'baz'}})
+        assert bulk.execute.call_count == 1
+        mock_bulk_update.assert_called_once_with(
+            MyModel, [new, loaded], None)
+        hook.assert_called_once_with(document=loaded)
+        assert not new._created
+        assert not loaded._get_changed_fields()
+        assert not unit
+
+    def test_commit_limit(self):
+        unit = uow.UnitOfWork()
+        with patch.object(unit, 'flush'):
+            unit.add(Mock())
+            with pytest.raises(RuntimeError):
+                unit.commit()
+
+
+class TestUnitOfWorkScope(object):
+
+    @patch.object(docs.mongo.Document, 'save')
+    @patch.object(uow.UnitOfWork, 'commit')
+    def test_save(self, mock_commit, mock_save):
+        MyModel = _model()
+        obj = MyModel(name=u'foo')
+        with uow.unit_of_work() as unit:
+            assert obj.save() is obj
+            obj.save()
+            assert list(unit._dirty.values()) == [obj]
+            assert isinstance(obj.pk, ObjectId)
+        assert not mock_save.called
+        mock_commit.assert_called_once_with()
+        assert uow.get_unit_of_work() is None
+
+    @patch.object(uow.UnitOfWork, 'commit')
+    def test_error_discards(self, mock_commit):
+        MyModel = _model()
+        with pytest.raises(ValueError):
+            with uow.unit_of_work():
+                MyModel(name=u'foo').save()
+                raise ValueError
+        assert not mock_commit.called
+        assert uow.get_unit_of_work() is None
+
+    @patch.object(uow.UnitOfWork, 'flush')
+    def test_tween_discards_error_response(self, mock_flush):
+        MyModel = _model()
+
+        def handler(request):
+            MyModel(name=u'foo').save()
+            return Mock(status_int=400)
+        tween = uow.unit_of_work_tween_factory(handler, Mock())
+        tween(Mock())
+        assert not mock_flush.called
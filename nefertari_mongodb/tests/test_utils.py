@@ -0,0 +1,40 @@
+import pytest
+from mock import Mock
+from pyramid.threadlocal import get_current_request, manager
+
+from .. import utils
+from .. import identity_map as imap
+
+
+class TestBackgroundCall(object):
+
+    def test_background_call(self):
+        assert utils.BackgroundCall(lambda x: x + 1, 1).result() == 2
+        call = utils.BackgroundCall(int, 'foo')
+        with pytest.raises(ValueError):
+            call.result()
+
+    def test_background_call_context(self):
+        request = Mock()
+        manager.push({'request': request, 'registry': request.registry})
+        try:
+            with imap.identity_map_scope() as identity_map:
+                call = utils.BackgroundCall(
+                    lambda: (get_current_request(), imap.get_identity_map()))
+                assert call.result() == (request, identity_map)
+        finally:
+            manager.pop()
+
+    def test_iter_prefetched(self):
+        results = utils.iter_prefetched(lambda x: x * 2, [1, 2, 3])
+        assert list(results) == [2, 4, 6]
+
+    def test_iter_prefetched_error(self):
+        def func(item):
+            if item == 2:
+                raise ValueError(item)
+            return item
+        results = utils.iter_prefetched(func, [1, 2, 3])
+        assert next(results) == 1
+        with pytest.raises(ValueError):
+            next(results)
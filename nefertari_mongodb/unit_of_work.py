@@ -0,0 +1,240 @@
+""" Unit of work batching writes of documents.
+
+Within `unit_of_work()` scope, `save`, `update` and `delete` of documents
+don't write to the database. Documents are validated and marked as dirty
+or deleted instead, so repeated changes of the same document are
+coalesced. When the scope exits without errors, changes are flushed with
+one bulk write per collection. Then post-save and post-delete signals are
+sent, documents are indexed in ES with one bulk request per model and
+backref hooks are run. Changes made by backref hooks are flushed the same
+way. When the scope exits with an error, changes are discarded.
+
+New documents get ObjectId primary keys when they are marked, so they may
+be referenced by other documents before they are flushed. Atomic updates
+of iterables (see `BaseMixin._atomic_iterables`) are not used within
+units of work, so changed iterables are flushed as whole fields.
+
+Unit of work is enabled per request by setting
+`mongodb.unit_of_work = true`. Changes of requests which end with an error
+response are discarded.
+"""
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from mongoengine import signals
+from pymongo.errors import BulkWriteError
+from pyramid.tweens import EXCVIEW
+
+_local = threading.local()
+
+
+def _group_by_model(documents):
+    groups = OrderedDict()
+    for document in documents:
+        groups.setdefault(type(document), []).append(document)
+    return groups.items()
+
+
+class UnitOfWork(object):
+    """ Dirty and deleted documents of a unit of work.
+
+    :max_flushes: Max number of flushes performed on commit. Each flush
+        writes changes made by backref hooks of the previous one.
+    """
+    max_flushes = 10
+
+    def __init__(self):
+        self._dirty = OrderedDict()
+        self._deleted = OrderedDict()
+        # True while post-save/post-delete signals of flushed documents
+        # are sent, so ES signal handlers leave indexing to the flush
+        self.indexing_deferred = False
+
+    def __len__(self):
+        return len(self._dirty) + len(self._deleted)
+
+    @staticmethod
+    def _key(document):
+        return id(document)
+
+    def add(self, document):
+        """ Mark :document: as dirty. """
+        key = self._key(document)
+        self._deleted.pop(key, None)
+        if key not in self._dirty:
+            self._dirty[key] = document
+
+    def remove(self, document):
+        """ Mark :document: as deleted. Documents which were not written
+        yet are just forgotten.
+        """
+        key = self._key(document)
+        self._dirty.pop(key, None)
+        if not document._created:
+            self._deleted[key] = document
+
+    def discard(self):
+        """ Forget all changes. """
+        self._dirty.clear()
+        self._deleted.clear()
+
+    def commit(self):
+        """ Flush changes until backref hooks make no more changes. """
+        for _ in range(self.max_flushes):
+            if not self:
+                return
+            self.flush()
+        raise RuntimeError(
+            'Unit of work changes were not flushed in %d flushes' % (
+                self.max_flushes))
+
+    def flush(self):
+        """ Write changes in bulk, send signals, index documents in ES and
+        run backref hooks.
+        """
+        dirty = list(self._dirty.values())
+        deleted = list(self._deleted.values())
+        self.discard()
+
+        saved = []
+        for model, documents in _group_by_model(dirty):
+            saved += self._write(model, documents)
+        for model, documents in _group_by_model(deleted):
+            self._delete(model, documents)
+
+        # Like in `save`, post-save signals are sent before changed
+        # fields are cleared, and backref hooks are run after that
+        self.indexing_deferred = True
+        try:
+            for document, created, changed in saved:
+                signals.post_save.send(
+                    type(document), document=document, created=created)
+            for document in deleted:
+                signals.post_delete.send(type(document), document=document)
+        finally:
+            self.indexing_deferred = False
+        self._index(
+            [doc for doc, created, changed in saved if created or changed],
+            deleted)
+        for document, created, changed in saved:
+            document._clear_changed_fields()
+            document._created = False
+        for document, created, changed in saved:
+            document.run_backref_hooks()
+            document._backref_hooks = ()
+
+    def _write(self, model, documents):
+        """ Insert and update :documents: of :model: with a single bulk
+        write. Returns list of (document, created, changed) tuples.
+        """
+        from nefertari.json_httpexceptions import JHTTPConflict
+        pk_field = model._fields[model.pk_field()]
+        bulk = model._get_collection().initialize_ordered_bulk_op()
+        operations = 0
+        saved = []
+        for document in documents:
+            created = document._created
+            changed = bool(document._get_changed_fields())
+            if created:
+                bulk.insert(document.to_mongo())
+                operations += 1
+            else:
+                updates, removals = document._delta()
+                update = {}
+                if updates:
+                    update['$set'] = updates
+                if removals:
+                    update['$unset'] = removals
+                if update:
+                    query = {'_id': pk_field.to_mongo(document.pk)}
+                    bulk.find(query).update_one(update)
+                    operations += 1
+            saved.append((document, created, changed))
+
+        if operations:
+            try:
+                bulk.execute()
+            except BulkWriteError as ex:
+                errors = ex.details.get('writeErrors', [])
+                if any(err.get('code') in (11000, 11001) for err in errors):
+                    raise JHTTPConflict(
+                        detail='Resource `{}` already exists.'.format(
+                            model.__name__),
+                        extra={'data': ex})
+                raise
+        return saved
+
+    def _delete(self, model, documents):
+        """ Delete :documents: of :model: with a single query. Delete rules
+        of the model are applied and documents are removed from
+        relationships with counters.
+        """
+        from .identity_map import get_identity_map
+        pks = [document.pk for document in documents]
+        request = getattr(documents[0], '_request', None)
+        model._remove_from_counted_relationships(documents, request)
+        model.objects(pk__in=pks).delete(_from_doc_delete=True)
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            for document in documents:
+                identity_map.discard(document)
+
+    def _index(self, saved, deleted):
+        """ Index :saved: documents and delete :deleted: documents in ES
+        with a bulk request per model.
+        """
+        from .signals import es_signals_enabled, on_bulk_update
+        if not es_signals_enabled():
+            return
+        for model, documents in _group_by_model(saved):
+            request = getattr(documents[0], '_request', None)
+            on_bulk_update(model, documents, request)
+        for model, documents in _group_by_model(deleted):
+            if not getattr(model, '_index_enabled', False):
+                continue
+            from nefertari.elasticsearch import ES
+            request = getattr(documents[0], '_request', None)
+            ES(model.__name__).delete(
+                [document.pk for document in documents], request=request)
+
+
+def get_unit_of_work():
+    """ Get unit of work of current scope if any. """
+    return getattr(_local, 'unit_of_work', None)
+
+
+@contextmanager
+def unit_of_work():
+    """ Collect changes of documents made in the block and commit them
+    when the block exits without errors.
+    """
+    previous = get_unit_of_work()
+    _local.unit_of_work = UnitOfWork()
+    try:
+        yield _local.unit_of_work
+        _local.unit_of_work.commit()
+    finally:
+        _local.unit_of_work.discard()
+        _local.unit_of_work = previous
+
+
+def unit_of_work_tween_factory(handler, registry):
+    """ Tween that commits changes of documents made by a request in a
+    single unit of work.
+    """
+    def unit_of_work_tween(request):
+        with unit_of_work() as uow:
+            response = handler(request)
+            if response.status_int >= 400:
+                uow.discard()
+            return response
+    return unit_of_work_tween
+
+
+def includeme(config):
+    # Placed under the exception view tween, so changes are discarded
+    # when a view raises and commit errors are rendered
+    config.add_tween(
+        'nefertari_mongodb.unit_of_work.unit_of_work_tween_factory',
+        under=EXCVIEW)
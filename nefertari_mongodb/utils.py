@@ -1,7 +1,22 @@
+import sys
+import threading
+
+import six
+from pyramid.threadlocal import manager
+
+from . import instrumentation
 from .fields import (RelationshipField, ReferenceField)
+from .identity_map import get_identity_map, active_identity_map
 
 relationship_fields = (RelationshipField, ReferenceField)
 
+# Cache of generated ES mappings. See `BaseMixin.get_es_mapping`
+es_mapping_cache = {}
+
+# (model, field name) of RelationshipFields with counters. See
+# `get_counted_relationships`
+counted_relationships = []
+
 
 def is_relationship_field(field, model_cls):
     """ Determine if `field` of the `model_cls` is a relational
@@ -24,3 +39,79 @@ def get_relationship_cls(field, model_cls):
     if isinstance(field_obj, RelationshipField):
         field_obj = getattr(field_obj, 'field')
     return getattr(field_obj, 'document_type')
+
+
+def get_counted_relationships(model_cls):
+    """ Return (model, field name) of RelationshipFields with counters
+    which relate documents of `model_cls`.
+
+    Models which share a collection are only returned once.
+    """
+    seen = set()
+    result = []
+    for owner, field_name in counted_relationships:
+        field_obj = owner._fields[field_name]
+        if not issubclass(model_cls, field_obj.field.document_type):
+            continue
+        key = (owner._get_collection_name(), field_name)
+        if key not in seen:
+            seen.add(key)
+            result.append((owner, field_name))
+    return result
+
+
+class BackgroundCall(object):
+    """ Call of `func(*args)` in a background thread.
+
+    The call runs with request-scoped state of the calling thread: current
+    pyramid request and registry, identity map and instrumentation stats,
+    so commands it performs are recorded and checked against query budget
+    of the request.
+    """
+    def __init__(self, func, *args):
+        self._result = {}
+        self._context = (
+            manager.get(), get_identity_map(),
+            instrumentation.get_request_stats())
+        self._thread = threading.Thread(
+            target=self._call, args=(func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _call(self, func, args):
+        threadlocals, identity_map, stats = self._context
+        manager.push(threadlocals)
+        try:
+            with active_identity_map(identity_map), \
+                    instrumentation.request_stats(stats):
+                self._result['value'] = func(*args)
+        except Exception:
+            self._result['error'] = sys.exc_info()
+        finally:
+            manager.pop()
+
+    def result(self):
+        """ Wait for the call and return its result. Exceptions raised by
+        the call are reraised in the calling thread.
+        """
+        self._thread.join()
+        if 'error' in self._result:
+            six.reraise(*self._result['error'])
+        return self._result['value']
+
+
+def iter_prefetched(func, items):
+    """ Yield `func(item)` for each of :items:.
+
+    `func` is called for the next item in a background thread while the
+    result of the current one is consumed. Exceptions are reraised in
+    the calling thread.
+    """
+    pending = None
+    for item in items:
+        started = BackgroundCall(func, item)
+        if pending is not None:
+            yield pending.result()
+        pending = started
+    if pending is not None:
+        yield pending.result()
@@ -36,4 +36,12 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    entry_points={
+        'console_scripts': [
+            'nefertari-mongodb-es-sync = '
+            'nefertari_mongodb.scripts.es_sync:main',
+            'nefertari-mongodb-reindex = '
+            'nefertari_mongodb.scripts.reindex:main',
+        ],
+    },
 )